@@ -5,15 +5,43 @@
 #
 
 from __future__ import print_function
+import array
 import collections
+import mmap
+import multiprocessing
 import os
 import numpy
-import bisect
 import sys
+import time
 import ctypes
 
+try:
+    from collections.abc import Mapping, MutableMapping, Sequence
+except ImportError:
+    from collections import Mapping, MutableMapping, Sequence
+
+try:
+    integer_types = (int, long)
+except NameError:
+    integer_types = (int,)
+
 from VehicleType import VehicleType, VehicleTypeString
 
+def _scalar(value):
+    '''converts numpy scalars back to the plain python value the log parser produced'''
+    if isinstance(value, numpy.generic):
+        return value.item()
+    return value
+
+def _castOrKeep(cast):
+    '''returns a function applying cast to a string, or returning it unchanged if that fails, as trycastToFormatType does'''
+    def convert(value):
+        try:
+            return cast(value)
+        except:
+            return value
+    return convert
+
 class Format(object):
     '''Data channel format as specified by the FMT lines in the log file'''
     def __init__(self,msgType,msgLen,name,types,labels):
@@ -24,6 +52,19 @@ class Format(object):
         self.types   = types
         self.labels  = labels.split(',')
 
+    # numpy storage type for values cast by trycastToFormatType, per format character
+    FIELD_DTYPE = dict(
+        [(c, numpy.float64) for c in "fcCeELd"] +
+        [(c, numpy.int64) for c in "bBhHiIMq"] +
+        [('Q', numpy.uint64)] +
+        [(c, object) for c in "nNZ"])
+
+    # the same casts as trycastToFormatType, looked up once per FMT rather than for every value
+    CONVERTER = dict(
+        [(c, _castOrKeep(float)) for c in "fcCeELd"] +
+        [(c, _castOrKeep(int)) for c in "bBhHiIMQq"] +
+        [(c, str) for c in "nNZ"])
+
     def __str__(self):
         return "%8s %s" % (self.name, repr(self.labels))
 
@@ -51,18 +92,25 @@ class Format(object):
         fieldtypes = [i for i in self.types]
         fieldlabels = self.labels[:]
 
+        # labels without a matching format character are left as uncast strings
+        members['types'] = fieldtypes[:len(fieldlabels)]
+        members['dtypes'] = [Format.FIELD_DTYPE.get(_type, object) for _type in members['types']]
+        members['dtypes'] += [object] * (len(fieldlabels) - len(members['dtypes']))
+        members['converters'] = tuple(Format.CONVERTER.get(_type, str) for _type in members['types'])
+        members['converters'] += (str,) * (len(fieldlabels) - len(members['converters']))
+
         # field access
-        for (label, _type) in zip(fieldlabels, fieldtypes):
-            def createproperty(name, format):
+        for (label, convert) in zip(fieldlabels, members['converters']):
+            def createproperty(name, convert):
                 # extra scope for variable sanity
                 # scaling via _NAME and def NAME(self): return self._NAME / SCALE
                 propertyname = name
                 attributename = '_' + name
                 p = property(lambda x:getattr(x, attributename),
-                             lambda x, v:setattr(x,attributename, Format.trycastToFormatType(v,format)))
+                             lambda x, v:setattr(x,attributename, convert(v)))
                 members[propertyname] = p
                 members[attributename] = None
-            createproperty(label, _type)
+            createproperty(label, convert)
 
         # repr shows all values but the header
         members['__repr__'] = lambda x: "<{cls} {data}>".format(cls=x.__class__.__name__, data = ' '.join(["{}:{}".format(k,getattr(x,'_'+k)) for k in x.labels]))
@@ -133,6 +181,29 @@ class BinaryFormat(ctypes.LittleEndianStructure):
         'E': 100,
     }
 
+    # numpy equivalents of FIELD_FORMAT
+    FIELD_DTYPE = {
+        'b': numpy.int8,
+        'B': numpy.uint8,
+        'h': numpy.int16,
+        'H': numpy.uint16,
+        'i': numpy.int32,
+        'I': numpy.uint32,
+        'f': numpy.float32,
+        'd': numpy.float64,
+        'n': 'S4',
+        'N': 'S16',
+        'Z': 'S64',
+        'c': numpy.int16,
+        'C': numpy.uint16,
+        'e': numpy.int32,
+        'E': numpy.uint32,
+        'L': numpy.int32,
+        'M': numpy.uint8,
+        'q': numpy.int64,
+        'Q': numpy.uint64,
+    }
+
     _packed_ = True
     _fields_ = [ \
         ('head', logheader),
@@ -160,6 +231,7 @@ class BinaryFormat(ctypes.LittleEndianStructure):
             return None
 
         fields = [('head',logheader)]
+        dtypes = []
 
         # field access
         for (label, _type) in zip(fieldlabels, fieldtypes):
@@ -173,6 +245,13 @@ class BinaryFormat(ctypes.LittleEndianStructure):
                 if scale is not None:
                     p = property(lambda x:getattr(x, attributename) / scale) 
                 members[propertyname] = p
+                dtype = numpy.dtype(BinaryFormat.FIELD_DTYPE.get(format, object))
+                if dtype.kind == 'S':
+                    dtype = numpy.dtype(object)
+                elif scale is not None:
+                    # scaled values take whatever type the division in the property above gives
+                    dtype = numpy.result_type(dtype, 1 / scale)
+                dtypes.append(dtype)
                 try:
                     fields.append((attributename, BinaryFormat.FIELD_FORMAT[format]))
                 except KeyError:
@@ -180,6 +259,13 @@ class BinaryFormat(ctypes.LittleEndianStructure):
                     raise
             createproperty(label, _type)
         members['_fields_'] = fields
+        members['dtypes'] = dtypes
+        members['types'] = [_type for (label, _type) in zip(fieldlabels, fieldtypes)]
+
+        # the same layout as a numpy structured dtype, used to decode all messages of this type at once
+        members['DTYPE'] = numpy.dtype(
+            [('head1', numpy.uint8), ('head2', numpy.uint8), ('msgid', numpy.uint8)] +
+            [('f%d' % i, numpy.dtype(BinaryFormat.FIELD_DTYPE[_type]).newbyteorder('<')) for (i, _type) in enumerate(members['types'])])
 
         # repr shows all values but the header
         members['__repr__'] = lambda x: "<{cls} {data}>".format(cls=x.__class__.__name__, data = ' '.join(["{}:{}".format(k,getattr(x,k)) for k in x.labels]))
@@ -201,45 +287,232 @@ class BinaryFormat(ctypes.LittleEndianStructure):
 
 BinaryFormat.SIZE = ctypes.sizeof(BinaryFormat)
 
+class TimeIndex(object):
+    '''sorted, array-backed index between the line numbers and timestamps of a message group, so that time <-> line
+    lookups are searchsorted queries rather than scans. Times are in milliseconds'''
+
+    # timestamp labels in order of preference, and their scale to milliseconds
+    timeLabels = [('TimeUS', 0.001), ('TimeMS', 1), ('Time', 1)]
+
+    def __init__(self, lines, times, scale=1):
+        self.lines  = lines
+        self._times = times
+        self._scale = scale
+
+    @staticmethod
+    def fromGroup(group):
+        '''returns the TimeIndex of a {label:Channel} group, or None if it has no timestamps'''
+        for (label, scale) in TimeIndex.timeLabels:
+            if label in group and group[label].dtype.kind in 'iuf' and len(group[label].lines):
+                return TimeIndex(group[label].lines, group[label].values, scale)
+        return None
+
+    @property
+    def times(self):
+        '''timestamps in ms, aligned with lines. Any steps back in time are flattened out so they are always sorted'''
+        if self._scale is not None:
+            times = self._times * self._scale if self._scale != 1 else self._times.astype(numpy.float64)
+            if len(times) and (numpy.diff(times) < 0).any():
+                times = numpy.maximum.accumulate(times)
+            self._times = times
+            self._scale = None
+        return self._times
+
+    def timeAtLine(self, lineNumber):
+        '''returns the time of the first sample at or after lineNumber, or None if there are none'''
+        index = self.lines.searchsorted(lineNumber, 'left')
+        if index < len(self.lines):
+            return self.times.item(index)
+        return None
+
+    def timesAtLines(self, lines):
+        '''array version of timeAtLine, lines after the last sample get its time'''
+        if lines is self.lines or numpy.array_equal(lines, self.lines):
+            return self.times
+        index = numpy.minimum(self.lines.searchsorted(lines, 'left'), len(self.lines)-1)
+        return self.times[index]
+
+    def lineAtTime(self, time):
+        '''returns the line number of the first sample at or after time, or None if there are none'''
+        index = self.times.searchsorted(time, 'left')
+        if index < len(self.lines):
+            return self.lines.item(index)
+        return None
+
+    def linesBetween(self, startTime, endTime):
+        '''returns (startLine, endLine) of the first and last samples from startTime to endTime inclusive, or None if there are none'''
+        start = self.times.searchsorted(startTime, 'left')
+        end   = self.times.searchsorted(endTime, 'right')
+        if start >= end:
+            return None
+        return (self.lines.item(start), self.lines.item(end-1))
+
+
 class Channel(object):
     '''storage for a single stream of data, i.e. all GPS.RelAlt values'''
 
-    # TODO: rethink data storage, but do more thorough regression testing before refactoring it
     # TODO: store data as a scipy spline curve so we can more easily interpolate and sample the slope?
 
-    def __init__(self):
-        self.dictData = {} #  dict of linenum->value      # store dupe data in dict and list for now, until we decide which is the better way to go
-        self.listData = [] #  list of (linenum,value)     # store dupe data in dict and list for now, until we decide which is the better way to go
+    # data is held column-wise in two growable numpy arrays (line numbers and values) rather than as
+    # Python dicts/tuples; dictData and listData are kept as lazy read-only views for older code
+
+    INITIAL_SIZE = 64
+
+    class DictView(Mapping):
+        '''read-only linenum->value view of a Channel, standing in for the old dictData dict'''
+        def __init__(self, channel):
+            self.channel = channel
+        def __getitem__(self, lineNumber):
+            index = self.channel.lines.searchsorted(lineNumber)
+            if index < len(self.channel.lines) and self.channel.lines[index] == lineNumber:
+                return self.channel.values.item(index)
+            raise KeyError(lineNumber)
+        def __contains__(self, lineNumber):
+            index = self.channel.lines.searchsorted(lineNumber)
+            return index < len(self.channel.lines) and self.channel.lines[index] == lineNumber
+        def __iter__(self):
+            return iter(self.channel.lines.tolist())
+        def __len__(self):
+            return len(self.channel.lines)
+        def keys(self):
+            return self.channel.lines.tolist()
+        def values(self):
+            return self.channel.values.tolist()
+        def items(self):
+            return list(zip(self.channel.lines.tolist(), self.channel.values.tolist()))
+
+    class ListView(Sequence):
+        '''read-only list of (linenum,value) view of a Channel, standing in for the old listData list'''
+        def __init__(self, channel):
+            self.channel = channel
+        def __getitem__(self, index):
+            if isinstance(index, slice):
+                return list(zip(self.channel.lines[index].tolist(), self.channel.values[index].tolist()))
+            return (self.channel.lines.item(index), self.channel.values.item(index))
+        def __iter__(self):
+            return iter(zip(self.channel.lines.tolist(), self.channel.values.tolist()))
+        def __len__(self):
+            return len(self.channel.lines)
+
+    def __init__(self, dtype=object):
+        self._lines  = numpy.empty(Channel.INITIAL_SIZE, dtype=numpy.int64)
+        self._values = numpy.empty(Channel.INITIAL_SIZE, dtype=dtype)
+        self._count  = 0
+        self._setAccepts()
+        self.timeIndex = None # TimeIndex of this channel's group, set once the log has been read
+
+    def _setAccepts(self):
+        # python types which can be stored in the value array without changing them, anything else
+        # (e.g. a text log token which failed its cast) switches the channel over to object storage
+        kind = self._values.dtype.kind
+        if kind == 'f':
+            self._accepts = float
+        elif kind in 'iu':
+            self._accepts = integer_types
+        else:
+            self._accepts = object
+
+    def _resize(self, size, dtype=None):
+        lines  = numpy.empty(size, dtype=self._lines.dtype)
+        values = numpy.empty(size, dtype=dtype or self._values.dtype)
+        lines[:self._count]  = self._lines[:self._count]
+        values[:self._count] = self._values[:self._count]
+        self._lines  = lines
+        self._values = values
+        self._setAccepts()
+
+    @property
+    def lines(self):
+        '''numpy array of the line numbers this channel has data for, in ascending order'''
+        return self._lines[:self._count]
+    @property
+    def values(self):
+        '''numpy array of this channel's values, index-aligned with lines'''
+        return self._values[:self._count]
+    @property
+    def dtype(self):
+        return self._values.dtype
+    @property
+    def times(self):
+        '''numpy array of the timestamps (in ms) of this channel's values, from its TimeIndex'''
+        if self.timeIndex is None:
+            raise Exception("No timestamps for this channel")
+        return self.timeIndex.timesAtLines(self.lines)
+    @property
+    def dictData(self):
+        return Channel.DictView(self)
+    @property
+    def listData(self):
+        return Channel.ListView(self)
+
+    def append(self, lineNumber, value):
+        '''add a value to the end of this channel, line numbers must be added in ascending order'''
+        if self._count == len(self._lines):
+            self._resize(max(2 * self._count, Channel.INITIAL_SIZE))
+        if not isinstance(value, self._accepts):
+            self._resize(len(self._lines), object)
+        self._lines[self._count]  = lineNumber
+        self._values[self._count] = value
+        self._count += 1
+    def extend(self, lines, values):
+        '''add arrays of line numbers and values to the end of this channel'''
+        count = self._count + len(lines)
+        dtype = self.dtype
+        if values.dtype != dtype:
+            # keep ints as ints and floats as floats, as append() does, widening where needed
+            if dtype.kind == 'O' or values.dtype.kind not in 'iuf' or (dtype.kind == 'f') != (values.dtype.kind == 'f'):
+                dtype = numpy.dtype(object)
+            elif numpy.can_cast(dtype, values.dtype):
+                dtype = values.dtype
+            elif not numpy.can_cast(values.dtype, dtype):
+                dtype = numpy.dtype(object)
+        if count > len(self._lines) or dtype != self.dtype:
+            self._resize(max(count, len(self._lines)), dtype)
+        self._lines[self._count:count]  = lines
+        self._values[self._count:count] = values
+        self._count = count
+    def trim(self):
+        '''release any spare capacity once the log has been read'''
+        if self._count != len(self._lines):
+            self._resize(self._count)
     def getSegment(self, startLine, endLine):
         '''returns a segment of this data (from startLine to endLine, inclusive) as a new Channel instance'''
-        segment = Channel()
-        segment.dictData = {k:v for k,v in self.dictData.iteritems() if k >= startLine and k <= endLine}
+        start = self.lines.searchsorted(startLine, 'left')
+        end   = self.lines.searchsorted(endLine, 'right')
+        segment = Channel(self.dtype)
+        # the segment shares memory with this channel, which is safe as it has no spare capacity to append into
+        segment._lines  = self._lines[start:end]
+        segment._values = self._values[start:end]
+        segment._count  = end - start
+        segment.timeIndex = self.timeIndex
         return segment
+    def between_times(self, startTime, endTime):
+        '''returns the segment of this data logged from startTime to endTime (in ms, inclusive) as a new Channel instance'''
+        if self.timeIndex is None:
+            raise Exception("No timestamps for this channel")
+        lines = self.timeIndex.linesBetween(startTime, endTime)
+        if lines is None:
+            return self.getSegment(0, -1)
+        return self.getSegment(*lines)
     def min(self):
-        return min(self.dictData.values())
+        return _scalar(self.values.min())
     def max(self):
-        return max(self.dictData.values())
+        return _scalar(self.values.max())
     def avg(self):
-        return numpy.mean(self.dictData.values())
+        if self.dtype.kind == 'f':
+            return numpy.mean(self.values, dtype=numpy.float64)
+        return numpy.mean(self.values)
     def getNearestValueFwd(self, lineNumber):
         '''Returns (value,lineNumber)'''
-        index = bisect.bisect_left(self.listData, (lineNumber,-99999))
-        while index<len(self.listData):
-            line  = self.listData[index][0]
-            #print("Looking forwards for nearest value to line number %d, starting at line %d" % (lineNumber,line)) # TEMP
-            if line >= lineNumber:
-                return (self.listData[index][1],line)
-            index += 1
+        index = self.lines.searchsorted(lineNumber, 'left')
+        if index < len(self.lines):
+            return (self.values.item(index), self.lines.item(index))
         raise Exception("Error finding nearest value for line %d" % lineNumber)
     def getNearestValueBack(self, lineNumber):
         '''Returns (value,lineNumber)'''
-        index = bisect.bisect_left(self.listData, (lineNumber,-99999)) - 1
-        while index>=0:
-            line  = self.listData[index][0]
-            #print("Looking backwards for nearest value to line number %d, starting at line %d" % (lineNumber,line)) # TEMP
-            if line <= lineNumber:
-                return (self.listData[index][1],line)
-            index -= 1
+        index = self.lines.searchsorted(lineNumber, 'left') - 1
+        if index >= 0:
+            return (self.values.item(index), self.lines.item(index))
         raise Exception("Error finding nearest value for line %d" % lineNumber)
     def getNearestValue(self, lineNumber, lookForwards=True):
         '''find the nearest data value to the given lineNumber, defaults to first looking forwards. Returns (value,lineNumber)'''
@@ -263,14 +536,131 @@ class Channel(object):
         return ((weight*prevValue) + ((1-weight)*nextValue))
     def getIndexOf(self, lineNumber):
         '''returns the index within this channel's listData of the given lineNumber, or raises an Exception if not found'''
-        index = bisect.bisect_left(self.listData, (lineNumber,-99999))
-        #print("INDEX of line %d: %d" % (lineNumber,index))
-        #print("self.listData[index][0]: %d" % self.listData[index][0])
-        if (self.listData[index][0] == lineNumber):
-            return index
+        index = self.lines.searchsorted(lineNumber, 'left')
+        if index < len(self.lines) and self.lines[index] == lineNumber:
+            return int(index)
         else:
             raise Exception("Error finding index for line %d" % lineNumber)
 
+class ShardDesync(Exception):
+    '''raised when walking a shard of a binary log finds something which needs the shards before it to be walked first'''
+    pass
+
+# the DataflashLog and data being walked by _index_binary_sharded, inherited by the pool's processes as they are forked
+_shardLog  = None
+_shardData = None
+
+def _initShardWorker():
+    '''pool process initializer for _walkShard, the parent reports any broken FMTs as it processes them'''
+    sys.stderr = open(os.devnull, 'w')
+
+def _walkShard(shard):
+    '''pool process side of _index_binary_sharded, walking the messages from (start, stop) of _shardData. Returns
+    (startOffset, numBytes, lineCount, endOffset, atEnd, index, headers, formats) with line numbers counted from the
+    shard's first message, index as msgid -> (offsets, lineNumbers), headers the (lineNumber, offset) of each header
+    message and formats the (msgid, size, name) of each FMT learned, or None if it couldn't be walked'''
+    (start, stop) = shard
+    log = _shardLog
+    offset = log._resync_binary(_shardData, start, stop)
+    if offset is None:
+        return None
+    headers = []
+    formats = []
+    def header(lineNumber, headerOffset, typ, window, pos):
+        headers.append((lineNumber, headerOffset))
+        if typ.NAME == 'FMT':
+            e = typ.from_buffer_copy(window, pos)
+            cls = e.to_class()
+            if cls is not None and e.type not in log._formats:
+                log._formats[e.type] = cls
+                formats.append((e.type, cls.SIZE, cls.NAME))
+    index = {}
+    try:
+        (numBytes, lineCount, end, atEnd) = log._walk_binary(_shardData, offset, stop, False, index, 0, header, shard=True)
+    except ShardDesync:
+        return None
+    for (msgid, (offsets, lines)) in index.items():
+        index[msgid] = (numpy.concatenate([log._asarray(part) for part in offsets]),
+                        numpy.concatenate([log._asarray(part) for part in lines]))
+    return (offset, numBytes, lineCount, end, atEnd, index, headers, formats)
+
+class LazyChannels(MutableMapping):
+    '''lineLabel -> {dataLabel:Channel} mapping used in place of a dict by lazily read logs, decoding each group of channels the first time it is accessed'''
+    def __init__(self, decode, lineLabels, scan=None):
+        self._decode  = decode
+        self._scan    = scan
+        self._pending = list(lineLabels)
+        self._groups  = {}
+        self._scanned = set()
+    def scanPending(self):
+        '''calls scan(lineLabel) once for each group not decoded yet, which doesn't make it decoded'''
+        for lineLabel in self._pending:
+            if lineLabel not in self._scanned:
+                self._scan(lineLabel)
+                self._scanned.add(lineLabel)
+    def __getitem__(self, lineLabel):
+        if lineLabel not in self._groups and lineLabel in self._pending:
+            self._groups[lineLabel] = self._decode(lineLabel)
+            self._pending.remove(lineLabel)
+        return self._groups[lineLabel]
+    def __setitem__(self, lineLabel, group):
+        if lineLabel in self._pending:
+            self._pending.remove(lineLabel)
+        self._groups[lineLabel] = group
+    def __delitem__(self, lineLabel):
+        if lineLabel in self._pending:
+            self._pending.remove(lineLabel)
+        else:
+            del self._groups[lineLabel]
+    def __contains__(self, lineLabel):
+        return lineLabel in self._groups or lineLabel in self._pending
+    def __iter__(self):
+        return iter(list(self._groups.keys()) + self._pending)
+    def __len__(self):
+        return len(self._groups) + len(self._pending)
+
+class CountingChannels(MutableMapping):
+    '''lineLabel -> {dataLabel:Channel} mapping wrapping another one, counting how many channels are looked up through it'''
+    class Group(MutableMapping):
+        def __init__(self, owner, group):
+            self._owner = owner
+            self._group = group
+        def __getitem__(self, dataLabel):
+            channel = self._group[dataLabel]
+            self._owner.accesses += 1
+            return channel
+        def __setitem__(self, dataLabel, channel):
+            self._group[dataLabel] = channel
+        def __delitem__(self, dataLabel):
+            del self._group[dataLabel]
+        def __contains__(self, dataLabel):
+            return dataLabel in self._group
+        def __iter__(self):
+            return iter(self._group)
+        def __len__(self):
+            return len(self._group)
+
+    def __init__(self, channels):
+        self.channels = channels
+        self.accesses = 0
+        self._groups  = {} # id(group) -> Group, so that aliased groups (GPS for GPS2) stay the same object
+    def __getitem__(self, lineLabel):
+        group = self.channels[lineLabel]
+        if id(group) not in self._groups:
+            self._groups[id(group)] = CountingChannels.Group(self, group)
+        return self._groups[id(group)]
+    def __setitem__(self, lineLabel, group):
+        self.channels[lineLabel] = group
+    def __delitem__(self, lineLabel):
+        del self.channels[lineLabel]
+    def __contains__(self, lineLabel):
+        return lineLabel in self.channels
+    def __iter__(self):
+        return iter(self.channels)
+    def __len__(self):
+        return len(self.channels)
+
+
 class LogIterator:
     '''Smart iterator that can move through a log by line number and maintain an index into the nearest values of all data channels'''
     # TODO: LogIterator currently indexes the next available value rather than the nearest value, we should make it configurable between next/nearest
@@ -295,6 +685,7 @@ class LogIterator:
     def __init__(self, logdata, lineNumber=0):
         self.logdata = logdata
         self.currentLine = lineNumber
+        self.iterators = {} # not the class attribute, which would carry over lineLabels from other logs
         for lineLabel in self.logdata.formats:
             if lineLabel in self.logdata.channels:
                 self.iterators[lineLabel] = ()
@@ -327,6 +718,16 @@ class LogIterator:
             self.iterators[lineLabel] = (self.logdata.channels[lineLabel][dataLabel].getIndexOf(lineNumber), lineNumber)
 
 
+class LogMessage(object):
+    '''a single log message rebuilt from channel data, with the NAME, labels and per label attributes of a parsed one'''
+    def __init__(self, name, labels, values):
+        self.NAME = name
+        self.labels = labels
+        self.__dict__.update(zip(labels, values))
+    def __repr__(self):
+        return "<LogMessage %s %s>" % (self.NAME, ", ".join("%s=%r" % (label, getattr(self, label)) for label in self.labels))
+
+
 class DataflashLogHelper:
     '''helper functions for dealing with log data, put here to keep DataflashLog class as a simple parser and data store'''
 
@@ -344,10 +745,10 @@ class DataflashLogHelper:
                 break
         if timeLabel is None:
             raise Exception("Unable to get time label")
-        while lineNumber <= logdata.lineCount:
-            if lineNumber in logdata.channels["GPS"][timeLabel].dictData:
-                return logdata.channels["GPS"][timeLabel].dictData[lineNumber]
-            lineNumber = lineNumber + 1
+        channel = logdata.channels["GPS"][timeLabel]
+        index = channel.lines.searchsorted(lineNumber, 'left')
+        if index < len(channel.lines) and channel.lines[index] <= logdata.lineCount:
+            return channel.values.item(index)
 
         sys.stderr.write("didn't find GPS data for " + str(lineNumber) + " - using maxtime\n")
         return logdata.channels["GPS"][timeLabel].max()
@@ -385,6 +786,50 @@ class DataflashLogHelper:
         chunks.sort(chunkSizeCompare)
         return chunks
 
+    @staticmethod
+    def alignChannels(logdata, fields, start=None, end=None, by='line', method='previous', axis=None):
+        '''resamples several channels onto a common axis so they can be compared sample by sample, returning (axis, [values, ...])
+        as numpy arrays. fields is a list of (lineLabel, dataLabel) pairs. With by='line' the axis is every line number from start
+        to end (default the whole log), as LogIterator steps through them, with by='time' it is the timestamps (in ms) of the first
+        field's samples from start to end; either can be replaced by passing axis. method picks the sample used at each point of
+        the axis: 'previous' (the last one at or before it), 'next' (the first at or after it, as LogIterator does) or 'nearest'
+        (the earlier one on a tie). Points outside a channel's samples get its first or last value'''
+        channels = [logdata.channels[lineLabel][dataLabel] for (lineLabel, dataLabel) in fields]
+        for ((lineLabel, dataLabel), channel) in zip(fields, channels):
+            if not len(channel.lines):
+                raise Exception("No %s.%s log data" % (lineLabel, dataLabel))
+        if by == 'line':
+            positions = [channel.lines for channel in channels]
+        elif by == 'time':
+            positions = [channel.times for channel in channels]
+        else:
+            raise ValueError("Unknown axis for alignChannels: %s" % by)
+
+        if axis is None:
+            if by == 'line':
+                axis = numpy.arange(1 if start is None else start, (logdata.lineCount if end is None else end) + 1)
+            else:
+                axis = positions[0]
+                first = 0 if start is None else axis.searchsorted(start, 'left')
+                last  = len(axis) if end is None else axis.searchsorted(end, 'right')
+                axis = axis[first:last]
+        axis = numpy.asarray(axis)
+
+        values = []
+        for (channel, position) in zip(channels, positions):
+            if method == 'previous':
+                index = position.searchsorted(axis, 'right') - 1
+            elif method == 'next':
+                index = position.searchsorted(axis, 'left')
+            elif method == 'nearest':
+                index = numpy.minimum(position.searchsorted(axis, 'left'), len(position)-1)
+                prev  = numpy.maximum(index-1, 0)
+                index = numpy.where(numpy.abs(position[index]-axis) < numpy.abs(position[prev]-axis), index, prev)
+            else:
+                raise ValueError("Unknown method for alignChannels: %s" % method)
+            values.append(channel.values[numpy.clip(index, 0, len(position)-1)])
+        return (axis, values)
+
     @staticmethod
     def isLogEmpty(logdata):
         '''returns an human readable error string if the log is essentially empty, otherwise returns None'''
@@ -413,7 +858,7 @@ class DataflashLog(object):
     floatTypes = "fcCeEL"
     charTypes  = "nNZ"    
 
-    def __init__(self, logfile=None, format="auto", ignoreBadlines=False):
+    def __init__(self, logfile=None, format="auto", ignoreBadlines=False, lazy=False, jobs=1):
         self.filename = None
 
         self.vehicleType     = None # from VehicleType enumeration; value derived from header
@@ -428,6 +873,10 @@ class DataflashLog(object):
         self.messages    = {} # lineNum -> message
         self.modeChanges = {} # lineNum -> (mode,value)
         self.channels    = {} # lineLabel -> {dataLabel:Channel}
+        self.nonFinite   = {} # lineLabel -> {dataLabel:(count, firstLine, lastLine)} of NaN/Inf values, filled as channels are decoded
+        # seconds spent in each stage of reading the log, and per message type (messages, bytes, seconds decoding) and
+        # per FMT (seconds creating its class), filled in as the log is read
+        self.readProfile = {'stages': {}, 'messageTypes': {}, 'formats': {}}
     
         self.filesizeKB   = 0
         self.durationSecs = 0
@@ -437,7 +886,7 @@ class DataflashLog(object):
         self.frame   = None
 
         if logfile:
-            self.read(logfile, format, ignoreBadlines)
+            self.read(logfile, format, ignoreBadlines, lazy, jobs)
 
     def getCopterType(self):
         '''returns quad/hex/octo/tradheli if this is a copter log'''
@@ -474,9 +923,59 @@ class DataflashLog(object):
         }
         return motor_channels_for_frame[self.frame]
 
-    def read(self, logfile, format="auto", ignoreBadlines=False):
-        '''returns on successful log read (including bad lines if ignoreBadlines==True), will throw an Exception otherwise'''
+    def read(self, logfile, format="auto", ignoreBadlines=False, lazy=False, jobs=1):
+        '''returns on successful log read (including bad lines if ignoreBadlines==True), will throw an Exception otherwise.
+        If lazy==True a binary log file is memory mapped and each channel group is only decoded when first accessed.
+        If jobs > 1 a large binary log is walked by that many processes at once, with the same result'''
         # TODO: dataflash log parsing code is pretty hacky, should re-write more methodically
+        (f, binary) = self._open(logfile, format)
+        startTime = time.time()
+        if binary:
+            numBytes, lineNumber = self.read_binary(f, ignoreBadlines, lazy and f is not sys.stdin, jobs)
+            pass
+        else:
+            numBytes, lineNumber = self.read_text(f, ignoreBadlines)
+        self.readProfile['stages']['read'] = time.time() - startTime
+        if not isinstance(self.channels, LazyChannels):
+            startTime = time.time()
+            self.indexTimes()
+            self.readProfile['stages']['timeIndex'] = time.time() - startTime
+
+        # gather some general stats about the log
+        self._setStats(numBytes, lineNumber, *self._gpsTimes())
+
+    def stream(self, logfile, format="auto", ignoreBadlines=False):
+        '''reads the log in a single pass, yielding (lineNumber, message) for each data message rather than storing it in
+        channels, so memory use doesn't grow with the log. FMT, PARM, MSG and MODE messages are processed as read() does,
+        and the general stats are filled in once the last message has been yielded'''
+        (f, binary) = self._open(logfile, format)
+        if not binary:
+            # text logs are small and old, just read them whole and replay their messages
+            numBytes, lineNumber = self.read_text(f, ignoreBadlines)
+            for message in self.iterMessages():
+                yield message
+            self._setStats(numBytes, lineNumber, *self._gpsTimes())
+            return
+
+        numBytes = 0
+        lineNumber = 0
+        firstTimeGPS = lastTimeGPS = timeLabel = None
+        for e in self._read_binary(f, ignoreBadlines):
+            lineNumber += 1
+            numBytes += e.SIZE
+            if e.NAME in self.headerMessages:
+                self.process(lineNumber, e)
+                continue
+            if e.NAME == "GPS":
+                if timeLabel is None:
+                    timeLabel = self._gpsTimeLabel(e.labels)
+                    firstTimeGPS = getattr(e, timeLabel)
+                lastTimeGPS = getattr(e, timeLabel)
+            yield (lineNumber, e)
+        self._setStats(numBytes, lineNumber, firstTimeGPS, lastTimeGPS, timeLabel)
+
+    def _open(self, logfile, format):
+        '''opens logfile, returning (file, True if it is a binary log)'''
         self.filename = logfile
         if self.filename == '<stdin>':
             f = sys.stdin
@@ -497,26 +996,85 @@ class DataflashLog(object):
                 f.seek(0)
         else:
             raise ValueError("Unknown log format for {}: {}".format(self.filename, format))
+        return (f, head == '\xa3\x95\x80\x80')
 
-        if head == '\xa3\x95\x80\x80':
-            numBytes, lineNumber = self.read_binary(f, ignoreBadlines)
-            pass
-        else:
-            numBytes, lineNumber = self.read_text(f, ignoreBadlines)
+    @staticmethod
+    def _gpsTimeLabel(labels):
+        # the GPS time label changed at some point, need to handle both
+        for i in 'TimeMS','TimeUS','Time':
+            if i in labels:
+                return i
+        return None
 
-        # gather some general stats about the log
+    def indexTimes(self):
+        '''gives every channel the TimeIndex of its message group, see _indexGroupTimes'''
+        if "GPS" in self.channels:
+            self._indexGroupTimes("GPS", self.channels["GPS"])
+        for (groupName, group) in self.channels.items():
+            if groupName != "GPS":
+                self._indexGroupTimes(groupName, group)
+
+    def _indexGroupTimes(self, groupName, group):
+        '''gives each channel of a group the TimeIndex of the group's timestamps, or of the GPS ones if it has none. Returns the group'''
+        timeIndex = TimeIndex.fromGroup(group)
+        if timeIndex is None and groupName != "GPS" and "GPS" in self.channels:
+            timeIndex = self.getTimeIndex("GPS")
+        for channel in group.values():
+            channel.timeIndex = timeIndex
+        return group
+
+    def scanNonFinite(self):
+        '''fills in nonFinite for every channel group, see _scanGroupNonFinite'''
+        self.nonFinite = {}
+        for (groupName, group) in self.channels.items():
+            self._scanGroupNonFinite(groupName, group)
+
+    def scanPendingNonFinite(self):
+        '''completes nonFinite for a lazily read log by decoding each channel group not decoded yet only to scan it,
+        so that memory use stays bounded by the largest group rather than growing to the whole log'''
+        if isinstance(self.channels, LazyChannels):
+            self.channels.scanPending()
+
+    def _scanGroupNonFinite(self, groupName, group):
+        '''records the count, first and last line of the NaN or Inf values in each float channel of a group. Returns the group'''
+        for (label, channel) in group.items():
+            if channel.dtype.kind != 'f':
+                continue
+            bad = numpy.flatnonzero(~numpy.isfinite(channel.values))
+            if len(bad):
+                if groupName not in self.nonFinite:
+                    self.nonFinite[groupName] = {}
+                self.nonFinite[groupName][label] = (len(bad), channel.lines.item(bad[0]), channel.lines.item(bad[-1]))
+        return group
+
+    def _profileMessageType(self, groupName, numMessages, numBytes, seconds):
+        '''adds the decoding of numMessages messages of a type to readProfile'''
+        stats = self.readProfile['messageTypes'].setdefault(groupName, {'messages': 0, 'bytes': 0, 'seconds': 0})
+        stats['messages'] += numMessages
+        stats['bytes']    += numBytes
+        stats['seconds']  += seconds
+        self.readProfile['stages']['decode'] = self.readProfile['stages'].get('decode', 0) + seconds
+
+    def getTimeIndex(self, groupName):
+        '''returns the TimeIndex of a message group, or None if neither it nor GPS has timestamps'''
+        for channel in self.channels[groupName].values():
+            return channel.timeIndex
+        return None
+
+    def _gpsTimes(self):
+        '''returns (firstTime, lastTime, timeLabel) of the GPS channel, or Nones if there is none'''
+        if "GPS" not in self.channels:
+            return (None, None, None)
+        timeLabel = self._gpsTimeLabel(self.channels["GPS"])
+        return (self.channels["GPS"][timeLabel].listData[0][1], self.channels["GPS"][timeLabel].listData[-1][1], timeLabel)
+
+    def _setStats(self, numBytes, lineNumber, firstTimeGPS, lastTimeGPS, timeLabel):
         self.lineCount  = lineNumber
         self.filesizeKB = numBytes / 1024.0
         # TODO: switch duration calculation to use TimeMS values rather than GPS timestemp
-        if "GPS" in self.channels:
-            # the GPS time label changed at some point, need to handle both
-            timeLabel = None
-            for i in 'TimeMS','TimeUS','Time':
-                if i in self.channels["GPS"]:
-                    timeLabel = i
-                    break
-            firstTimeGPS = int(self.channels["GPS"][timeLabel].listData[0][1])
-            lastTimeGPS  = int(self.channels["GPS"][timeLabel].listData[-1][1])
+        if firstTimeGPS is not None:
+            firstTimeGPS = int(firstTimeGPS)
+            lastTimeGPS  = int(lastTimeGPS)
             if timeLabel == 'TimeUS':
                 firstTimeGPS /= 1000
                 lastTimeGPS /= 1000
@@ -525,6 +1083,41 @@ class DataflashLog(object):
         # TODO: calculate logging rate based on timestamps
         # ...
 
+    def iterMessages(self, names=None):
+        '''yields (lineNumber, message) for each message of the given types (default all of them) held in channels, in
+        log order. Each message is a LogMessage with the same NAME, labels and per label attributes as a parsed one'''
+        if names is None:
+            names = self.channels.keys()
+        rows = []
+        for name in names:
+            if name not in self.channels:
+                continue
+            group = self.channels[name]
+            labels = [label for label in (self.formats[name].labels if name in self.formats else []) if label in group]
+            labels += [label for label in group.keys() if label not in labels]
+            if not labels:
+                continue
+            lines = group[labels[0]].lines
+            columns = []
+            for label in labels:
+                channel = group[label]
+                if numpy.array_equal(channel.lines, lines):
+                    columns.append(channel.values.tolist())
+                else:
+                    # only seen when one message name has been given several formats
+                    dictData = channel.dictData
+                    columns.append([dictData.get(lineNumber) for lineNumber in lines.tolist()])
+            rows.append((name, labels, lines, list(zip(*columns))))
+        if not rows:
+            return
+        lines = numpy.concatenate([r[2] for r in rows])
+        groupIndex = numpy.concatenate([numpy.full(len(r[2]), i, dtype=numpy.int32) for (i, r) in enumerate(rows)])
+        rowIndex = numpy.concatenate([numpy.arange(len(r[2]), dtype=numpy.int32) for r in rows])
+        order = numpy.argsort(lines, kind='mergesort')
+        for (lineNumber, i, j) in zip(lines[order].tolist(), groupIndex[order].tolist(), rowIndex[order].tolist()):
+            (name, labels, _, values) = rows[i]
+            yield (lineNumber, LogMessage(name, labels, values[j]))
+
     msg_vehicle_to_vehicle_map = {
         "ArduCopter": VehicleType.Copter,
         "APM:Copter": VehicleType.Copter,
@@ -592,7 +1185,10 @@ class DataflashLog(object):
 
     def process(self, lineNumber, e):
         if e.NAME == 'FMT':
+            startTime = time.time()
             cls = e.to_class()
+            if cls is not None:
+                self.readProfile['formats'][cls.NAME] = self.readProfile['formats'].get(cls.NAME, 0) + time.time() - startTime
             if cls is not None: # FMT messages can be broken ...
                 if hasattr(e, 'type') and e.type not in self._formats: # binary log specific
                     self._formats[e.type] = cls
@@ -628,19 +1224,17 @@ class DataflashLog(object):
             # first time seeing this type of log line, create the channel storage
             if not groupName in self.channels:
                 self.channels[groupName] = {}
-                for label in e.labels:
-                    self.channels[groupName][label] = Channel()
+                for (label, dtype) in zip(e.labels, e.dtypes):
+                    self.channels[groupName][label] = Channel(dtype)
 
             # store each token in its relevant channel
             for label in e.labels:
-                value = getattr(e, label)
-                channel = self.channels[groupName][label]
-                channel.dictData[lineNumber] = value
-                channel.listData.append((lineNumber, value))
+                self.channels[groupName][label].append(lineNumber, getattr(e, label))
 
 
     def read_text(self, f, ignoreBadlines):
         self.formats = {'FMT':Format}
+        rows = collections.OrderedDict() # data line name -> (line numbers, token lists, [bytes])
         lineNumber = 0
         numBytes = 0
         knownHardwareTypes = ["APM", "PX4", "MPNG"]
@@ -684,38 +1278,303 @@ class DataflashLog(object):
                 else:
                     if not tokens[0] in self.formats:
                         raise ValueError("Unknown Format {}".format(tokens[0]))
-                    e = self.formats[tokens[0]](*tokens[1:])
-                    self.process(lineNumber, e)
+                    if tokens[0] in self.headerMessages:
+                        e = self.formats[tokens[0]](*tokens[1:])
+                        self.process(lineNumber, e)
+                    else:
+                        # data lines are gathered per message type and converted a column at a time at the end
+                        if len(tokens)-1 != len(self.formats[tokens[0]].labels):
+                            raise ValueError("Invalid Length")
+                        if tokens[0] not in rows:
+                            rows[tokens[0]] = ([], [], [0])
+                        rows[tokens[0]][0].append(lineNumber)
+                        rows[tokens[0]][1].append(tokens)
+                        rows[tokens[0]][2][0] += len(line) + 1
             except Exception as e:
                 print("BAD LINE: " + line, file=sys.stderr)
                 if not ignoreBadlines:
                     raise Exception("Error parsing line %d of log file %s - %s" % (lineNumber,self.filename,e.args[0]))
+        for (groupName, (lines, tokens, (groupBytes,))) in rows.items():
+            startTime = time.time()
+            self.channels[groupName] = self._scanGroupNonFinite(groupName, self._convert_text(self.formats[groupName], lines, tokens))
+            self._profileMessageType(groupName, len(lines), groupBytes, time.time() - startTime)
         return (numBytes,lineNumber)
 
-    def read_binary(self, f, ignoreBadlines):
-        lineNumber = 0
+    def _convert_text(self, cls, lines, rows):
+        '''converts the token lists of one type of text log line into its {label:Channel} group a column at a time, with the
+        same results as processing each line through cls'''
+        lines = numpy.array(lines, dtype=numpy.int64)
+        group = {}
+        for (i, (label, dtype, convert)) in enumerate(zip(cls.labels, cls.dtypes, cls.converters)):
+            column = [row[i+1] for row in rows]
+            channel = Channel(dtype)
+            try:
+                if dtype is object:
+                    values = numpy.empty(len(column), dtype=object)
+                    values[:] = [convert(value) for value in column]
+                else:
+                    values = numpy.array(column, dtype=dtype)
+                channel.extend(lines, values)
+            except (ValueError, TypeError, OverflowError):
+                # some values don't cast, which process() keeps as strings
+                for (lineNumber, value) in zip(lines.tolist(), column):
+                    channel.append(lineNumber, convert(value))
+            channel.trim()
+            group[label] = channel
+        return group
+
+    # message types which process() handles one at a time, everything else is channel data
+    headerMessages = ['FMT', 'PARM', 'MSG', 'MODE']
+    binaryWindowSize = 1 << 20
+
+    def read_binary(self, f, ignoreBadlines, lazy=False, jobs=1):
+        '''reads a binary log in two passes: the first walks the message headers, processing the header
+        messages in order and indexing where each data message type lives, the second decodes all
+        messages of each data type at once with numpy. If lazy==True the file is memory mapped and the
+        second pass is left until each channel group is first accessed. The first pass is split between jobs
+        processes if jobs > 1'''
+        if lazy:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            data = bytearray(f.read())
+        startTime = time.time()
+        (numBytes, lineNumber, index) = self._index_binary(data, ignoreBadlines, jobs)
+        self.readProfile['stages']['index'] = time.time() - startTime
+
+        # group message types by name, in the order they first appear in the log
+        groups = collections.OrderedDict()
+        for msgid in sorted(index.keys(), key=lambda m: index[m][1][0]):
+            groups.setdefault(self._formats[msgid].NAME, []).append(msgid)
+
+        if lazy:
+            self.channels = LazyChannels(lambda groupName: self._indexGroupTimes(groupName, self._decode_group(groupName, data, index, groups[groupName])), groups.keys(),
+                                         lambda groupName: self._scanGroupNonFinite(groupName, self._decode_binary(data, index, groups[groupName])))
+        else:
+            for (groupName, msgids) in groups.items():
+                self.channels[groupName] = self._decode_group(groupName, data, index, msgids)
+        return (numBytes,lineNumber)
+
+    def _decode_group(self, groupName, data, index, msgids):
+        '''decodes and scans one channel group with _decode_binary and _scanGroupNonFinite, profiling how long it took'''
+        startTime = time.time()
+        numMessages = sum(len(index[msgid][1]) for msgid in msgids)
+        numBytes = sum(len(index[msgid][1]) * self._formats[msgid].SIZE for msgid in msgids)
+        group = self._scanGroupNonFinite(groupName, self._decode_binary(data, index, msgids))
+        for msgid in msgids:
+            del index[msgid] # not needed once the group is decoded
+        self._profileMessageType(groupName, numMessages, numBytes, time.time() - startTime)
+        return group
+
+    def _index_binary(self, data, ignoreBadlines, jobs=1):
+        '''walks the messages exactly as _read_binary does, returning (numBytes, lineCount, index) where
+        index is msgid -> (offsets, lineNumbers) arrays of each data message. If jobs > 1 a large log is
+        split into shards which are walked by a pool of processes, see _index_binary_sharded'''
+        self._formats = {128:BinaryFormat}
+        index = {}
+        header = lambda lineNumber, offset, typ, window, pos: self.process(lineNumber, typ.from_buffer_copy(window, pos))
+        if jobs > 1 and hasattr(os, 'fork') and len(data) > 2 * self.binaryShardSize:
+            (numBytes, lineNumber) = self._index_binary_sharded(data, ignoreBadlines, jobs, index, header)
+        else:
+            (numBytes, lineNumber, offset, atEnd) = self._walk_binary(data, 0, len(data), ignoreBadlines, index, 0, header)
+        for (msgid, (offsets, lines)) in index.items():
+            index[msgid] = (numpy.concatenate([self._asarray(part) for part in offsets]),
+                            numpy.concatenate([self._asarray(part) for part in lines]))
+        return (numBytes, lineNumber, index)
+
+    @staticmethod
+    def _asarray(part):
+        if isinstance(part, array.array):
+            return numpy.frombuffer(part, dtype=part.typecode)
+        return part
+
+    def _walk_binary(self, data, offset, stop, ignoreBadlines, index, lineNumber, header, shard=False):
+        '''walks the messages of data from offset, up to the first one starting at or after stop, adding each data
+        message's offset and line number to index (msgid -> ([offsets arrays], [lineNumbers arrays])) and calling
+        header(lineNumber, offset, typ, window, pos) for each header message. Returns (numBytes, lineNumber, offset, atEnd),
+        atEnd being True if the end of the log was reached. If shard is True bad data raises ShardDesync
+        rather than being handled, so that the shard can be walked again in order'''
         numBytes = 0
-        for e in self._read_binary(f, ignoreBadlines):
+        headerSize = ctypes.sizeof(logheader)
+        parts = {}
+        # data is read through a window so that a memory mapped file is never copied in one go,
+        # a window always holds at least one whole message (at most 255 bytes) unless at EOF
+        window = bytearray()
+        windowStart = offset
+        atEnd = True
+        while len(data) > offset + headerSize:
+            if offset >= stop:
+                atEnd = False
+                break
+            pos = offset - windowStart
+            if pos + 256 > len(window) and windowStart + len(window) < len(data):
+                window = bytearray(data[offset:offset+self.binaryWindowSize])
+                windowStart = offset
+                pos = 0
+            if not (window[pos] == 0xa3 and window[pos+1] == 0x95):
+                if shard:
+                    raise ShardDesync(offset)
+                if ignoreBadlines == False:
+                    raise ValueError(logheader.from_buffer_copy(window, pos))
+                else:
+                    if window[pos] == 0xff and window[pos+1] == 0xff and window[pos+2] == 0xff:
+                        print("Assuming EOF due to dataflash block tail filled with \\xff... (offset={off})".format(off=offset), file=sys.stderr)
+                        break
+                    offset += 1
+                    continue
+
+            typ = self._formats.get(window[pos+2], None)
+            if typ is None:
+                if shard:
+                    raise ShardDesync(offset)
+                raise ValueError(str(logheader.from_buffer_copy(window, pos)) + "unknown type")
+            if len(data) <= offset + typ.SIZE:
+                break
             lineNumber += 1
-            if e is None:
-                continue
-            numBytes += e.SIZE
-#            print(e)
-            self.process(lineNumber, e)
-        return (numBytes,lineNumber)
+            numBytes += typ.SIZE
+            if typ.NAME in self.headerMessages:
+                header(lineNumber, offset, typ, window, pos)
+            else:
+                if typ.MSG not in parts:
+                    parts[typ.MSG] = (array.array('l'), array.array('I'))
+                parts[typ.MSG][0].append(offset)
+                parts[typ.MSG][1].append(lineNumber)
+            offset += typ.SIZE
+        for (msgid, (offsets, lines)) in parts.items():
+            if msgid not in index:
+                index[msgid] = ([], [])
+            index[msgid][0].append(offsets)
+            index[msgid][1].append(lines)
+        return (numBytes, lineNumber, offset, atEnd)
+
+    # binary logs read with jobs > 1 are walked in shards of at least this many bytes
+    binaryShardSize = 1 << 23
+    # consecutive valid message headers needed to resynchronize on a shard's first message
+    binaryResyncMessages = 8
+
+    def _resync_binary(self, data, offset, stop):
+        '''returns the offset of the first message from offset to stop which is followed by binaryResyncMessages
+        messages of known types (or the end of the log), or None if there is none'''
+        buf = bytearray(data[offset:stop + 256 * (self.binaryResyncMessages + 1)])
+        start = 0
+        while offset + start < stop:
+            start = buf.find(b'\xa3\x95', start)
+            if start < 0 or offset + start >= stop:
+                return None
+            candidate = start
+            for i in range(self.binaryResyncMessages):
+                if offset + candidate + ctypes.sizeof(logheader) >= len(data):
+                    return offset + start # the end of the log
+                if not (buf[candidate] == 0xa3 and buf[candidate+1] == 0x95) or buf[candidate+2] not in self._formats:
+                    break
+                candidate += self._formats[buf[candidate+2]].SIZE
+            else:
+                return offset + start
+            start += 1
+        return None
+
+    def _index_binary_sharded(self, data, ignoreBadlines, jobs, index, header):
+        '''walks a binary log with a pool of jobs processes, filling in index as _walk_binary does and returning
+        (numBytes, lineCount). The first shard is walked here, learning the FMTs; each process then resynchronizes
+        on the first message of its shard and walks it. A shard is only used if it starts exactly where the
+        previous one ended and its walk found nothing unexpected (bad data, an unknown or redefined type),
+        otherwise it is walked again here in order, so the result is always that of a single sequential walk'''
+        shardSize = max(self.binaryShardSize, len(data) // (jobs * 4))
+        (numBytes, lineNumber, offset, atEnd) = self._walk_binary(data, 0, shardSize, ignoreBadlines, index, 0, header)
+        if atEnd:
+            return (numBytes, lineNumber)
+
+        global _shardLog, _shardData
+        (_shardLog, _shardData) = (self, data)
+        stops = list(range(2 * shardSize, len(data), shardSize)) + [len(data)]
+        starts = [shardSize] + stops[:-1]
+        pool = multiprocessing.Pool(min(jobs, len(stops)), _initShardWorker)
+        try:
+            shards = pool.imap(_walkShard, list(zip(starts, stops)))
+            for (stop, shard) in zip(stops, shards):
+                if shard is not None:
+                    (start, shardBytes, shardLines, end, shardAtEnd, parts, headers, formats) = shard
+                if (shard is None or start != offset or
+                    any(msgid in self._formats and (self._formats[msgid].SIZE, self._formats[msgid].NAME) != (size, name) for (msgid, size, name) in formats)):
+                    (walkedBytes, lineNumber, offset, atEnd) = self._walk_binary(data, offset, stop, ignoreBadlines, index, lineNumber, header)
+                    numBytes += walkedBytes
+                else:
+                    for (headerLine, headerOffset) in headers:
+                        typ = self._formats[bytearray(data[headerOffset+2:headerOffset+3])[0]]
+                        header(lineNumber + headerLine, headerOffset, typ, bytearray(data[headerOffset:headerOffset+typ.SIZE]), 0)
+                    for (msgid, (offsets, lines)) in parts.items():
+                        if msgid not in index:
+                            index[msgid] = ([], [])
+                        index[msgid][0].append(offsets)
+                        index[msgid][1].append((lines + lineNumber).astype(numpy.uint32))
+                    (numBytes, lineNumber, offset, atEnd) = (numBytes + shardBytes, lineNumber + shardLines, end, shardAtEnd)
+                if atEnd:
+                    break
+        finally:
+            pool.terminate()
+            pool.join()
+            (_shardLog, _shardData) = (None, None)
+        return (numBytes, lineNumber)
+
+    def _decode_binary(self, data, index, msgids):
+        '''decodes all messages of the given types found by _index_binary, returning them as a channel group'''
+        buf = numpy.frombuffer(data, dtype=numpy.uint8)
+        group = {}
+        columns = collections.OrderedDict() # label -> [(lines, values)]
+        for msgid in msgids:
+            typ = self._formats[msgid]
+            (offsets, lines) = index[msgid]
+            records = buf[offsets[:,numpy.newaxis] + numpy.arange(typ.SIZE)].view(typ.DTYPE)[:,0]
+            if not group:
+                for (label, dtype) in zip(typ.labels, typ.dtypes):
+                    group[label] = Channel(dtype)
+            for (i, label) in enumerate(typ.labels):
+                values = records['f%d' % i]
+                scale = BinaryFormat.FIELD_SCALE.get(typ.types[i], None)
+                if values.dtype.kind == 'S':
+                    # ctypes char arrays stop at the first NUL, numpy only strips trailing ones
+                    values = numpy.array([v.split(b'\0', 1)[0] for v in values.tolist()], dtype=object)
+                elif scale is not None:
+                    values = values / scale
+                columns.setdefault(label, []).append((lines, values))
+
+        for (label, parts) in columns.items():
+            if len(parts) == 1:
+                group[label].extend(*parts[0])
+            else:
+                # several FMTs share this name, interleave their messages back into log order
+                lines  = numpy.concatenate([part[0] for part in parts])
+                values = numpy.concatenate([part[1] for part in parts])
+                order  = lines.argsort(kind='mergesort')
+                group[label].extend(lines[order], values[order])
+            group[label].trim()
+        return group
 
     def _read_binary(self, f, ignoreBadlines):
+        '''yields each message of a binary log in turn, reading it binaryWindowSize bytes at a time so that memory use
+        stays constant, and so it can also read from a pipe'''
         self._formats = {128:BinaryFormat}
-        data = bytearray(f.read())
+        data = bytearray()
+        base = 0 # file offset of data[0]
         offset = 0
-        while len(data) > offset + ctypes.sizeof(logheader):
+        eof = False
+        while True:
+            # keep at least one whole message (they are under 256 bytes) buffered until the end of the file
+            if not eof and len(data) - offset < 256:
+                chunk = f.read(self.binaryWindowSize)
+                eof = not chunk
+                base += offset
+                data = data[offset:] + bytearray(chunk)
+                offset = 0
+                continue
+            if not len(data) > offset + ctypes.sizeof(logheader):
+                break
             h = logheader.from_buffer(data, offset)
             if not (h.head1 == 0xa3 and h.head2 == 0x95):
                 if ignoreBadlines == False:
                     raise ValueError(h)
                 else:
                     if h.head1 == 0xff and h.head2 == 0xff and h.msgid == 0xff:
-                        print("Assuming EOF due to dataflash block tail filled with \\xff... (offset={off})".format(off=offset), file=sys.stderr)
+                        print("Assuming EOF due to dataflash block tail filled with \\xff... (offset={off})".format(off=base+offset), file=sys.stderr)
                         break
                     offset += 1
                     continue
@@ -725,7 +1584,7 @@ class DataflashLog(object):
                 if len(data) <= offset + typ.SIZE:
                     break
                 try:
-                    e = typ.from_buffer(data, offset)
+                    e = typ.from_buffer_copy(data, offset)
                 except:
                     print("data:{} offset:{} size:{} sizeof:{} sum:{}".format(len(data),offset,typ.SIZE,ctypes.sizeof(typ),offset+typ.SIZE))
                     raise
@@ -0,0 +1,239 @@
+#
+# Persistent on-disk cache of decoded Dataflash logs, so re-analyzing a log doesn't pay for parsing it again
+#
+
+from __future__ import print_function
+
+import ctypes
+import glob
+import hashlib
+import json
+import os
+import sys
+import tempfile
+
+import numpy
+
+import DataflashLog
+
+
+class InsertionOrderDict(dict):
+    '''plain dict which also remembers the order keys were first set in, so a cached copy can be rebuilt by replaying the
+    same insertions and so iterate in exactly the same order as the original (python 2 dict order depends on insertion history)'''
+    def __init__(self):
+        dict.__init__(self)
+        self.insertionOrder = []
+    def __setitem__(self, key, value):
+        if key not in self:
+            self.insertionOrder.append(key)
+        dict.__setitem__(self, key, value)
+
+
+class DataflashLogCache(object):
+    '''stores what DataflashLog.read produces (channels, formats, parameters, messages, mode changes and header info) as a
+    columnar .npz file, keyed on the log's size, mtime and content, and the options it was read with. Everything but the
+    channel data is stored as JSON, so that loading a cache file written by someone else can't run code'''
+
+    VERSION    = 3        # bump whenever the layout of the cache files or of DataflashLog changes
+    HASH_BLOCK = 1 << 20  # bytes hashed from each end of the log
+
+    # DataflashLog attributes stored alongside the channel data
+    attributes = ['vehicleType', 'vehicleTypeString', 'firmwareVersion', 'firmwareHash', 'freeRAM', 'hardwareType',
+                  'filesizeKB', 'durationSecs', 'lineCount', 'skippedLines', 'frame']
+    dictAttributes = ['parameters', 'messages', 'modeChanges']
+
+    def __init__(self, cacheDir=None, maxSizeMB=1024):
+        '''if cacheDir is None each log is cached next to itself as <logfile>.npz, otherwise logs are cached in cacheDir
+        and the least recently used entries are removed once they total more than maxSizeMB'''
+        self.cacheDir  = cacheDir
+        self.maxSizeMB = maxSizeMB
+        if self.cacheDir and not os.path.isdir(self.cacheDir):
+            os.makedirs(self.cacheDir)
+
+    def key(self, logfile, format, ignoreBadlines):
+        '''returns the cache key of a log file, hashing its size, mtime, first and last HASH_BLOCK bytes and read options'''
+        st = os.stat(logfile)
+        h = hashlib.sha1()
+        h.update(repr((self.VERSION, st.st_size, st.st_mtime, format, bool(ignoreBadlines))).encode('ascii'))
+        with open(logfile, 'rb') as f:
+            h.update(f.read(self.HASH_BLOCK))
+            if st.st_size > self.HASH_BLOCK:
+                f.seek(max(self.HASH_BLOCK, st.st_size - self.HASH_BLOCK))
+                h.update(f.read())
+        return h.hexdigest()
+
+    def path(self, logfile, key):
+        if self.cacheDir:
+            return os.path.join(self.cacheDir, key + '.npz')
+        return logfile + '.npz'
+
+    def read(self, logfile, format="auto", ignoreBadlines=False, lazy=False, jobs=1):
+        '''returns the DataflashLog for logfile, from the cache if possible, otherwise reading it and caching the result'''
+        if logfile == '<stdin>':
+            return DataflashLog.DataflashLog(logfile, format=format, ignoreBadlines=ignoreBadlines, lazy=lazy, jobs=jobs)
+        key = self.key(logfile, format, ignoreBadlines)
+        path = self.path(logfile, key)
+        logdata = self.load(path, key)
+        if logdata is None:
+            logdata = DataflashLog.DataflashLog()
+            for name in self.dictAttributes:
+                setattr(logdata, name, InsertionOrderDict())
+            logdata.read(logfile, format=format, ignoreBadlines=ignoreBadlines, lazy=lazy, jobs=jobs)
+            self.save(path, key, logdata)
+        logdata.filename = logfile
+        return logdata
+
+    def load(self, path, key):
+        '''returns the DataflashLog stored in path, or None if there is no valid entry for key'''
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'rb') as f:
+                npz = numpy.load(f, allow_pickle=False)
+                meta = self.loadMeta(npz['meta'].tobytes())
+                if meta['key'] != key:
+                    return None
+                logdata = DataflashLog.DataflashLog()
+                for name in self.attributes:
+                    setattr(logdata, name, meta[name])
+                for name in self.dictAttributes:
+                    for (k, v) in meta[name]:
+                        getattr(logdata, name)[k] = tuple(v) if isinstance(v, list) else v # JSON has no tuples
+                for record in meta['formats']:
+                    (name, cls) = self.fromFormatRecord(record)
+                    logdata.formats[name] = cls
+                for (groupName, labels) in meta['groups']:
+                    logdata.channels[groupName] = {}
+                    for (label, i, j) in labels:
+                        if 'values%d' % i in meta['objectValues']:
+                            objects = meta['objectValues']['values%d' % i]
+                            values = numpy.empty(len(objects), dtype=object)
+                            values[:] = objects
+                        else:
+                            values = npz['values%d' % i]
+                        channel = DataflashLog.Channel(values.dtype)
+                        channel.extend(npz['lines%d' % j], values)
+                        channel.trim()
+                        logdata.channels[groupName][label] = channel
+                logdata.indexTimes()
+                logdata.scanNonFinite()
+        except Exception as e:
+            print("Ignoring unreadable log cache %s: %s" % (path, e), file=sys.stderr)
+            return None
+        if self.cacheDir:
+            os.utime(path, None) # mark as recently used
+        return logdata
+
+    def save(self, path, key, logdata):
+        '''stores logdata in path, then evicts old entries if over the size limit'''
+        # object arrays (strings, or text log columns mixing strings and numbers) would be pickled by savez, so go in meta
+        meta = dict(key=key, groups=[], formats=[], objectValues={})
+        for name in self.attributes:
+            meta[name] = getattr(logdata, name)
+        for name in self.dictAttributes:
+            d = getattr(logdata, name)
+            meta[name] = [(k, d[k]) for k in getattr(d, 'insertionOrder', d.keys())]
+        for (name, cls) in logdata.formats.items():
+            meta['formats'].append(self.toFormatRecord(name, cls))
+        arrays = {}
+        nValues = 0
+        nLines = 0
+        for (groupName, group) in logdata.channels.items():
+            labels = []
+            # channels of a group nearly always share their line numbers, so only store them once
+            groupLines = None
+            for (label, channel) in group.items():
+                if groupLines is None or not numpy.array_equal(channel.lines, groupLines):
+                    groupLines = channel.lines
+                    arrays['lines%d' % nLines] = groupLines.astype(numpy.uint32) if logdata.lineCount < 2**32 else groupLines
+                    nLines += 1
+                if channel.values.dtype == object:
+                    meta['objectValues']['values%d' % nValues] = channel.values.tolist()
+                else:
+                    arrays['values%d' % nValues] = channel.values
+                labels.append((label, nValues, nLines - 1))
+                nValues += 1
+            meta['groups'].append((groupName, labels))
+        arrays['meta'] = numpy.frombuffer(self.dumpMeta(meta), dtype=numpy.uint8)
+
+        # write to a temporary file first so other processes never see a partial entry
+        (fd, tmpPath) = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                numpy.savez(f, **arrays)
+            os.rename(tmpPath, path)
+        except (IOError, OSError) as e:
+            print("Unable to write log cache %s: %s" % (path, e), file=sys.stderr)
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+            return
+        if self.cacheDir:
+            self.evict()
+
+    def evict(self):
+        '''removes the least recently used cache entries until the cache is within maxSizeMB'''
+        entries = []
+        for path in glob.glob(os.path.join(self.cacheDir, '*.npz')):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue # removed by another process
+            entries.append((st.st_mtime, st.st_size, path))
+        entries.sort()
+        total = sum(size for (mtime, size, path) in entries)
+        for (mtime, size, path) in entries[:-1]: # never remove the newest entry
+            if total <= self.maxSizeMB * 1024 * 1024:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    @staticmethod
+    def dumpMeta(meta):
+        '''returns meta as JSON bytes. Python 2 strings are bytes, not always UTF-8, so are stored as latin-1 which keeps every byte'''
+        if sys.version_info[0] < 3:
+            return json.dumps(meta, encoding='latin-1', default=lambda o: o.item())
+        return json.dumps(meta, default=lambda o: o.item()).encode('utf-8')
+
+    @staticmethod
+    def loadMeta(data):
+        '''returns the meta stored by dumpMeta'''
+        if sys.version_info[0] < 3:
+            return DataflashLogCache.latin1Bytes(json.loads(data))
+        return json.loads(data.decode('utf-8'))
+
+    @staticmethod
+    def latin1Bytes(obj):
+        '''returns obj with the unicode strings python 2 json gives back encoded as the latin-1 bytes they were'''
+        if isinstance(obj, type(u'')):
+            return obj.encode('latin-1')
+        if isinstance(obj, list):
+            return [DataflashLogCache.latin1Bytes(x) for x in obj]
+        if isinstance(obj, dict):
+            return dict((DataflashLogCache.latin1Bytes(k), DataflashLogCache.latin1Bytes(v)) for (k, v) in obj.items())
+        return obj
+
+    @staticmethod
+    def toFormatRecord(name, cls):
+        '''returns a JSON serializable description of a format class, from which fromFormatRecord can rebuild it'''
+        if cls is DataflashLog.Format:
+            return (name, 'text', None)
+        if issubclass(cls, ctypes.Structure):
+            return (name, 'binary', (cls.MSG, cls.SIZE, ''.join(cls.types), cls.labels))
+        return (name, 'text', (''.join(cls.types), cls.labels))
+
+    @staticmethod
+    def fromFormatRecord(record):
+        (name, kind, fields) = record
+        if fields is None:
+            return (name, DataflashLog.Format)
+        if kind == 'binary':
+            (msgType, length, types, labels) = fields
+            fmt = DataflashLog.BinaryFormat(type=msgType, length=length, name=name, types=types, labels=','.join(labels))
+            return (name, fmt.to_class())
+        (types, labels) = fields
+        fmt = DataflashLog.Format(None, None, name, types, '')
+        fmt.labels = labels[:]
+        return (name, fmt.to_class())
@@ -20,19 +20,41 @@
 from __future__ import print_function
 
 import DataflashLog
+import DataflashLogCache
 
 import pprint  # temp
 import imp
 import glob
 import inspect
+import json
 import os, sys
 import argparse
 import datetime
+import multiprocessing
+import select
 import time
+import traceback
 from xml.sax.saxutils import escape
 
 from VehicleType import VehicleType
 
+try:
+    import resource
+except ImportError:
+    resource = None # not available on Windows
+
+# CPU time of this process in seconds
+processTime = time.process_time if hasattr(time, 'process_time') else time.clock
+
+def peakRSSKB():
+    '''returns the peak resident set size of this process in KB, or None if it isn't available'''
+    if resource is None:
+        return None
+    maxRSS = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return maxRSS / 1024 # in bytes on OS X
+    return maxRSS
+
 class TestResult(object):
     '''all tests return a standardized result type'''
     class StatusType:
@@ -48,9 +70,32 @@ class Test(object):
         self.name     = ""
         self.result   = None   # will be an instance of TestResult after being run
         self.execTime = None
+        self.cpuTime  = None   # ms of CPU time used by run(), as execTime is wall time
+        self.channelAccesses = None # channels looked up by run(), only counted when profiling
         self.enable   = True
+        # streaming tests list the message types they need here (or '*' for all of them) and implement start(),
+        # on_message() and finish() instead of run(), so they can also be fed messages as the log is read
+        self.messageTypes = None
 
     def run(self, logdata, verbose=False):
+        if self.messageTypes is None:
+            return
+        # a streaming test run against an already loaded log, replay the messages it needs
+        self.start(logdata)
+        for (lineNumber, m) in logdata.iterMessages(None if '*' in self.messageTypes else self.messageTypes):
+            self.on_message(lineNumber, m)
+        self.finish(logdata, verbose)
+
+    def start(self, logdata):
+        '''called before the first message, only the log's header info is available'''
+        pass
+
+    def on_message(self, lineNumber, m):
+        '''called for each message of the types in messageTypes, in log order'''
+        pass
+
+    def finish(self, logdata, verbose):
+        '''called after the last message, sets self.result'''
         pass
 
 
@@ -76,21 +121,130 @@ class TestSuite(object):
         # m = imp.load_source("m", dirName + '/tests/TestBadParams.py')
         # self.tests.append(m.TestBadParams())
 
-    def run(self, logdata, verbose):
-        '''run all registered tests in a single call, gathering execution timing info'''
+    def run(self, logdata, verbose, jobs=1, timeout=None, countAccesses=False):
+        '''run all registered tests in a single call, gathering execution timing info. If jobs > 1 or a per-test timeout
+        (in seconds) is given the tests are run in forked child processes instead, which share the loaded log data.
+        If countAccesses each test also records how many channels it looked up'''
         self.logdata = logdata
         if 'GPS' not in self.logdata.channels and 'GPS2' in self.logdata.channels:
             # *cough*
             self.logdata.channels['GPS'] = self.logdata.channels['GPS2']
 
         self.logfile = logdata.filename
+        if jobs > 1 or timeout:
+            self.runInProcesses([test for test in self.tests if test.enable], verbose, jobs, timeout, countAccesses)
+            return
         for test in self.tests:
             # run each test in turn, gathering timing info
             if test.enable:
+                self.runTest(test, verbose, countAccesses)
+
+    def runTest(self, test, verbose, countAccesses=False):
+        '''run a single test, setting its execTime and cpuTime, and channelAccesses if countAccesses'''
+        channels = self.logdata.channels
+        if countAccesses:
+            self.logdata.channels = DataflashLog.CountingChannels(channels)
+        startTime = time.time()
+        startCPU = processTime()
+        try:
+            test.run(self.logdata, verbose)  # RUN THE TEST
+        finally:
+            test.execTime = 1000 * (time.time()-startTime)
+            test.cpuTime = 1000 * (processTime()-startCPU)
+            if countAccesses:
+                test.channelAccesses = self.logdata.channels.accesses
+                self.logdata.channels = channels
+
+    def runStreaming(self, logdata, logfile, verbose, format="auto", ignoreBadlines=False):
+        '''run the streaming tests in a single pass over logfile as logdata reads it, without keeping its data messages
+        in memory, so it also works on huge logs or one still being downloaded. The other tests need the whole log
+        loaded and are marked UNKNOWN'''
+        self.logdata = logdata
+        self.logfile = logfile
+        tests = [test for test in self.tests if test.enable and test.messageTypes is not None]
+        for test in tests:
+            test.execTime = 0
+            test.start(logdata)
+        dispatch = {} # message name -> tests wanting it
+        for (lineNumber, m) in logdata.stream(logfile, format, ignoreBadlines):
+            if m.NAME not in dispatch:
+                dispatch[m.NAME] = [test for test in tests if m.NAME in test.messageTypes or '*' in test.messageTypes]
+            for test in dispatch[m.NAME]:
                 startTime = time.time()
-                test.run(self.logdata, verbose)  # RUN THE TEST
-                endTime = time.time()
-                test.execTime = 1000 * (endTime-startTime)
+                test.on_message(lineNumber, m)
+                test.execTime += 1000 * (time.time()-startTime)
+        for test in tests:
+            startTime = time.time()
+            test.finish(logdata, verbose)
+            test.execTime += 1000 * (time.time()-startTime)
+
+        for test in self.tests:
+            if test.enable and test.messageTypes is None:
+                test.result = TestResult()
+                test.result.status = TestResult.StatusType.UNKNOWN
+                test.result.statusMessage = "Test needs the whole log, not run in streaming mode"
+                test.execTime = 0
+
+    def runInProcesses(self, tests, verbose, jobs, timeout, countAccesses=False):
+        '''run tests with up to jobs of them at once, each in a child process forked after the log was loaded so the log
+        data is shared rather than copied. A test still running after timeout seconds is killed and its result set to UNKNOWN'''
+        pending = list(tests)
+        running = {} # connection -> (test, process, startTime)
+        try:
+            while pending or running:
+                while pending and len(running) < max(jobs, 1):
+                    test = pending.pop(0)
+                    (parentConn, childConn) = multiprocessing.Pipe(False)
+                    process = multiprocessing.Process(target=self.runTestInProcess, args=(test, verbose, childConn, countAccesses))
+                    process.start()
+                    childConn.close()
+                    running[parentConn] = (test, process, time.time())
+
+                (ready, _, _) = select.select(list(running.keys()), [], [], 0.05)
+                for conn in ready:
+                    (test, process, startTime) = running.pop(conn)
+                    try:
+                        (status, statusMessage, execTime, cpuTime, channelAccesses, error) = conn.recv()
+                    except EOFError:
+                        (status, statusMessage, execTime, cpuTime, channelAccesses, error) = (TestResult.StatusType.UNKNOWN, "Test process exited unexpectedly", 1000 * (time.time()-startTime), None, None, None)
+                    conn.close()
+                    process.join()
+                    if error:
+                        raise Exception("Error running test %s:\n%s" % (test.name, error))
+                    test.result = TestResult()
+                    test.result.status = status
+                    test.result.statusMessage = statusMessage
+                    test.execTime = execTime
+                    test.cpuTime = cpuTime
+                    test.channelAccesses = channelAccesses
+
+                if timeout:
+                    for (conn, (test, process, startTime)) in list(running.items()):
+                        if time.time() - startTime > timeout:
+                            process.terminate()
+                            process.join()
+                            conn.close()
+                            del running[conn]
+                            test.result = TestResult()
+                            test.result.status = TestResult.StatusType.UNKNOWN
+                            test.result.statusMessage = "Test timed out after %g seconds" % timeout
+                            test.execTime = 1000 * (time.time()-startTime)
+        finally:
+            # an error in one test leaves the others running
+            for (conn, (test, process, startTime)) in running.items():
+                process.terminate()
+            for (conn, (test, process, startTime)) in running.items():
+                process.join()
+                conn.close()
+
+    def runTestInProcess(self, test, verbose, conn, countAccesses=False):
+        '''child process side of runInProcesses, sends (status, statusMessage, execTime, cpuTime, channelAccesses, error) back down conn'''
+        try:
+            self.runTest(test, verbose, countAccesses)
+            conn.send((test.result.status, test.result.statusMessage, test.execTime, test.cpuTime, test.channelAccesses, None))
+        except Exception:
+            conn.send((None, None, None, None, None, traceback.format_exc()))
+        conn.close()
 
     def outputPlainText(self, outputStats):
         '''output test results in plain text'''
@@ -137,6 +291,47 @@ class TestSuite(object):
         print('The Log Analyzer is currently BETA code.\nFor any support or feedback on the log analyzer please email Andrew Chapman (amchapman@gmail.com)')
         print('\n')
 
+    def outputProfileJSON(self, jsonFile, stages):
+        '''output profiling data to a JSON file: the given {stage: seconds} of the whole run, how long each stage of
+        reading the log and each message type and FMT took, peak memory use, and each test's wall and CPU time and
+        channel lookups'''
+        readProfile = self.logdata.readProfile
+        profile = {
+            'logfile':    self.logfile,
+            'sizeBytes':  int(self.logdata.filesizeKB * 1024),
+            'lineCount':  self.logdata.lineCount,
+            'stages':     dict(stages, **readProfile['stages']),
+            'peakRSSKB':  peakRSSKB(),
+            'formats':    readProfile['formats'],
+            'messageTypes': {},
+            'tests':      {},
+        }
+        for (name, stats) in readProfile['messageTypes'].items():
+            stats = dict(stats)
+            if stats['seconds'] > 0:
+                stats['messagesPerSec'] = stats['messages'] / stats['seconds']
+                stats['bytesPerSec']    = stats['bytes'] / stats['seconds']
+            profile['messageTypes'][name] = stats
+        if stages.get('read'):
+            profile['bytesPerSec']    = profile['sizeBytes'] / stages['read']
+            profile['messagesPerSec'] = self.logdata.lineCount / stages['read']
+        for test in self.tests:
+            if test.enable:
+                profile['tests'][test.name] = {'wallMs': test.execTime, 'cpuMs': test.cpuTime, 'channelAccesses': test.channelAccesses}
+
+        try:
+            if jsonFile == '-':
+                f = sys.stdout
+            else:
+                f = open(jsonFile, 'w')
+        except:
+            sys.stderr.write("Error opening output profile file: %s" % jsonFile)
+            sys.exit(1)
+        json.dump(profile, f, sort_keys=True, indent=2)
+        f.write("\n")
+        if f is not sys.stdout:
+            f.close()
+
     def outputXML(self, xmlFile):
         '''output test results to an XML file'''
 
@@ -219,17 +414,41 @@ def main():
     parser.add_argument('logfile', type=argparse.FileType('r'), help='path to Dataflash log file (or - for stdin)')
     parser.add_argument('-f', '--format',  metavar='', type=str, action='store', choices=['bin','log','auto'], default='auto', help='log file format: \'bin\',\'log\' or \'auto\'')
     parser.add_argument('-q', '--quiet',  metavar='', action='store_const', const=True, help='quiet mode, do not print results')
-    parser.add_argument('-p', '--profile', metavar='', action='store_const', const=True, help='output performance profiling data')
+    parser.add_argument('-p', '--profile', metavar='', action='store_const', const=True, help='output performance profiling data, and write it as JSON next to the XML file')
+    parser.add_argument('--profile_json', type=str, metavar='JSON file', default=None, help='write performance profiling data to specified JSON file (or - for stdout)')
     parser.add_argument('-s', '--skip_bad', metavar='', action='store_const', const=True, help='skip over corrupt dataflash lines')
     parser.add_argument('-e', '--empty',  metavar='', action='store_const', const=True, help='run an initial check for an empty log')
+    parser.add_argument('-l', '--lazy',  metavar='', action='store_const', const=True, help='memory map binary logs and only decode data as tests use it')
+    parser.add_argument('-c', '--cache', type=str, metavar='cache dir', nargs='?', const='', default=None, help='cache the decoded log, next to the log file or in the specified directory')
+    parser.add_argument('--cache_size', type=int, metavar='MB', default=1024, help='maximum size of the cache directory in MB')
     parser.add_argument('-x', '--xml', type=str, metavar='XML file', nargs='?', const='', default='', help='write output to specified XML file (or - for stdout)')
     parser.add_argument('-v', '--verbose', metavar='', action='store_const', const=True, help='verbose output')
+    parser.add_argument('-j', '--jobs', type=int, metavar='N', default=1, help='run up to N tests at once in separate processes')
+    parser.add_argument('--read_jobs', type=int, metavar='N', default=1, help='split reading a large binary log between N processes')
+    parser.add_argument('-t', '--timeout', type=float, metavar='seconds', default=None, help='mark any test taking longer than this as UNKNOWN')
+    parser.add_argument('--stream', action='store_const', const=True, help='run only the streaming tests, in a single pass as the log is read')
     args = parser.parse_args()
 
+    if args.stream:
+        # read and test the log in one pass
+        testSuite = TestSuite()
+        startTime = time.time()
+        testSuite.runStreaming(DataflashLog.DataflashLog(), args.logfile.name, args.verbose, format=args.format, ignoreBadlines=args.skip_bad)
+        endTime = time.time()
+        if args.profile:
+            print("Streaming read and test time: %.2f seconds" % (endTime-startTime))
+        output(testSuite, args, {'stream': endTime-startTime})
+        return
+
     # load the log
     startTime = time.time()
-    logdata = DataflashLog.DataflashLog(args.logfile.name, format=args.format, ignoreBadlines=args.skip_bad) # read log
+    if args.cache is not None:
+        cache = DataflashLogCache.DataflashLogCache(args.cache or None, args.cache_size)
+        logdata = cache.read(args.logfile.name, format=args.format, ignoreBadlines=args.skip_bad, lazy=args.lazy, jobs=args.read_jobs) # read log
+    else:
+        logdata = DataflashLog.DataflashLog(args.logfile.name, format=args.format, ignoreBadlines=args.skip_bad, lazy=args.lazy, jobs=args.read_jobs) # read log
     endTime = time.time()
+    stages = {'read': endTime-startTime}
     if args.profile:
         print("Log file read time: %.2f seconds" % (endTime-startTime))
 
@@ -243,18 +462,30 @@ def main():
     #run the tests, and gather timings
     testSuite = TestSuite()
     startTime = time.time()
-    testSuite.run(logdata, args.verbose)  # run tests
+    testSuite.run(logdata, args.verbose, jobs=args.jobs, timeout=args.timeout, countAccesses=bool(args.profile or args.profile_json))  # run tests
     endTime = time.time()
+    stages['tests'] = endTime-startTime
     if args.profile:
         print("Test suite run time: %.2f seconds" % (endTime-startTime))
 
-    # deal with output
+    output(testSuite, args, stages)
+
+
+def output(testSuite, args, stages):
+    '''deal with output'''
     if not args.quiet:
         testSuite.outputPlainText(args.profile)
     if args.xml:
         testSuite.outputXML(args.xml)
         if not args.quiet:
             print("XML output written to file: %s\n" % args.xml)
+    profileFile = args.profile_json
+    if profileFile is None and args.profile and args.xml and args.xml != '-':
+        profileFile = os.path.splitext(args.xml)[0] + '.profile.json'
+    if profileFile:
+        testSuite.outputProfileJSON(profileFile, stages)
+        if not args.quiet and profileFile != '-':
+            print("Profile written to file: %s\n" % profileFile)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+#
+# Batch mode for the LogAnalyzer, analyzing a whole directory (or glob) of Dataflash logs, each in its own process
+# forked after the tests were loaded once, so that a log which hangs or crashes its process only loses that log
+#
+# Writes one JSON result record per log as each finishes, followed by a summary of FAIL/WARN counts per test
+#
+
+from __future__ import print_function
+
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import select
+import sys
+import time
+import traceback
+
+import DataflashLog
+import DataflashLogCache
+from LogAnalyzer import TestSuite, TestResult
+
+statusNames = {
+    TestResult.StatusType.GOOD:    "GOOD",
+    TestResult.StatusType.FAIL:    "FAIL",
+    TestResult.StatusType.WARN:    "WARN",
+    TestResult.StatusType.UNKNOWN: "UNKNOWN",
+    TestResult.StatusType.NA:      "NA",
+}
+
+logExtensions = ['.bin', '.log']
+
+# state shared by every log's process, set up once by initWorker
+testSuite = None
+options   = None
+
+
+def findLogs(paths):
+    '''returns the sorted list of log files in the given directories (searched recursively), glob patterns or files'''
+    logs = []
+    for path in paths:
+        if os.path.isdir(path):
+            for (dirpath, dirnames, filenames) in os.walk(path):
+                for filename in filenames:
+                    if os.path.splitext(filename)[1].lower() in logExtensions:
+                        logs.append(os.path.join(dirpath, filename))
+        else:
+            logs.extend(glob.glob(path))
+    return sorted(set(logs))
+
+
+def initWorker(args):
+    '''load the tests once, before any log's process is forked'''
+    global testSuite, options
+    testSuite = TestSuite()
+    options = args
+
+
+def analyzeLog(logfile):
+    '''reads and tests a single log, returning its result record. Any error is recorded rather than raised so that one
+    bad log can't abort the batch'''
+    record = dict(logfile=logfile)
+    try:
+        startTime = time.time()
+        if options.cache is not None:
+            cache = DataflashLogCache.DataflashLogCache(options.cache or None, options.cache_size)
+            logdata = cache.read(logfile, format=options.format, ignoreBadlines=options.skip_bad, lazy=options.lazy)
+        else:
+            logdata = DataflashLog.DataflashLog(logfile, format=options.format, ignoreBadlines=options.skip_bad, lazy=options.lazy)
+        record['readTime'] = time.time() - startTime
+
+        startTime = time.time()
+        testSuite.run(logdata, False)
+        record['testTime'] = time.time() - startTime
+
+        record['vehicleType']     = logdata.vehicleTypeString
+        record['firmwareVersion'] = logdata.firmwareVersion
+        record['firmwareHash']    = logdata.firmwareHash
+        record['durationSecs']    = logdata.durationSecs
+        record['lineCount']       = logdata.lineCount
+        record['skippedLines']    = logdata.skippedLines
+        record['results'] = []
+        for test in testSuite.tests:
+            if not test.enable:
+                continue
+            record['results'].append(dict(
+                name=test.name,
+                status=statusNames.get(test.result.status, "UNKNOWN"),
+                message=test.result.statusMessage,
+                execTime=test.execTime,
+                cpuTime=test.cpuTime))
+        record['status'] = "OK"
+    except Exception as e:
+        record['status'] = "ERROR"
+        record['error'] = "%s: %s" % (e.__class__.__name__, e)
+        record['traceback'] = traceback.format_exc()
+    return record
+
+
+def errorRecord(logfile, error):
+    '''returns the result record of a log which couldn't be analyzed'''
+    return dict(logfile=logfile, status="ERROR", error=error)
+
+
+def analyzeInProcess(logfile, conn):
+    '''child process side of analyzeInProcesses, sends the log's result record back down conn'''
+    conn.send(analyzeLog(logfile))
+    conn.close()
+
+
+def analyzeInProcesses(logs, args):
+    '''yields the result record of each log, analyzing up to args.jobs of them at once, each in a child process forked
+    after the tests were loaded here so they are shared rather than loaded again. A log not analyzed within args.timeout
+    seconds, because it hung or its process died (e.g. to the OOM killer), is recorded as an ERROR and only its process
+    killed, so that the other logs carry on'''
+    initWorker(args)
+    pending = list(logs)
+    running = {} # connection -> (logfile, process, startTime)
+    try:
+        while pending or running:
+            while pending and len(running) < args.jobs:
+                logfile = pending.pop(0)
+                (parentConn, childConn) = multiprocessing.Pipe(False)
+                process = multiprocessing.Process(target=analyzeInProcess, args=(logfile, childConn))
+                process.start()
+                childConn.close()
+                running[parentConn] = (logfile, process, time.time())
+
+            (ready, _, _) = select.select(list(running.keys()), [], [], 0.05)
+            for conn in ready:
+                (logfile, process, startTime) = running.pop(conn)
+                try:
+                    record = conn.recv()
+                except EOFError:
+                    record = None
+                conn.close()
+                process.join()
+                if record is None:
+                    record = errorRecord(logfile, "Analysis process exited unexpectedly with code %s" % process.exitcode)
+                yield record
+
+            for (conn, (logfile, process, startTime)) in list(running.items()):
+                if time.time() - startTime > args.timeout:
+                    process.terminate()
+                    process.join()
+                    conn.close()
+                    del running[conn]
+                    yield errorRecord(logfile, "Not analyzed within %g seconds" % args.timeout)
+    finally:
+        for (conn, (logfile, process, startTime)) in running.items():
+            process.terminate()
+        for (conn, (logfile, process, startTime)) in running.items():
+            process.join()
+            conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Analyze a batch of APM Dataflash logs for known issues')
+    parser.add_argument('logs', nargs='+', help='log files, directories of logs or glob patterns')
+    parser.add_argument('-f', '--format',  metavar='', type=str, action='store', choices=['bin','log','auto'], default='auto', help='log file format: \'bin\',\'log\' or \'auto\'')
+    parser.add_argument('-s', '--skip_bad', metavar='', action='store_const', const=True, help='skip over corrupt dataflash lines')
+    parser.add_argument('-l', '--lazy',  metavar='', action='store_const', const=True, help='memory map binary logs and only decode data as tests use it')
+    parser.add_argument('-c', '--cache', type=str, metavar='cache dir', nargs='?', const='', default=None, help='cache decoded logs, next to each log file or in the specified directory')
+    parser.add_argument('--cache_size', type=int, metavar='MB', default=1024, help='maximum size of the cache directory in MB')
+    parser.add_argument('-j', '--jobs', type=int, metavar='N', default=multiprocessing.cpu_count(), help='number of logs to analyze at once, each in its own process')
+    parser.add_argument('-t', '--timeout', type=float, metavar='seconds', default=600, help='record any log taking longer than this to analyze as an ERROR')
+    parser.add_argument('-o', '--output', type=str, metavar='file', default='-', help='write JSON lines results to this file (or - for stdout)')
+    parser.add_argument('--summary', type=str, metavar='file', default=None, help='also write the summary as JSON to this file')
+    args = parser.parse_args()
+
+    logs = findLogs(args.logs)
+    if not logs:
+        sys.stderr.write("No log files found\n")
+        sys.exit(1)
+
+    if args.output == '-':
+        output = sys.stdout
+    else:
+        output = open(args.output, 'w')
+
+    if args.jobs > 1:
+        records = analyzeInProcesses(logs, args)
+    else:
+        initWorker(args)
+        records = (analyzeLog(logfile) for logfile in logs)
+
+    summary = dict(logs=0, errors=0, tests={})
+    for record in records:
+        output.write(json.dumps(record, sort_keys=True) + "\n")
+        output.flush()
+        summary['logs'] += 1
+        if record['status'] != "OK":
+            summary['errors'] += 1
+            continue
+        for result in record['results']:
+            counts = summary['tests'].setdefault(result['name'], dict((name, 0) for name in statusNames.values()))
+            counts[result['status']] += 1
+
+    if output is not sys.stdout:
+        output.close()
+
+    sys.stderr.write("Analyzed %d logs (%d could not be analyzed)\n" % (summary['logs'], summary['errors']))
+    sys.stderr.write("  %20s  %6s  %6s\n" % ("", "FAIL", "WARN"))
+    for name in sorted(summary['tests']):
+        sys.stderr.write("  %20s  %6d  %6d\n" % (name, summary['tests'][name]['FAIL'], summary['tests'][name]['WARN']))
+    if args.summary:
+        with open(args.summary, 'w') as f:
+            json.dump(summary, f, sort_keys=True, indent=2)
+
+
+if __name__ == "__main__":
+    main()
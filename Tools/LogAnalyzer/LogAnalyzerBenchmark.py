@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+#
+# Benchmark for the LogAnalyzer pipeline: generates synthetic binary Dataflash logs of a given size and message mix,
+# then times reading them (split into the stages DataflashLog profiles) and each test
+#
+# Writes the results as JSON, which can be given back with --baseline to check for parse throughput regressions
+#
+
+from __future__ import print_function
+
+import argparse
+import ctypes
+import json
+import math
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy
+
+import DataflashLog
+from LogAnalyzer import TestSuite
+
+# message types the generated logs hold by default, as in an ArduCopter V3.1 log:
+# name -> (msgid, types, labels, rate in Hz, {label: (mean, amplitude)} for values which need to be realistic)
+MESSAGES = {
+    'IMU':  (131, 'Iffffff', 'TimeMS,GyrX,GyrY,GyrZ,AccX,AccY,AccZ', 50, {'AccZ': (-9.8, 1)}),
+    'IMU2': (135, 'Iffffff', 'TimeMS,GyrX,GyrY,GyrZ,AccX,AccY,AccZ', 50, {'AccZ': (-9.8, 1)}),
+    'ATT':  (1,   'IccccCC', 'TimeMS,DesRoll,Roll,DesPitch,Pitch,DesYaw,Yaw', 10, {'DesRoll': (0, 10), 'Roll': (0, 10), 'DesPitch': (0, 10), 'Pitch': (0, 10), 'DesYaw': (180, 90), 'Yaw': (180, 90)}),
+    'CTUN': (4,   'Ihhhffecchh', 'TimeMS,ThrIn,AngBst,ThrOut,DAlt,Alt,BarAlt,DSAlt,SAlt,DCRt,CRt', 10, {'ThrIn': (500, 200), 'ThrOut': (500, 200), 'Alt': (20, 10), 'BarAlt': (20, 10)}),
+    'RCIN': (133, 'Ihhhhhhhh', 'TimeMS,Chan1,Chan2,Chan3,Chan4,Chan5,Chan6,Chan7,Chan8', 10, {}),
+    'RCOU': (134, 'Ihhhhhhhh', 'TimeMS,Chan1,Chan2,Chan3,Chan4,Chan5,Chan6,Chan7,Chan8', 10, {}),
+    'MAG':  (15,  'Ihhhhhhhhh', 'TimeMS,MagX,MagY,MagZ,OfsX,OfsY,OfsZ,MOfsX,MOfsY,MOfsZ', 10, {'MagX': (200, 100), 'MagY': (0, 100), 'MagZ': (-300, 100), 'OfsX': (10, 0), 'OfsY': (-20, 0), 'OfsZ': (30, 0)}),
+    'GPS':  (130, 'BIHBcLLeeEefI', 'Status,TimeMS,Week,NSats,HDop,Lat,Lng,RelAlt,Alt,Spd,GCrs,VZ,T', 5, {'Status': (3, 0), 'Week': (1800, 0), 'NSats': (10, 1), 'HDop': (1.2, .2), 'Lat': (-353632610, 1000), 'Lng': (1491652300, 1000), 'RelAlt': (20, 10), 'Alt': (600, 10), 'Spd': (3, 2), 'GCrs': (180, 90)}),
+    'CURR': (9,   'IhIhhhf', 'TimeMS,ThrOut,ThrInt,Volt,Curr,Vcc,CurrTot', 1, {'ThrOut': (500, 200), 'Volt': (1200, 50), 'Curr': (1000, 500), 'Vcc': (5000, 50), 'CurrTot': (1000, 500)}),
+    'PM':   (6,   'BBHHIhBHB', 'RenCnt,RenBlw,NLon,NLoop,MaxT,PMT,I2CErr,INSErr,INAVErr', .1, {'NLon': (10, 5), 'NLoop': (1000, 0), 'MaxT': (4000, 500), 'PMT': (0, 0), 'I2CErr': (0, 0), 'INSErr': (0, 0), 'INAVErr': (0, 0)}),
+    'DU32': (23,  'BI', 'Id,Value', 1, {'Id': (7, 0), 'Value': (1000, 0)}),
+}
+
+# header message types, which are written as DataflashLog expects rather than generated
+HEADER_MESSAGES = {
+    'PARM': (129, 'Nf', 'Name,Value'),
+    'MSG':  (132, 'Z', 'Message'),
+    'MODE': (3,   'Mh', 'Mode,ThrCrs'),
+}
+
+# parameters written to the header, the ones the tests look at
+PARAMETERS = [('FRAME', 1), ('BATT_MONITOR', 4), ('LOG_BITMASK', 830), ('MAG_ENABLE', 1), ('ANGLE_MAX', 4500),
+              ('THR_MIN', 130), ('THR_MID', 500), ('RC3_MIN', 1100), ('RC3_MAX', 1900), ('MOT_PWM_MIN', 1100),
+              ('MOT_PWM_MAX', 1900), ('COMPASS_OFS_X', 10), ('COMPASS_OFS_Y', -20), ('COMPASS_OFS_Z', 30),
+              ('FLOW_FXSCALER', 0), ('FLOW_FYSCALER', 0)]
+
+CHUNK_BYTES = 1 << 22 # roughly how much of the log is generated at a time
+
+statsLabels = ['index', 'timeIndex']
+
+
+def formatClass(name, msgid, types, labels):
+    '''returns the FMT message describing a message type, and the class DataflashLog decodes it with'''
+    size = 3 + sum(ctypes.sizeof(DataflashLog.BinaryFormat.FIELD_FORMAT[t]) for t in types)
+    fmt = DataflashLog.BinaryFormat(type=msgid, length=size, name=name, types=types, labels=labels)
+    fmt.head.head1 = 0xa3
+    fmt.head.head2 = 0x95
+    fmt.head.msgid = DataflashLog.BinaryFormat.MSG
+    return (fmt, fmt.to_class())
+
+def headerMessage(cls, *values):
+    '''returns the bytes of a single message of class cls'''
+    m = cls()
+    m.head.head1 = 0xa3
+    m.head.head2 = 0x95
+    m.head.msgid = cls.MSG
+    for (label, value) in zip(cls.labels, values):
+        setattr(m, '_' + label, value)
+    return bytearray(m)
+
+def fieldValues(rng, label, fieldType, times, spec):
+    '''returns values of one field at the given times in seconds, a random wave about (mean, amplitude), as stored in the log'''
+    if label in ('TimeMS', 'T'):
+        return numpy.round(times * 1000)
+    (mean, amplitude) = spec.get(label, (1500, 400) if fieldType == 'h' else (0, 1))
+    period = rng.uniform(5, 60)
+    values = mean + amplitude * numpy.sin(2 * math.pi * times / period + rng.uniform(0, 2 * math.pi))
+    values += rng.normal(0, amplitude * .05 + 1e-9, len(times))
+    return values * DataflashLog.BinaryFormat.FIELD_SCALE.get(fieldType, 1)
+
+def generateLog(path, sizeBytes, rates=None, seed=0):
+    '''writes a synthetic binary log of about sizeBytes to path, with each of MESSAGES logged at its rate (rates can
+    override these in Hz, 0 leaving that type out). Returns the number of messages of each type written'''
+    rng = numpy.random.RandomState(seed)
+    rates = dict(rates or {})
+    messages = {}
+    for (name, (msgid, types, labels, rate, spec)) in MESSAGES.items():
+        rate = rates.get(name, rate)
+        if rate > 0:
+            (fmt, cls) = formatClass(name, msgid, types, labels)
+            messages[name] = (fmt, cls, rate, spec)
+    names = sorted(messages.keys(), key=lambda name: messages[name][1].MSG)
+    if not names:
+        raise ValueError("No message types to generate")
+    bytesPerSecond = sum(messages[name][1].SIZE * messages[name][2] for name in names)
+    chunkSeconds = max(1.0, CHUNK_BYTES / float(bytesPerSecond))
+    counts = dict((name, 0) for name in names)
+
+    with open(path, 'wb') as f:
+        # the header: FMTs, firmware version, parameters and an initial flight mode
+        header = bytearray()
+        (fmtFMT, fmtClass) = formatClass('FMT', 128, 'BBnNZ', 'Type,Length,Name,Format,Columns')
+        header += bytearray(fmtFMT)
+        headerClasses = {}
+        for (name, (msgid, types, labels)) in HEADER_MESSAGES.items():
+            (fmt, headerClasses[name]) = formatClass(name, msgid, types, labels)
+            header += bytearray(fmt)
+        for name in names:
+            header += bytearray(messages[name][0])
+        header += headerMessage(headerClasses['MSG'], b'ArduCopter V3.1 (5c6503e2)')
+        header += headerMessage(headerClasses['MSG'], b'Frame: QUAD')
+        for (param, value) in PARAMETERS:
+            header += headerMessage(headerClasses['PARM'], param.encode('ascii'), value)
+        header += headerMessage(headerClasses['MODE'], 0, 0)
+        f.write(header)
+        written = len(header)
+
+        # then the data, a chunk at a time, interleaving each type's messages by time
+        startTime = 0.0
+        while written < sizeBytes:
+            endTime = startTime + min(chunkSeconds, max((sizeBytes - written) / float(bytesPerSecond), .1))
+            chunks = []
+            for name in names:
+                (fmt, cls, rate, spec) = messages[name]
+                times = numpy.arange(math.ceil(startTime * rate), math.ceil(endTime * rate)) / float(rate)
+                records = numpy.zeros(len(times), dtype=cls.DTYPE)
+                records['head1'] = 0xa3
+                records['head2'] = 0x95
+                records['msgid'] = cls.MSG
+                for (i, (label, fieldType)) in enumerate(zip(cls.labels, cls.types)):
+                    dtype = records.dtype['f%d' % i]
+                    values = fieldValues(rng, label, fieldType, times, spec)
+                    if dtype.kind in 'iu':
+                        info = numpy.iinfo(dtype)
+                        values = numpy.clip(numpy.round(values), info.min, info.max)
+                    records['f%d' % i] = values
+                chunks.append((times, records))
+
+            times = numpy.concatenate([chunk[0] for chunk in chunks])
+            sizes = numpy.concatenate([numpy.repeat(chunk[1].dtype.itemsize, len(chunk[1])) for chunk in chunks])
+            order = times.argsort(kind='mergesort')
+            offsets = numpy.empty(len(order), dtype=numpy.int64)
+            offsets[order] = numpy.cumsum(sizes[order]) - sizes[order]
+            buf = numpy.zeros(sizes.sum(), dtype=numpy.uint8)
+            start = 0
+            for (name, (chunkTimes, records)) in zip(names, chunks):
+                size = records.dtype.itemsize
+                buf[offsets[start:start+len(records), numpy.newaxis] + numpy.arange(size)] = records.view(numpy.uint8).reshape(len(records), size)
+                start += len(records)
+                counts[name] += len(records)
+            f.write(buf.tobytes())
+            written += len(buf)
+            startTime = endTime
+    return counts
+
+def benchmarkLog(logfile, lazy=False, jobs=1):
+    '''reads and tests logfile, returning the times taken in a dict'''
+    result = dict(sizeBytes=os.path.getsize(logfile))
+    startTime = time.time()
+    logdata = DataflashLog.DataflashLog(logfile, lazy=lazy, jobs=jobs)
+    result['loadSecs'] = time.time() - startTime
+    for stage in statsLabels:
+        result[stage + 'Secs'] = logdata.readProfile['stages'].get(stage)
+    result['messages'] = logdata.lineCount
+    result['loadMBPerSec'] = result['sizeBytes'] / 1048576.0 / result['loadSecs']
+    result['loadMessagesPerSec'] = logdata.lineCount / result['loadSecs']
+
+    testSuite = TestSuite()
+    startTime = time.time()
+    testSuite.run(logdata, False)
+    result['testSecs'] = time.time() - startTime
+    result['decodeSecs'] = logdata.readProfile['stages'].get('decode') # includes decoding lazily read groups
+    result['tests'] = {}
+    for test in testSuite.tests:
+        if test.enable:
+            result['tests'][test.name] = dict(wallMs=test.execTime, cpuMs=test.cpuTime)
+    return result
+
+def compare(results, baseline, tolerance):
+    '''returns a list of messages for each size where load throughput fell more than tolerance below the baseline'''
+    regressions = []
+    for (size, result) in sorted(results.items()):
+        if size not in baseline.get('results', {}):
+            continue
+        before = baseline['results'][size]['loadMBPerSec']
+        after  = result['loadMBPerSec']
+        if after < before * (1 - tolerance):
+            regressions.append("%sMB log loads at %.2fMB/s, down from %.2fMB/s" % (size, after, before))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the LogAnalyzer on synthetic Dataflash logs')
+    parser.add_argument('-s', '--sizes', type=str, metavar='MB', default='10,100,1000', help='comma separated sizes of the logs to generate, in MB')
+    parser.add_argument('-r', '--rate', type=str, metavar='NAME=HZ', action='append', default=[], help='rate to log a message type at, 0 to leave it out (can be repeated)')
+    parser.add_argument('-d', '--dir', type=str, metavar='dir', default=None, help='directory to keep the generated logs in, so they are reused by later runs')
+    parser.add_argument('-l', '--lazy', metavar='', action='store_const', const=True, help='memory map the logs and only decode data as tests use it')
+    parser.add_argument('-j', '--read_jobs', type=int, metavar='N', default=1, help='split reading each log between N processes')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for the generated data')
+    parser.add_argument('-o', '--output', type=str, metavar='file', default='-', help='write the results as JSON to this file (or - for stdout)')
+    parser.add_argument('-b', '--baseline', type=str, metavar='file', default=None, help='compare load throughput with the results in this file, exiting with an error if it has regressed')
+    parser.add_argument('--tolerance', type=float, default=.2, help='fraction load throughput may fall below the baseline before it is a regression')
+    args = parser.parse_args()
+
+    rates = {}
+    for rate in args.rate:
+        (name, hz) = rate.split('=')
+        if name not in MESSAGES:
+            parser.error("Unknown message type %s, must be one of %s" % (name, ','.join(sorted(MESSAGES.keys()))))
+        rates[name] = float(hz)
+    mix = '_'.join('%s%g' % item for item in sorted(rates.items()))
+
+    logDir = args.dir or tempfile.mkdtemp()
+    if not os.path.isdir(logDir):
+        os.makedirs(logDir)
+    results = {}
+    for size in args.sizes.split(','):
+        logfile = os.path.join(logDir, 'synthetic_%sMB_%d%s.bin' % (size, args.seed, '_' + mix if mix else ''))
+        if not os.path.exists(logfile):
+            sys.stderr.write("Generating %s\n" % logfile)
+            generateLog(logfile, float(size) * 1048576, rates, args.seed)
+        sys.stderr.write("Benchmarking %s\n" % logfile)
+        results[size] = benchmarkLog(logfile, args.lazy, args.read_jobs)
+        sys.stderr.write("  load %.2fs (%.2fMB/s), tests %.2fs\n" % (results[size]['loadSecs'], results[size]['loadMBPerSec'], results[size]['testSecs']))
+        if not args.dir:
+            os.remove(logfile)
+    if not args.dir:
+        os.rmdir(logDir)
+
+    record = dict(results=results, rates=rates, seed=args.seed, lazy=bool(args.lazy), readJobs=args.read_jobs,
+                  python=platform.python_version(), numpy=numpy.__version__, machine=platform.machine())
+    if args.output == '-':
+        json.dump(record, sys.stdout, sort_keys=True, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(record, f, sort_keys=True, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            sys.stderr.write("REGRESSION: %s\n" % regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -10,6 +10,11 @@
 from __future__ import print_function
 
 import DataflashLog
+import DataflashLogCache
+import numpy
+import os
+import shutil
+import tempfile
 import traceback
 from VehicleType import VehicleType
 
@@ -42,6 +47,20 @@ try:
 	assert(logdata.channels['CTUN']['CRate'].listData[3]   == (317, 35))
 	assert(logdata.channels['CTUN']['CRate'].listData[51]  == (421, 31))
 	assert(logdata.channels['CTUN']['CRate'].listData[115] == (563, -8))
+	assert(logdata.channels['CTUN']['ThrOut'].dictData[321] == 139)
+	assert(321 in logdata.channels['CTUN']['ThrOut'].dictData)
+	assert(322 not in logdata.channels['CTUN']['ThrOut'].dictData)
+	assert(logdata.channels['CTUN']['ThrOut'].listData[-1] == (logdata.channels['CTUN']['ThrOut'].lines[-1], logdata.channels['CTUN']['ThrOut'].values[-1]))
+	assert(logdata.channels['CTUN']['ThrOut'].getSegment(321,409).listData[0]  == (321, 139))
+	assert(logdata.channels['CTUN']['ThrOut'].getSegment(321,409).listData[-1] == (409, 242))
+	assert(logdata.channels['GPS']['HDop'].getSegment(0,552).max() == 4.68)
+	assert(logdata.getTimeIndex('CTUN') is logdata.getTimeIndex('GPS')) # no CTUN timestamps in this log, so GPS ones are used
+	assert(logdata.getTimeIndex('GPS').timeAtLine(553) == 594438600)
+	assert(logdata.getTimeIndex('GPS').lineAtTime(594438600) == 560)
+	assert(logdata.channels['CTUN']['ThrOut'].between_times(594438600, 594438800).listData[0]  == (561, 265))
+	assert(logdata.channels['CTUN']['ThrOut'].between_times(594438600, 594438800).listData[-1] == (563, 266))
+	assert(len(logdata.channels['CTUN']['ThrOut'].between_times(0, 1).listData) == 0)
+	assert(DataflashLog.DataflashLogHelper.getTimeAtLine(logdata, 553) == 594438600)
 	assert(int(logdata.filesizeKB) == 307)
 	assert(logdata.durationSecs    == 155)
 	assert(logdata.lineCount       == 4750)
@@ -63,12 +82,168 @@ try:
 	assert(lit.currentLine == 4751)
 	assert(lit['ATT']['Roll'] == 2.99)
 
+	# test aligning channels, which should match LogIterator when stepping through lines
+	(lines, (thrIn, rollIn)) = DataflashLog.DataflashLogHelper.alignChannels(logdata, [('CTUN', 'ThrIn'), ('ATT', 'RollIn')], 500, 4751, method='next')
+	assert(lines[0] == 500 and lines[-1] == 4751)
+	assert(thrIn[0] == 450 and rollIn[0] == 11.19)
+	assert(rollIn[-1] == logdata.channels['ATT']['RollIn'].values[-1])
+	(lines, (thrIn,)) = DataflashLog.DataflashLogHelper.alignChannels(logdata, [('CTUN', 'ThrIn')], 499, 500, method='previous')
+	assert(thrIn[0] == logdata.channels['CTUN']['ThrIn'].getNearestValueBack(500)[0] and thrIn[1] == 450)
+	(times, (hdop, thrOut)) = DataflashLog.DataflashLogHelper.alignChannels(logdata, [('GPS', 'HDop'), ('CTUN', 'ThrOut')], 594438600, 594438800, by='time', method='nearest')
+	assert(list(times) == [594438600, 594438800] and hdop[0] == logdata.channels['GPS']['HDop'].dictData[560])
+
+	# test counting channel lookups, as done when profiling tests
+	counted = DataflashLog.CountingChannels(logdata.channels)
+	assert(counted['CTUN']['ThrOut'] is logdata.channels['CTUN']['ThrOut'])
+	assert(len(list(counted['GPS'].values())) == len(logdata.formats['GPS'].labels))
+	assert(counted.accesses == 1 + len(logdata.formats['GPS'].labels))
+	assert(counted['GPS'] is counted['GPS'] and list(counted.keys()) == list(logdata.channels.keys()))
+
+
+	# test replaying messages from channels, and streaming them as the log is read
+	messages = list(logdata.iterMessages(['CTUN', 'GPS']))
+	assert(len(messages) == len(logdata.channels['CTUN']['ThrOut'].listData) + len(logdata.channels['GPS']['HDop'].listData))
+	assert([lineNumber for (lineNumber, m) in messages] == sorted(lineNumber for (lineNumber, m) in messages))
+	(lineNumber, m) = [(lineNumber, m) for (lineNumber, m) in messages if lineNumber == 321][0]
+	assert(m.NAME == 'CTUN' and m.ThrOut == 139 and m.labels == logdata.formats['CTUN'].labels)
+	streamed = DataflashLog.DataflashLog()
+	assert([(lineNumber, m.NAME) for (lineNumber, m) in streamed.stream("examples/robert_lefebvre_octo_PM.log")] == [(lineNumber, m.NAME) for (lineNumber, m) in logdata.iterMessages()])
+	assert(streamed.lineCount       == 4750)
+	assert(streamed.durationSecs    == 155)
+
+
+	# test DataflashLogCache round trip
+	cacheDir = tempfile.mkdtemp()
+	try:
+		cache = DataflashLogCache.DataflashLogCache(cacheDir)
+		cache.read("examples/robert_lefebvre_octo_PM.log")
+		assert(len(os.listdir(cacheDir)) == 1)
+		cached = cache.read("examples/robert_lefebvre_octo_PM.log")
+		assert(cached.filename        == "examples/robert_lefebvre_octo_PM.log")
+		assert(cached.vehicleType     == VehicleType.Copter)
+		assert(cached.firmwareVersion == "V3.0.1")
+		assert(list(cached.parameters.items()) == list(logdata.parameters.items()))
+		assert(cached.modeChanges     == logdata.modeChanges)
+		assert(cached.formats['GPS'].labels == logdata.formats['GPS'].labels)
+		assert(cached.channels['GPS']['HDop'].listData[44]     == (768, 4.67))
+		assert(cached.channels['CTUN']['ThrOut'].listData[125] == (589, 266))
+		assert(cached.lineCount       == 4750)
+		assert(cached.durationSecs    == 155)
+	finally:
+		shutil.rmtree(cacheDir)
+
+	# test DataflashLogCache round trip of string channels, which must still be cache hits
+	cacheDir = tempfile.mkdtemp()
+	try:
+		stringLog = os.path.join(cacheDir, "strings.log")
+		with open(stringLog, 'w') as f:
+			f.write(open("examples/robert_lefebvre_octo_PM.log").read())
+			f.write("FMT, 200, 40, STR, BZ, Id,Text\nSTR, 1, hello\nSTR, 2, world\n")
+			f.write("FMT, 201, 7, MIX, f, Value\nMIX, 1.5\nMIX, oops\n")
+		cache = DataflashLogCache.DataflashLogCache(os.path.join(cacheDir, "cache"))
+		original = cache.read(stringLog)
+		key = cache.key(stringLog, "auto", False)
+		cached = cache.load(cache.path(stringLog, key), key)
+		assert(cached is not None)
+		assert(list(cached.channels['STR']['Text'].listData) == list(original.channels['STR']['Text'].listData))
+		assert([value for (lineNumber, value) in cached.channels['STR']['Text'].listData] == ["hello", "world"])
+		assert([value for (lineNumber, value) in cached.channels['MIX']['Value'].listData] == [1.5, "oops"])
+	finally:
+		shutil.rmtree(cacheDir)
+
+	# test reading a synthetic log, as generated for benchmarking
+	import LogAnalyzerBenchmark
+	(fd, syntheticLog) = tempfile.mkstemp(suffix='.bin')
+	os.close(fd)
+	try:
+		counts = LogAnalyzerBenchmark.generateLog(syntheticLog, 200000, {'PM': 0, 'IMU': 100})
+		assert('PM' not in counts and abs(counts['IMU'] - 2 * counts['IMU2']) <= 1)
+		synthetic = DataflashLog.DataflashLog(syntheticLog)
+		assert(synthetic.vehicleType == VehicleType.Copter and synthetic.parameters['MOT_PWM_MIN'] == 1100)
+		read = [len(list(synthetic.channels[name].values())[0].lines) for name in counts]
+		assert(0 <= sum(counts.values()) - sum(read) <= 1) # a message ending right at the end of the file isn't read
+		assert(synthetic.channels['IMU']['TimeMS'].values[100] == 1000)
+		assert(8 <= synthetic.channels['GPS']['NSats'].min() and synthetic.channels['GPS']['NSats'].max() <= 12)
+
+		# test reading it in shards with a pool of processes, with and without bad data, gives the same result
+		shardSize = DataflashLog.DataflashLog.binaryShardSize
+		DataflashLog.DataflashLog.binaryShardSize = 20000
+		try:
+			sharded = DataflashLog.DataflashLog(syntheticLog, jobs=3)
+			for name in counts:
+				for (label, channel) in synthetic.channels[name].items():
+					assert(numpy.array_equal(sharded.channels[name][label].lines, channel.lines))
+					assert(numpy.array_equal(sharded.channels[name][label].values, channel.values))
+			assert(sharded.lineCount == synthetic.lineCount and sharded.parameters == synthetic.parameters)
+			lineCount = synthetic.lineCount
+			with open(syntheticLog, 'r+b') as f:
+				data = bytearray(f.read())
+				for offset in (30000, 65000, 110000):
+					data[data.find(b'\xa3\x95', offset)] = 0
+				f.seek(0)
+				f.write(data)
+			synthetic = DataflashLog.DataflashLog(syntheticLog, ignoreBadlines=True)
+			sharded = DataflashLog.DataflashLog(syntheticLog, ignoreBadlines=True, jobs=3)
+			assert(sharded.lineCount == synthetic.lineCount and sharded.lineCount < lineCount)
+			for name in counts:
+				for (label, channel) in synthetic.channels[name].items():
+					assert(numpy.array_equal(sharded.channels[name][label].lines, channel.lines))
+					assert(numpy.array_equal(sharded.channels[name][label].values, channel.values))
+		finally:
+			DataflashLog.DataflashLog.binaryShardSize = shardSize
+	finally:
+		os.remove(syntheticLog)
 
 	# TODO: unit test DataflashLog reading 2
 	# ...
 
 	# TODO: unit test the log test classes
 	# ...
+	import imp
+	TestDupeLogData = imp.load_source("TestDupeLogData", "tests/TestDupeLogData.py").TestDupeLogData
+	assert(TestDupeLogData.findDuplicates(logdata.channels['ATT'], 20) == [])
+	values = list(range(100)) + list(range(10, 40)) + list(range(200, 250))
+	pitch = DataflashLog.Channel(float)
+	for (lineNumber, value) in enumerate(values):
+		pitch.append(2 * lineNumber, float(value))
+	assert(TestDupeLogData.findDuplicates({'Pitch': pitch}, 20) == [(20, 78, 200, 258)])
+	assert(logdata.nonFinite == {})
+	pitch.values[[5, 7]] = [float('nan'), float('inf')]
+	logdata.channels['PIT'] = {'Pitch': pitch}
+	logdata.scanNonFinite()
+	assert(logdata.nonFinite == {'PIT': {'Pitch': (2, 10, 14)}})
+	del logdata.channels['PIT']
+	TestIMUMatch = imp.load_source("TestIMUMatch", "tests/TestIMUMatch.py").TestIMUMatch
+	diff = [[float(i % 7), -1.0, float(i % 3)] for i in range(600)]
+	dt = [0] + [0.01 * (i % 11) for i in range(1, 600)]
+	filtered = [0.0, 0.0, 0.0]
+	for (d, t) in zip(diff, dt):
+		filtered = [f + (x - f) * t / 5.0 for (f, x) in zip(filtered, d)]
+	assert(abs(TestIMUMatch.lowPass(numpy.array(diff), numpy.array(dt), 5.0)[-1] - filtered).max() < 1e-12)
+
+	# test that a log which hangs in batch mode only times out itself, the logs still being analyzed when it does
+	# carrying on rather than being analyzed again
+	import LogAnalyzerBatch
+	import time
+	class BatchArgs(object):
+		jobs = 3
+		timeout = 2
+	analyzedDir = tempfile.mkdtemp()
+	def fakeAnalyzeLog(logfile):
+		open(os.path.join(analyzedDir, logfile), 'a').write("x") # one x per analysis, from the log's process
+		time.sleep(1000 if logfile == 'hang' else 1.5)
+		return dict(logfile=logfile, status="OK")
+	(analyzeLog, initWorker) = (LogAnalyzerBatch.analyzeLog, LogAnalyzerBatch.initWorker)
+	(LogAnalyzerBatch.analyzeLog, LogAnalyzerBatch.initWorker) = (fakeAnalyzeLog, lambda args: None)
+	try:
+		logs = ['hang'] + ['log%d' % i for i in range(4)]
+		records = dict((record['logfile'], record['status']) for record in LogAnalyzerBatch.analyzeInProcesses(logs, BatchArgs()))
+		assert(records == dict((logfile, "ERROR" if logfile == 'hang' else "OK") for logfile in logs))
+		for logfile in logs:
+			assert(open(os.path.join(analyzedDir, logfile)).read() == "x")
+	finally:
+		(LogAnalyzerBatch.analyzeLog, LogAnalyzerBatch.initWorker) = (analyzeLog, initWorker)
+		shutil.rmtree(analyzedDir)
 
 
 	print("All unit/regression tests GOOD\n")
@@ -9,36 +9,45 @@ class TestBrownout(Test):
 	def __init__(self):
 		Test.__init__(self)
 		self.name = "Brownout"
+		self.messageTypes = ["EV", "CTUN"]
 
-	def run(self, logdata, verbose):
-		self.result = TestResult()
-		self.result.status = TestResult.StatusType.GOOD
+	def start(self, logdata):
+		self.isArmed = False
+		self.ctun_baralt_att = None
+		self.lastAlts = [] # (line, alt) of the last two CTUN messages
 
-		isArmed = False
+	def on_message(self, lineNumber, m):
 		# FIXME: cope with LOG_ARM_DISARM_MSG message
-		if "EV" in logdata.channels:
+		if m.NAME == "EV":
 			# step through the arm/disarm events in order, to see if they're symmetrical
 			# note: it seems landing detection isn't robust enough to rely upon here, so we'll only consider arm+disarm, not takeoff+land
-			for line,ev in logdata.channels["EV"]["Id"].listData:
-				if ev == 10:
-					isArmed = True
-				elif ev == 11:
-					isArmed = False
+			if m.Id == 10:
+				self.isArmed = True
+			elif m.Id == 11:
+				self.isArmed = False
+		else:
+			if self.ctun_baralt_att is None:
+				if "BarAlt" in m.labels:
+					self.ctun_baralt_att = 'BarAlt'
+				else:
+					self.ctun_baralt_att = 'BAlt'
+			self.lastAlts = self.lastAlts[-1:] + [(lineNumber, getattr(m, self.ctun_baralt_att))]
+
+	def finish(self, logdata, verbose):
+		self.result = TestResult()
+		self.result.status = TestResult.StatusType.GOOD
 
-		if "CTUN" not in logdata.channels:
+		if not self.lastAlts:
 			self.result.status = TestResult.StatusType.UNKNOWN
 			self.result.statusMessage = "No CTUN log data"
 			return
 
-		if "BarAlt" in logdata.channels['CTUN']:
-			self.ctun_baralt_att = 'BarAlt'
-		else:
-			self.ctun_baralt_att = 'BAlt'
-
-		# check for relative altitude at end
-		(finalAlt,finalAltLine) = logdata.channels["CTUN"][self.ctun_baralt_att].getNearestValue(logdata.lineCount, lookForwards=False)
+		# check for relative altitude at end, i.e. the nearest value before the last line
+		(finalAltLine,finalAlt) = self.lastAlts[-1]
+		if finalAltLine >= logdata.lineCount and len(self.lastAlts) > 1:
+			(finalAltLine,finalAlt) = self.lastAlts[0]
 
 		finalAltMax = 3.0   # max alt offset that we'll still consider to be on the ground
-		if isArmed and finalAlt > finalAltMax:
+		if self.isArmed and finalAlt > finalAltMax:
 			self.result.status = TestResult.StatusType.FAIL
 			self.result.statusMessage = "Truncated Log? Ends while armed at altitude %.2fm" % finalAlt
@@ -3,77 +3,120 @@ from __future__ import print_function
 from LogAnalyzer import Test,TestResult
 import DataflashLog
 
+import numpy
+
 
 class TestDupeLogData(Test):
 	'''test for duplicated data in log, which has been happening on PX4/Pixhawk'''
 
+	windowSize  = 20 # consecutive messages of one type which must match to count as duplicated
+	maxReported = 10 # duplicated blocks listed in the result, all of them are kept in self.duplicates
+	hashBase        = numpy.uint64(0x100000001b3)  # odd, so it has an inverse mod 2**64
+	hashBaseInverse = numpy.uint64(pow(0x100000001b3, 2**62 - 1, 2**64)) # as any odd number**(2**62) == 1 mod 2**64
+
 	def __init__(self):
 		Test.__init__(self)
 		self.name = "Dupe Log Data"
-		
-	def __matchSample(self, sample, sampleStartIndex, logdata):
-		'''return the line number where a match is found, otherwise return False'''
-
-		# ignore if all data in sample is the same value
-		nSame = 0
-		for s in sample:
-			if s[1] == sample[0][1]:
-				nSame += 1
-		if nSame == 20:
-			return False
-
-		# c
-		data = logdata.channels["ATT"]["Pitch"].listData
-		for i in range(sampleStartIndex, len(data)):
-			#print("Checking against index %d" % i)
-			if i == sampleStartIndex:
-				continue # skip matching against ourselves
-			j = 0
-			while j<20 and (i+j)<len(data) and data[i+j][1] == sample[j][1]:
-				#print("### Match found, j=%d, data=%f, sample=%f, log data matched to sample at line %d" % (j,data[i+j][1],sample[j][1],data[i+j][0]))
-				j += 1
-			if j == 20: # all samples match
-				return data[i][0]
-
-		return False
+		self.duplicates = [] # ((startLine, endLine, dupStartLine, dupEndLine), lineLabel) of each duplicated block found
+
+	@staticmethod
+	def rowHashes(group):
+		'''returns a uint64 hash of the values in each message of a {label:Channel} group, along with its line numbers'''
+		channels = list(group.values())
+		lines = channels[0].lines
+		hashes = numpy.zeros(len(lines), dtype=numpy.uint64)
+		for channel in channels:
+			if not numpy.array_equal(channel.lines, lines):
+				continue # one message name given several formats, just hash the columns of the first
+			values = numpy.ascontiguousarray(channel.values)
+			if values.dtype.kind in 'iuf':
+				bits = values.view('u%d' % values.dtype.itemsize).astype(numpy.uint64)
+			else:
+				bits = numpy.array([hash(value) for value in values.tolist()], dtype=numpy.int64).view(numpy.uint64)
+			hashes = (hashes ^ bits) * TestDupeLogData.hashBase
+		return (lines, hashes)
+
+	@staticmethod
+	def windowHashes(hashes, windowSize):
+		'''returns the hash of every run of windowSize consecutive values in hashes, as a polynomial rolling hash mod 2**64'''
+		n = len(hashes)
+		powers = numpy.empty(n, dtype=numpy.uint64)
+		powers[0] = 1
+		powers[1:] = TestDupeLogData.hashBase
+		powers = numpy.cumprod(powers, dtype=numpy.uint64)
+		inverses = numpy.empty(n, dtype=numpy.uint64)
+		inverses[0] = 1
+		inverses[1:] = TestDupeLogData.hashBaseInverse
+		inverses = numpy.cumprod(inverses, dtype=numpy.uint64)
+		sums = numpy.zeros(n+1, dtype=numpy.uint64)
+		numpy.cumsum(hashes * powers, dtype=numpy.uint64, out=sums[1:])
+		# sum(hashes[i+k] * base**(i+k)) scaled back by base**-i, so equal windows hash the same wherever they are
+		return (sums[windowSize:] - sums[:-windowSize]) * inverses[:n-windowSize+1]
+
+	@staticmethod
+	def findDuplicates(group, windowSize):
+		'''returns a list of (startLine, endLine, dupStartLine, dupEndLine) for each block of at least windowSize
+		consecutive messages in group which appears again later in the log'''
+		(lines, hashes) = TestDupeLogData.rowHashes(group)
+		if len(lines) < 2 * windowSize:
+			return []
+		windows = TestDupeLogData.windowHashes(hashes, windowSize)
+
+		# only use windows where each message differs from the one before, low entropy data such as flags or values
+		# while sitting still can repeat without being duplicated
+		changes = numpy.zeros(len(hashes), dtype=numpy.int64)
+		changes[1:] = numpy.cumsum(hashes[1:] != hashes[:-1])
+		candidates = numpy.flatnonzero(changes[windowSize-1:] - changes[:len(windows)] == windowSize-1)
+		if not len(candidates):
+			return []
+
+		# pair each window with the first window having the same hash, if they don't overlap
+		order = candidates[numpy.argsort(windows[candidates], kind='mergesort')]
+		sortedWindows = windows[order]
+		runStarts = numpy.flatnonzero(numpy.r_[True, sortedWindows[1:] != sortedWindows[:-1]])
+		runLengths = numpy.diff(numpy.r_[runStarts, len(order)])
+		first = numpy.repeat(order[runStarts], runLengths)
+		dupe = order - first >= windowSize
+		(first, order) = (first[dupe], order[dupe])
+		if not len(order):
+			return []
+
+		# merge runs of matching windows at the same offset into blocks
+		sortIndex = numpy.argsort(order, kind='mergesort')
+		(first, order) = (first[sortIndex], order[sortIndex])
+		newBlock = numpy.r_[True, (order[1:] != order[:-1] + 1) | (order[1:] - first[1:] != order[:-1] - first[:-1])]
+		blockStarts = numpy.flatnonzero(newBlock)
+		blockEnds = numpy.r_[blockStarts[1:], len(order)] - 1
+		blocks = []
+		for (start, end) in zip(blockStarts.tolist(), blockEnds.tolist()):
+			(i, j, length) = (first[start], order[start], order[end] - order[start] + windowSize)
+			# rule out hash collisions by comparing the messages themselves
+			if all(numpy.array_equal(channel.values[i:i+length], channel.values[j:j+length]) or
+			       channel.values[i:i+length].tobytes() == channel.values[j:j+length].tobytes() for channel in group.values()):
+				blocks.append((lines[i], lines[i+length-1], lines[j], lines[j+length-1]))
+		return blocks
 
 	def run(self, logdata, verbose):
 		self.result = TestResult()
 		self.result.status = TestResult.StatusType.GOOD
 
-		# this could be made more flexible by not hard-coding to use ATT data, could make it dynamic based on whatever is available as long as it is highly variable
-		if "ATT" not in logdata.channels:
-			self.result.status = TestResult.StatusType.UNKNOWN
-			self.result.statusMessage = "No ATT log data"
-			return
-
-		# pick 10 sample points within the range of ATT data we have
-		sampleStartIndices = []
-		attStartIndex = 0
-		attEndIndex   = len(logdata.channels["ATT"]["Pitch"].listData)-1
-		step = attEndIndex / 11
-		for i in range(step,attEndIndex-step,step):
-			sampleStartIndices.append(i)
-			#print("Dupe data sample point index %d at line %d" % (i, logdata.channels["ATT"]["Pitch"].listData[i][0]))
-
-		# get 20 datapoints of pitch from each sample location and check for a match elsewhere
-		sampleIndex = 0
-		for i in range(sampleStartIndices[0], len(logdata.channels["ATT"]["Pitch"].listData)):
-			if i == sampleStartIndices[sampleIndex]:
-				#print("Checking sample %d" % i)
-				sample = logdata.channels["ATT"]["Pitch"].listData[i:i+20]
-				matchedLine = self.__matchSample(sample, i, logdata)
-				if matchedLine:
-					#print("Data from line %d found duplicated at line %d" % (sample[0][0],matchedLine))
-					self.result.status = TestResult.StatusType.FAIL
-					self.result.statusMessage = "Duplicate data chunks found in log (%d and %d)" % (sample[0][0],matchedLine)
-					return
-				sampleIndex += 1
-				if sampleIndex >= len(sampleStartIndices):
-					break
-
-
-
-
-
-
+		# check every type of message, in a single pass over each
+		duplicates = []
+		checked = set()
+		for groupName in logdata.channels.keys():
+			group = logdata.channels[groupName]
+			if id(group) in checked or not group:
+				continue # GPS may be an alias for GPS2
+			checked.add(id(group))
+			for block in self.findDuplicates(group, self.windowSize):
+				duplicates.append((block, groupName))
+
+		duplicates.sort()
+		self.duplicates = duplicates
+		if duplicates:
+			self.result.status = TestResult.StatusType.FAIL
+			self.result.statusMessage = "Duplicate data chunks found in log (%d and %d)\n" % (duplicates[0][0][0], duplicates[0][0][2])
+			for ((startLine, endLine, dupStartLine, dupEndLine), groupName) in duplicates[:self.maxReported]:
+				self.result.statusMessage += "%s lines %d-%d repeated at lines %d-%d\n" % (groupName, startLine, endLine, dupStartLine, dupEndLine)
+			if len(duplicates) > self.maxReported:
+				self.result.statusMessage += "and %d more duplicated blocks\n" % (len(duplicates) - self.maxReported)
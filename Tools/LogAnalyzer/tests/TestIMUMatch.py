@@ -2,7 +2,8 @@ from __future__ import print_function
 
 from LogAnalyzer import Test,TestResult
 import DataflashLog
-from math import sqrt
+import itertools
+import numpy
 
 
 class TestIMUMatch(Test):
@@ -12,6 +13,23 @@ class TestIMUMatch(Test):
         Test.__init__(self)
         self.name = "IMU Mismatch"
 
+    @staticmethod
+    def lowPass(x, dt, tc, chunkSize=256):
+        '''first order low pass filter of the rows of x with a varying time step, y[i] = y[i-1] + (x[i]-y[i-1])*dt[i]/tc
+        starting from y = 0. Each chunk of samples is filtered in closed form, y[i] = C[i]*(y[start] + sum(a[j]*x[j]/C[j]))
+        where a = dt/tc and C is the running product of (1-a) in the chunk, short enough for C not to underflow'''
+        n = len(dt)
+        chunks = max(1, (n + chunkSize - 1) // chunkSize)
+        pad = chunks * chunkSize - n
+        a = numpy.concatenate([dt / tc, numpy.zeros(pad)]).reshape(chunks, chunkSize, 1)
+        x = numpy.concatenate([x, numpy.zeros((pad, x.shape[1]))]).reshape(chunks, chunkSize, x.shape[1])
+        C = numpy.cumprod(1 - a, axis=1)
+        y = C * numpy.cumsum(a * x / C, axis=1)
+        # carry each chunk's final value into the next
+        for i in range(1, chunks):
+            y[i] += C[i] * y[i-1, -1]
+        return y.reshape(chunks * chunkSize, -1)[:n]
+
     def run(self, logdata, verbose):
 
         #tuning parameters:
@@ -22,94 +40,48 @@ class TestIMUMatch(Test):
         self.result = TestResult()
         self.result.status = TestResult.StatusType.GOOD
 
-        if ("IMU" in logdata.channels) and (not "IMU2" in logdata.channels):
+        imus = [name for name in ("IMU", "IMU2", "IMU3") if name in logdata.channels]
+
+        if ("IMU" in imus) and (len(imus) < 2):
             self.result.status = TestResult.StatusType.NA
             self.result.statusMessage = "No IMU2"
             return
 
-        if (not "IMU" in logdata.channels) or (not "IMU2" in logdata.channels):
+        if len(imus) < 2:
             self.result.status = TestResult.StatusType.UNKNOWN
             self.result.statusMessage = "No IMU log data"
             return
 
-        imu1 = logdata.channels["IMU"]
-        imu2 = logdata.channels["IMU2"]
-
-        timeLabel = None
-        for i in 'TimeMS','TimeUS','Time':
-            if i in logdata.channels["GPS"]:
-                timeLabel = i
-                break
-        imu1_timems = imu1[timeLabel].listData
-        imu1_accx = imu1["AccX"].listData
-        imu1_accy = imu1["AccY"].listData
-        imu1_accz = imu1["AccZ"].listData
-
-        imu2_timems = imu2[timeLabel].listData
-        imu2_accx = imu2["AccX"].listData
-        imu2_accy = imu2["AccY"].listData
-        imu2_accz = imu2["AccZ"].listData
-
-        imu_multiplier = 1.0E-3
-        if timeLabel == 'TimeUS':
-            imu_multiplier = 1.0E-6
-
-        imu1 = []
-        imu2 = []
-
-        for i in range(len(imu1_timems)):
-            imu1.append({ 't': imu1_timems[i][1]*imu_multiplier, 'x': imu1_accx[i][1], 'y': imu1_accy[i][1], 'z': imu1_accz[i][1]})
-
-        for i in range(len(imu2_timems)):
-            imu2.append({ 't': imu2_timems[i][1]*imu_multiplier, 'x': imu2_accx[i][1], 'y': imu2_accy[i][1], 'z': imu2_accz[i][1]})
-
-        imu1.sort(key=lambda x: x['t'])
-        imu2.sort(key=lambda x: x['t'])
-
-        imu2_index = 0
-
-        last_t = None
-
-        xdiff_filtered = 0
-        ydiff_filtered = 0
-        zdiff_filtered = 0
+        # compare every pair of IMUs, pairing each sample of the first with the sample of the second closest to it in time
         max_diff_filtered = 0
-
-        for i in range(len(imu1)):
-            #find closest imu2 value
-            t = imu1[i]['t']
-            dt = 0 if last_t is None else t-last_t
-            dt=min(dt,.1)
-
-            next_imu2 = None
-            for i in range(imu2_index,len(imu2)):
-                next_imu2 = imu2[i]
-                imu2_index=i
-                if next_imu2['t'] >= t:
-                    break
-            prev_imu2 = imu2[imu2_index-1]
-            closest_imu2 = next_imu2 if abs(next_imu2['t']-t)<abs(prev_imu2['t']-t) else prev_imu2
-
-            xdiff = imu1[i]['x']-closest_imu2['x']
-            ydiff = imu1[i]['y']-closest_imu2['y']
-            zdiff = imu1[i]['z']-closest_imu2['z']
-
-            xdiff_filtered += (xdiff-xdiff_filtered)*dt/filter_tc
-            ydiff_filtered += (ydiff-ydiff_filtered)*dt/filter_tc
-            zdiff_filtered += (zdiff-zdiff_filtered)*dt/filter_tc
-
-            diff_filtered = sqrt(xdiff_filtered**2+ydiff_filtered**2+zdiff_filtered**2)
-            max_diff_filtered = max(max_diff_filtered,diff_filtered)
-            #print(max_diff_filtered)
-            last_t = t
+        worst_pair = None
+        for (imu1, imu2) in itertools.combinations(imus, 2):
+            fields = [(imu1, "AccX"), (imu1, "AccY"), (imu1, "AccZ"), (imu2, "AccX"), (imu2, "AccY"), (imu2, "AccZ")]
+            (times, acc) = DataflashLog.DataflashLogHelper.alignChannels(logdata, fields, by='time', method='nearest')
+            if not len(times):
+                continue
+            acc = [values.astype(numpy.float64) for values in acc]
+            diff = numpy.column_stack([acc[0] - acc[3], acc[1] - acc[4], acc[2] - acc[5]])
+            dt = numpy.zeros(len(times))
+            dt[1:] = numpy.minimum(numpy.diff(times * 1.0E-3), .1)
+
+            diff_filtered = self.lowPass(diff, dt, filter_tc)
+            pair_max = numpy.sqrt((diff_filtered**2).sum(axis=1)).max()
+            if worst_pair is None or pair_max > max_diff_filtered:
+                max_diff_filtered = max(0, pair_max)
+                worst_pair = (imu1, imu2)
+
+        label = "Mismatch"
+        if len(imus) > 2 and worst_pair is not None:
+            label = "%s/%s mismatch" % worst_pair
 
         if max_diff_filtered > fail_threshold:
-            self.result.statusMessage = "Check vibration or accelerometer calibration. (Mismatch: %.2f, WARN: %.2f, FAIL: %.2f)" % (max_diff_filtered,warn_threshold,fail_threshold)
+            self.result.statusMessage = "Check vibration or accelerometer calibration. (%s: %.2f, WARN: %.2f, FAIL: %.2f)" % (label,max_diff_filtered,warn_threshold,fail_threshold)
             self.result.status = TestResult.StatusType.FAIL
         elif max_diff_filtered > warn_threshold:
-            self.result.statusMessage = "Check vibration or accelerometer calibration. (Mismatch: %.2f, WARN: %.2f, FAIL: %.2f)" % (max_diff_filtered,warn_threshold,fail_threshold)
+            self.result.statusMessage = "Check vibration or accelerometer calibration. (%s: %.2f, WARN: %.2f, FAIL: %.2f)" % (label,max_diff_filtered,warn_threshold,fail_threshold)
             self.result.status = TestResult.StatusType.WARN
         else:
-            self.result.statusMessage = "(Mismatch: %.2f, WARN: %.2f, FAIL: %.2f)" % (max_diff_filtered,warn_threshold, fail_threshold)
+            self.result.statusMessage = "(%s: %.2f, WARN: %.2f, FAIL: %.2f)" % (label,max_diff_filtered,warn_threshold, fail_threshold)
 
 
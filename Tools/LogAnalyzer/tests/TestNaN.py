@@ -1,29 +1,68 @@
 from LogAnalyzer import Test,TestResult
+import DataflashLog
 import math
 
 class TestNaN(Test):
-    '''test for NaNs present in log'''
+    '''test for NaNs or Infs present in log'''
 
     def __init__(self):
         Test.__init__(self)
         self.name = "NaNs"
+        self.messageTypes = ['*']
 
     def run(self, logdata, verbose):
+        # float channels are scanned once as the log is decoded, groups of a lazily read log not decoded yet are scanned without keeping them
+        logdata.scanPendingNonFinite()
+        found = []
+        for groupName in list(logdata.channels.keys()):
+            for (field, (count, firstLine, lastLine)) in logdata.nonFinite.get(groupName, {}).items():
+                timeIndex = logdata.getTimeIndex(groupName)
+                if timeIndex is None:
+                    (firstTime, lastTime) = (None, None)
+                else:
+                    (firstTime, lastTime) = (timeIndex.timeAtLine(firstLine), timeIndex.timeAtLine(lastLine))
+                found.append((groupName, field, count, firstLine, lastLine, firstTime, lastTime))
+        self.report(found)
+
+    def start(self, logdata):
+        # channel -> field -> [count, firstLine, lastLine, firstTime, lastTime] of NaN/Inf values
+        self.fields = {}
+
+    def on_message(self, lineNumber, m):
+        for field in m.labels:
+            val = getattr(m, field)
+            if isinstance(val, float) and (math.isnan(val) or math.isinf(val)):
+                fields = self.fields.setdefault(m.NAME, {})
+                if field not in fields:
+                    time = self.messageTime(m)
+                    fields[field] = [0, lineNumber, lineNumber, time, time]
+                fields[field][0] += 1
+                fields[field][2] = lineNumber
+                fields[field][4] = self.messageTime(m)
+
+    def finish(self, logdata, verbose):
+        found = []
+        for channel in self.fields.keys():
+            for (field, record) in self.fields[channel].items():
+                found.append(tuple([channel, field] + record))
+        self.report(found)
+
+    @staticmethod
+    def messageTime(m):
+        '''returns the timestamp of a message in ms, or None if it has none'''
+        for (label, scale) in DataflashLog.TimeIndex.timeLabels:
+            if label in m.labels:
+                return getattr(m, label) * scale
+        return None
+
+    def report(self, found):
+        '''sets the result from a list of (channel, field, count, firstLine, lastLine, firstTime, lastTime)'''
         self.result = TestResult()
         self.result.status = TestResult.StatusType.GOOD
 
-        def FAIL():
+        for (channel, field, count, firstLine, lastLine, firstTime, lastTime) in sorted(found):
             self.result.status = TestResult.StatusType.FAIL
-
-
-        for channel in logdata.channels.keys():
-            for field in logdata.channels[channel].keys():
-                try:
-                    for tupe in logdata.channels[channel][field].listData:
-                        (ts, val) = tupe
-                        if isinstance(val, float) and math.isnan(val):
-                            FAIL()
-                            self.result.statusMessage += "Found NaN in %s.%s\n" % (channel, field,)
-                            raise ValueError()
-                except ValueError as e:
-                    continue
+            self.result.statusMessage += "Found NaN/Inf in %s.%s (%d values, lines %d-%d" % (channel, field, count, firstLine, lastLine)
+            if firstTime is not None and lastTime is not None:
+                self.result.statusMessage += ", %.1fs-%.1fs" % (firstTime * 1.0E-3, lastTime * 1.0E-3)
+            self.result.statusMessage += ")\n"
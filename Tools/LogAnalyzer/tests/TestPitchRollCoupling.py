@@ -3,6 +3,7 @@ import DataflashLog
 from VehicleType import VehicleType
 
 import collections
+import numpy
 
 
 class TestPitchRollCoupling(Test):
@@ -14,6 +15,17 @@ class TestPitchRollCoupling(Test):
         self.name = "Pitch/Roll"
         self.enable = True   # TEMP
 
+    @staticmethod
+    def maxAngle(lines, angles, airborne, limit, prevMax, prevMaxLine):
+        '''returns (angle, line) of the first of the largest airborne angles beyond limit, if larger than prevMax, otherwise (prevMax, prevMaxLine)'''
+        angles = angles.astype(numpy.float64)
+        candidates = numpy.flatnonzero(airborne & (numpy.abs(angles) > limit))
+        if len(candidates):
+            i = candidates[numpy.argmax(numpy.abs(angles[candidates]))]
+            if abs(angles[i]) > abs(prevMax):
+                return (angles.item(i), lines.item(i))
+        return (prevMax, prevMaxLine)
+
     def run(self, logdata, verbose):
         self.result = TestResult()
         self.result.status = TestResult.StatusType.GOOD
@@ -111,20 +123,12 @@ class TestPitchRollCoupling(Test):
             roll  = max(abs(rollSeg.min()),  abs(rollSeg.max()))
             pitch = max(abs(pitchSeg.min()), abs(pitchSeg.max()))
             if (roll>(maxLeanAngle+maxLeanAngleBuffer) and abs(roll)>abs(maxRoll)) or (pitch>(maxLeanAngle+maxLeanAngleBuffer) and abs(pitch)>abs(maxPitch)):
-                lit = DataflashLog.LogIterator(logdata, startLine)
-                assert(lit.currentLine == startLine)
-                while lit.currentLine <= endLine:
-                    relativeAlt = lit["CTUN"][self.ctun_baralt_att]
-                    if relativeAlt > minAltThreshold:
-                        roll  = lit["ATT"]["Roll"]
-                        pitch = lit["ATT"]["Pitch"]
-                        if abs(roll)>(maxLeanAngle+maxLeanAngleBuffer) and abs(roll)>abs(maxRoll):
-                            maxRoll = roll
-                            maxRollLine = lit.currentLine
-                        if abs(pitch)>(maxLeanAngle+maxLeanAngleBuffer) and abs(pitch)>abs(maxPitch):
-                            maxPitch = pitch
-                            maxPitchLine = lit.currentLine
-                    next(lit)
+                # step through every line of the segment, as CTUN and ATT were logged at different times
+                (lines, (relativeAlt, roll, pitch)) = DataflashLog.DataflashLogHelper.alignChannels(logdata,
+                    [("CTUN", self.ctun_baralt_att), ("ATT", "Roll"), ("ATT", "Pitch")], startLine, endLine, method='next')
+                airborne = relativeAlt > minAltThreshold
+                (maxRoll, maxRollLine)   = self.maxAngle(lines, roll,  airborne, maxLeanAngle+maxLeanAngleBuffer, maxRoll,  maxRollLine)
+                (maxPitch, maxPitchLine) = self.maxAngle(lines, pitch, airborne, maxLeanAngle+maxLeanAngleBuffer, maxPitch, maxPitchLine)
         # check for breaking max lean angles
         if maxRoll and abs(maxRoll)>abs(maxPitch):
             self.result.status = TestResult.StatusType.FAIL
@@ -10,25 +10,45 @@ class TestVCC(Test):
     def __init__(self):
         Test.__init__(self)
         self.name = "VCC"
+        self.messageTypes = ["CURR", "POWR"]
 
-    def run(self, logdata, verbose):
+    def start(self, logdata):
+        # just a naive min/max test for now
+        self.haveCURR = False
+        self.vcc = {} # message name -> [min, max]
+
+    def on_message(self, lineNumber, m):
+        if m.NAME == "CURR":
+            self.haveCURR = True
+        if "Vcc" not in m.labels:
+            return
+        vcc = m.Vcc
+        if m.NAME not in self.vcc:
+            self.vcc[m.NAME] = [vcc, vcc]
+        elif vcc < self.vcc[m.NAME][0]:
+            self.vcc[m.NAME][0] = vcc
+        elif vcc > self.vcc[m.NAME][1]:
+            self.vcc[m.NAME][1] = vcc
+
+    def finish(self, logdata, verbose):
         self.result = TestResult()
         self.result.status = TestResult.StatusType.GOOD
 
-        if not "CURR" in logdata.channels:
+        if not self.haveCURR:
             self.result.status = TestResult.StatusType.UNKNOWN
             self.result.statusMessage = "No CURR log data"
             return
 
-        # just a naive min/max test for now
-        try:
-            vccMin  = logdata.channels["CURR"]["Vcc"].min()
-            vccMax  = logdata.channels["CURR"]["Vcc"].max()
-        except KeyError as e:
-            vccMin  = logdata.channels["POWR"]["Vcc"].min()
-            vccMax  = logdata.channels["POWR"]["Vcc"].max()
+        if "CURR" in self.vcc:
+            (vccMin, vccMax) = self.vcc["CURR"]
+        elif "POWR" in self.vcc:
+            (vccMin, vccMax) = self.vcc["POWR"]
             vccMin *= 1000
             vccMax *= 1000
+        else:
+            self.result.status = TestResult.StatusType.UNKNOWN
+            self.result.statusMessage = "No Vcc log data"
+            return
 
         vccDiff = vccMax - vccMin;
         vccMinThreshold = 4.6 * 1000;
@@ -39,4 +59,3 @@ class TestVCC(Test):
         elif vccMin < vccMinThreshold:
             self.result.status = TestResult.StatusType.FAIL
             self.result.statusMessage = "VCC below minimum of %sv (%sv)" % (repr(vccMinThreshold/1000.0),repr(vccMin/1000.0))
-        
@@ -3,7 +3,7 @@
 run Replay over a set of logs to check for code regressions
 '''
 
-import optparse, os, sys
+import hashlib, json, multiprocessing, optparse, os, shutil, subprocess, sys, tempfile, time
 
 parser = optparse.OptionParser("CheckLogs")
 parser.add_option("--logdir", type='string', default='testlogs', help='directory of logs to use')
@@ -11,6 +11,10 @@ parser.add_option("--create-checked-logs", action='store_true', default=False, h
 parser.add_option("--tolerance-euler", type=float, default=3, help="tolerance for euler angles in degrees");
 parser.add_option("--tolerance-pos", type=float, default=2, help="tolerance for position angles in meters");
 parser.add_option("--tolerance-vel", type=float, default=2, help="tolerance for velocity in meters/second");
+parser.add_option("--jobs", "-j", type=int, default=multiprocessing.cpu_count(), help="number of logs to replay at once")
+parser.add_option("--timeout", type=float, default=None, help="give up on a log after this many seconds");
+parser.add_option("--results", type='string', default='replay_results.json', help="file storing the results of each log, by log hash, git version and Replay build")
+parser.add_option("--force", action='store_true', default=False, help="replay every log, even those with stored results for this build")
 
 opts, args = parser.parse_args()
 
@@ -27,14 +31,68 @@ def run_cmd(cmd, dir=".", show=False, output=False, checkfail=True):
         return call(cmd, shell=True, cwd=dir)
 
 def run_replay(logfile):
-    '''run Replay on one logfile'''
+    '''run Replay on one logfile in its own scratch directory, returning a line of
+    replay_results.txt as a list of the filename and 5 errors'''
     print("Processing %s" % logfile)
-    cmd = "./Replay.elf -- --check %s --tolerance-euler=%f --tolerance-pos=%f --tolerance-vel=%f " % (
-        logfile,
-        opts.tolerance_euler,
-        opts.tolerance_pos,
-        opts.tolerance_vel)
-    run_cmd(cmd, checkfail=False)
+    workdir = tempfile.mkdtemp(prefix='replay-')
+    cmd = [os.path.abspath("Replay.elf"), "--",
+           "--check", os.path.abspath(logfile),
+           "--tolerance-euler=%f" % opts.tolerance_euler,
+           "--tolerance-pos=%f" % opts.tolerance_pos,
+           "--tolerance-vel=%f" % opts.tolerance_vel]
+    try:
+        start_time = time.time()
+        output = open(os.path.join(workdir, "replay.out"), "w")
+        p = subprocess.Popen(cmd, cwd=workdir, stdout=output, stderr=subprocess.STDOUT)
+        while p.poll() is None:
+            if opts.timeout is not None and time.time() - start_time > opts.timeout:
+                p.kill()
+                p.wait()
+                output.close()
+                print("Timed out %s after %.0f seconds" % (logfile, opts.timeout))
+                return [logfile] + ["TIMEOUT"] * 5
+            time.sleep(0.1)
+        output.close()
+        results = os.path.join(workdir, "replay_results.txt")
+        if os.path.exists(results):
+            a = open(results).readline().strip().split("\t")
+            if len(a) == 6:
+                print("Finished %s in %.1f seconds" % (logfile, time.time() - start_time))
+                return [logfile] + a[1:]
+        print("Replay of %s failed with exit code %d:" % (logfile, p.returncode))
+        print("".join(open(os.path.join(workdir, "replay.out")).readlines()[-10:]))
+        return [logfile] + ["ERROR"] * 5
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def log_hash(filename):
+    '''return the SHA1 of a log (or any other) file'''
+    h = hashlib.sha1()
+    f = open(filename, "rb")
+    while True:
+        data = f.read(1 << 20)
+        if not data:
+            break
+        h.update(data)
+    f.close()
+    return h.hexdigest()
+
+def load_results():
+    '''load the stored results, a dict of log, git version and Replay.elf hashes to replay_results.txt errors'''
+    if opts.force or not os.path.exists(opts.results):
+        return {}
+    try:
+        return json.load(open(opts.results))
+    except ValueError as ex:
+        print("Ignoring bad results file %s: %s" % (opts.results, ex))
+        return {}
+
+def write_file(filename, text):
+    '''replace a file with text, so a reader never sees it half written'''
+    f = open(filename + ".tmp", "w")
+    f.write(text)
+    f.close()
+    os.rename(filename + ".tmp", filename)
 
 def get_log_list():
     '''get a list of log files to process'''
@@ -47,13 +105,11 @@ def get_log_list():
         sys.exit(1)
     return file_list
 
-def create_html_results():
-    '''create a HTML file with results'''
+def create_html_results(lines, git_version, total_count):
+    '''create a HTML file with results, given the replay_results.txt lines so far'''
     error_count = 0
 
-    git_version = run_cmd('git log --pretty=oneline HEAD~1..HEAD', output=True)
-    
-    f = open("replay_results.html", "w")
+    f = open("replay_results.html.tmp", "w")
     f.write(
 '''<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN"
         "http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd">
@@ -76,15 +132,12 @@ Git version: %s
  <th>VelError(m/s)</th>
 </tr>
 ''' % git_version)
-    infile = open("replay_results.txt", "r")
-
     line_count = 0
     line_errors = 0
     
-    for line in infile:
-        line = line.strip()
+    for a in lines:
+        line = "\t".join(a)
         line_count += 1
-        a = line.split("\t")
         if len(a) != 6:
             print("Invalid line: %s" % line)
             error_count += 1
@@ -98,7 +151,7 @@ Git version: %s
         error_in_this_log = False
         for i in range(1,6):
             tol = tolerances[i-1]
-            if a[i] == "FPE":
+            if a[i] in ["FPE", "TIMEOUT", "ERROR"]:
                 bgcolor = "red"
                 error_count += 1
                 error_in_this_log = True
@@ -119,13 +172,13 @@ Git version: %s
     # write summary
     f.write(
 '''<h2>Summary</h2>
-<p>Processed %u logs<br/>
+<p>Processed %u of %u logs<br/>
 %u errors from %u logs<br/>
 <hr>
 <p>Tolerance Euler: %.3f degrees<br/>
 Tolerance Position: %.3f meters<br/>
 Tolerance Velocity: %.3f meters/second
-''' % (line_count, error_count, line_errors,
+''' % (line_count, total_count, error_count, line_errors,
        opts.tolerance_euler,
        opts.tolerance_pos,
        opts.tolerance_vel))
@@ -137,23 +190,47 @@ Tolerance Velocity: %.3f meters/second
 </html>
 ''')
     f.close()
-    infile.close()
+    os.rename("replay_results.html.tmp", "replay_results.html")
 
 def check_logs():
-    '''run log checking'''
-    log_list = get_log_list()
-
-    # remove old results file
-    try:
-        os.unlink("replay_results.txt")
-    except Exception as ex:
-        print(ex)
-        pass
+    '''run log checking, replaying logs opts.jobs at a time and updating the results as each one finishes'''
+    log_list = sorted(get_log_list())
 
+    git_version = run_cmd('git log --pretty=oneline HEAD~1..HEAD', output=True).decode().strip()
+    # results are only reused for the same log, git version and Replay build, so uncommitted changes are picked up
+    git_hash = run_cmd('git rev-parse HEAD', output=True).decode().strip()
+    replay_hash = log_hash("Replay.elf")
+    keys = dict((logfile, "%s-%s-%s" % (log_hash(logfile), git_hash, replay_hash)) for logfile in log_list)
+    # only keep the results of the current logs, git version and Replay build, older ones can never be used again
+    stored = load_results()
+    stored = dict((key, stored[key]) for key in keys.values() if key in stored)
+    results = {}
     for logfile in log_list:
-        run_replay(logfile)
+        if keys[logfile] in stored:
+            results[logfile] = [logfile] + stored[keys[logfile]]
+    to_run = [logfile for logfile in log_list if logfile not in results]
+    print("Replaying %u logs, %u unchanged since the last run" % (len(to_run), len(results)))
+
+    def write_results():
+        lines = [results[f] for f in log_list if f in results]
+        write_file(opts.results, json.dumps(stored, indent=1, sort_keys=True))
+        write_file("replay_results.txt", "".join("\t".join(a) + "\n" for a in lines))
+        create_html_results(lines, git_version, len(log_list))
 
-    create_html_results()
+    write_results()
+    if len(to_run) == 0:
+        return
+    pool = multiprocessing.Pool(max(1, min(opts.jobs, len(to_run))))
+    try:
+        for line in pool.imap_unordered(run_replay, to_run):
+            results[line[0]] = line
+            if line[1] not in ["TIMEOUT", "ERROR"]:
+                # timeouts and crashes may not happen again, so those logs are always replayed
+                stored[keys[line[0]]] = line[1:]
+            write_results()
+    finally:
+        pool.terminate()
+        pool.join()
 
 def create_checked_logs():
     '''create a set of CHEK logs'''
@@ -9,9 +9,9 @@ import shutil
 import time
 
 from common import AutoTest
+from common import AutoTestCase
 
 from pysim import util
-from pysim import vehicleinfo
 
 from pymavlink import mavutil
 
@@ -32,14 +32,15 @@ class AutoTestRover(AutoTest):
                  use_map=False,
                  valgrind=False,
                  gdb=False,
-                 speedup=10,
+                 speedup=None,
                  frame=None,
                  params=None,
-                 gdbserver=False):
-        super(AutoTestRover, self).__init__()
+                 gdbserver=False,
+                 instance=0):
+        super(AutoTestRover, self).__init__(instance=instance)
         self.binary = binary
-        self.options = ("--sitl=127.0.0.1:5501 --out=127.0.0.1:19550"
-                        " --streamrate=10")
+        self.options = (self.mavproxy_options() +
+                        ' --streamrate=10')
         self.viewerip = viewerip
         self.use_map = use_map
         self.valgrind = valgrind
@@ -68,42 +69,16 @@ class AutoTestRover(AutoTest):
         if self.use_map:
             self.options += ' --map'
 
-        self.sitl = util.start_SITL(self.binary,
-                                    wipe=True,
-                                    model=self.frame,
-                                    home=self.home,
-                                    speedup=self.speedup_default)
-        self.mavproxy = util.start_MAVProxy_SITL('APMrover2')
-
-        self.progress("WAITING FOR PARAMETERS")
-        self.mavproxy.expect('Received [0-9]+ parameters')
-
-        # setup test parameters
-        vinfo = vehicleinfo.VehicleInfo()
-        if self.params is None:
-            frames = vinfo.options["APMrover2"]["frames"]
-            self.params = frames[self.frame]["default_params_filename"]
-        if not isinstance(self.params, list):
-            self.params = [self.params]
-        for x in self.params:
-            self.mavproxy.send("param load %s\n" % os.path.join(testdir, x))
-            self.mavproxy.expect('Loaded [0-9]+ parameters')
-        self.set_parameter('LOG_REPLAY', 1)
-        self.set_parameter('LOG_DISARMED', 1)
-        self.progress("RELOADING SITL WITH NEW PARAMETERS")
-
-        # restart with new parms
-        util.pexpect_close(self.mavproxy)
-        util.pexpect_close(self.sitl)
-
-        self.sitl = util.start_SITL(self.binary,
-                                    model=self.frame,
-                                    home=self.home,
-                                    speedup=self.speedup,
-                                    valgrind=self.valgrind,
-                                    gdb=self.gdb,
-                                    gdbserver=self.gdbserver)
+        self.start_SITL(wipe=True,
+                        model=self.frame,
+                        home=self.home,
+                        defaults_file=self.sitl_defaults_file(
+                            "APMrover2"),
+                        valgrind=self.valgrind,
+                        gdb=self.gdb,
+                        gdbserver=self.gdbserver)
         self.mavproxy = util.start_MAVProxy_SITL('APMrover2',
+                                                 master=self.mavproxy_master(),
                                                  options=self.options)
         self.mavproxy.expect('Telemetry log: (\S+)')
         logfile = self.mavproxy.match.group(1)
@@ -127,17 +102,7 @@ class AutoTestRover(AutoTest):
 
         self.progress("Started simulator")
 
-        # get a mavlink connection going
-        connection_string = '127.0.0.1:19550'
-        try:
-            self.mav = mavutil.mavlink_connection(connection_string,
-                                                  robust_parsing=True)
-        except Exception as msg:
-            self.progress("Failed to start mavlink connection on %s" %
-                          connection_string)
-            raise
-        self.mav.message_hooks.append(self.message_hook)
-        self.mav.idle_hooks.append(self.idle_hook)
+        self.start_mavlink_connection()
         self.hasInit = True
         self.progress("Ready to start testing!")
 
@@ -146,7 +111,7 @@ class AutoTestRover(AutoTest):
             self.mavproxy.send("module unload map\n")
             self.mavproxy.expect("Unloaded module map")
 
-        self.mav.close()
+        self.stop_mavlink_connection()
         util.pexpect_close(self.mavproxy)
         util.pexpect_close(self.sitl)
 
@@ -419,9 +384,9 @@ class AutoTestRover(AutoTest):
 
         # controller tends not to meet cruise speed (max of ~14 when 15
         # set), thus *1.2
-        self.set_parameter('CRUISE_SPEED', speed*1.2)
         # at time of writing, the vehicle is only capable of 10m/s/s accel
-        self.set_parameter('ATC_ACCEL_MAX', 15)
+        self.set_parameters({'CRUISE_SPEED': speed*1.2,
+                             'ATC_ACCEL_MAX': 15})
         self.mavproxy.send("mode STEERING\n")
         self.wait_mode('STEERING')
         self.set_rc(3, 2000)
@@ -444,8 +409,8 @@ class AutoTestRover(AutoTest):
                 break
         delta = self.get_distance(start, stop)
 
-        self.set_parameter('CRUISE_SPEED', old_cruise_speed)
-        self.set_parameter('ATC_ACCEL_MAX', old_accel_max)
+        self.set_parameters({'CRUISE_SPEED': old_cruise_speed,
+                             'ATC_ACCEL_MAX': old_accel_max})
 
         return delta
 
@@ -453,8 +418,8 @@ class AutoTestRover(AutoTest):
         old_using_brake = self.get_parameter('ATC_BRAKE')
         old_cruise_speed = self.get_parameter('CRUISE_SPEED')
 
-        self.set_parameter('CRUISE_SPEED', 15)
-        self.set_parameter('ATC_BRAKE', 0)
+        self.set_parameters({'CRUISE_SPEED': 15,
+                             'ATC_BRAKE': 0})
 
         distance_without_brakes = self.drive_brake_get_stopping_distance(15)
 
@@ -462,8 +427,8 @@ class AutoTestRover(AutoTest):
         self.set_parameter('ATC_BRAKE', 1)
         distance_with_brakes = self.drive_brake_get_stopping_distance(15)
         # revert state:
-        self.set_parameter('ATC_BRAKE', old_using_brake)
-        self.set_parameter('CRUISE_SPEED', old_cruise_speed)
+        self.set_parameters({'ATC_BRAKE': old_using_brake,
+                             'CRUISE_SPEED': old_cruise_speed})
 
         delta = distance_without_brakes - distance_with_brakes
         if delta < distance_without_brakes * 0.05:  # 5% isn't asking for much
@@ -520,6 +485,60 @@ class AutoTestRover(AutoTest):
         self.progress("RTL Mission OK")
         return True
 
+    def boot_setup(self):
+        """Wait for a newly started vehicle to know where it is."""
+        self.mav.wait_heartbeat()
+        self.progress("Setting up RC parameters")
+        self.set_rc_default()
+        self.set_rc(8, 1800)
+        self.progress("Waiting for GPS fix")
+        self.mav.wait_gps_fix()
+        self.homeloc = self.mav.location()
+        self.progress("Home location: %s" % self.homeloc)
+        return True
+
+    def arm_in_manual(self):
+        """Arm in MANUAL mode."""
+        self.mavproxy.send('switch 6\n')  # Manual mode
+        self.wait_mode('MANUAL')
+        self.progress("Waiting reading for arm")
+        self.wait_ready_to_arm()
+        return self.arm_vehicle()
+
+    def test_cases(self):
+        """Return the test cases autotest runs, in order."""
+        return [
+            AutoTestCase("DriveRTL",
+                         "Drive an RTL mission",
+                         self.drive_rtl_mission,
+                         setup=self.arm_in_manual),
+            AutoTestCase("DriveSquare",
+                         "Drive a square and save WPs with CH7 switch",
+                         self.drive_square,
+                         setup=self.arm_in_manual),
+            AutoTestCase("DriveMission",
+                         "Drive rover1.txt mission",
+                         lambda: self.drive_mission(
+                             os.path.join(testdir, "rover1.txt")),
+                         setup=self.arm_in_manual),
+            AutoTestCase("DriveBrake",
+                         "Test braking",
+                         self.drive_brake,
+                         setup=self.arm_in_manual,
+                         teardown=self.disarm_vehicle),
+            # do not move this to be the first test.  MAVProxy's dedupe
+            # function may bite you.
+            AutoTestCase("GetBanner",
+                         "Get banner",
+                         self.do_get_banner),
+            AutoTestCase("GetCapabilities",
+                         "Get autopilot capabilities",
+                         self.do_get_autopilot_capabilities),
+            AutoTestCase("SetModeViaCommandLong",
+                         "Set mode via MAV_COMMAND_DO_SET_MODE",
+                         self.do_set_mode_via_command_long),
+        ]
+
     def autotest(self):
         """Autotest APMrover2 in SITL."""
         if not self.hasInit:
@@ -531,67 +550,8 @@ class AutoTestRover(AutoTest):
         try:
             self.progress("Waiting for a heartbeat with mavlink protocol %s" %
                           self.mav.WIRE_PROTOCOL_VERSION)
-            self.mav.wait_heartbeat()
-            self.progress("Setting up RC parameters")
-            self.set_rc_default()
-            self.set_rc(8, 1800)
-            self.progress("Waiting for GPS fix")
-            self.mav.wait_gps_fix()
-            self.homeloc = self.mav.location()
-            self.progress("Home location: %s" % self.homeloc)
-            self.mavproxy.send('switch 6\n')  # Manual mode
-            self.wait_mode('MANUAL')
-            self.progress("Waiting reading for arm")
-            self.wait_ready_to_arm()
-            if not self.arm_vehicle():
-                self.progress("Failed to ARM")
-                failed = True
-
-            self.progress("#")
-            self.progress("########## Drive an RTL mission  ##########")
-            self.progress("#")
-            # Drive a square in learning mode
-            # self.reset_and_arm()
-            if not self.drive_rtl_mission():
-                self.progress("Failed RTL mission")
-                failed = True
-
-            self.progress("#")
-            self.progress("########## Drive a square and save WPs with CH7"
-                          "switch  ##########")
-            self.progress("#")
-            # Drive a square in learning mode
-            # self.reset_and_arm()
-            if not self.drive_square():
-                self.progress("Failed drive square")
-                failed = True
-
-            if not self.drive_mission(os.path.join(testdir, "rover1.txt")):
-                self.progress("Failed mission")
-                failed = True
-
-            if not self.drive_brake():
-                self.progress("Failed brake")
-                failed = True
-
-            if not self.disarm_vehicle():
-                self.progress("Failed to DISARM")
-                failed = True
-
-            # do not move this to be the first test.  MAVProxy's dedupe
-            # function may bite you.
-            self.progress("Getting banner")
-            if not self.do_get_banner():
-                self.progress("FAILED: get banner")
-                failed = True
-
-            self.progress("Getting autopilot capabilities")
-            if not self.do_get_autopilot_capabilities():
-                self.progress("FAILED: get capabilities")
-                failed = True
-
-            self.progress("Setting mode via MAV_COMMAND_DO_SET_MODE")
-            if not self.do_set_mode_via_command_long():
+            if not self.run_test_cases(self.test_cases(),
+                                       boot=self.boot_setup):
                 failed = True
 
             # Throttle Failsafe
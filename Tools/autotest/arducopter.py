@@ -10,9 +10,9 @@ import pexpect
 from pymavlink import mavutil
 
 from pysim import util
-from pysim import vehicleinfo
 
 from common import AutoTest
+from common import AutoTestCase
 
 # get location of scripts
 testdir = os.path.dirname(os.path.realpath(__file__))
@@ -34,14 +34,14 @@ class AutoTestCopter(AutoTest):
                  use_map=False,
                  valgrind=False,
                  gdb=False,
-                 speedup=10,
+                 speedup=None,
                  frame=None,
                  params=None,
-                 gdbserver=False):
-        super(AutoTestCopter, self).__init__()
+                 gdbserver=False,
+                 instance=0):
+        super(AutoTestCopter, self).__init__(instance=instance)
         self.binary = binary
-        self.options = ('--sitl=127.0.0.1:5501 '
-                        ' --out=127.0.0.1:19550 '
+        self.options = (self.mavproxy_options() +
                         ' --streamrate=5')
         self.viewerip = viewerip
         self.use_map = use_map
@@ -85,42 +85,16 @@ class AutoTestCopter(AutoTest):
         if self.use_map:
             self.options += ' --map'
 
-        self.sitl = util.start_SITL(self.binary,
-                                    wipe=True,
-                                    model=self.frame,
-                                    home=self.home,
-                                    speedup=self.speedup_default)
-        self.mavproxy = util.start_MAVProxy_SITL('ArduCopter')
-
-        self.progress("WAITING FOR PARAMETERS")
-        self.mavproxy.expect('Received [0-9]+ parameters')
-
-        # setup test parameters
-        vinfo = vehicleinfo.VehicleInfo()
-        if self.params is None:
-            frames = vinfo.options["ArduCopter"]["frames"]
-            self.params = frames[self.frame]["default_params_filename"]
-        if not isinstance(self.params, list):
-            self.params = [self.params]
-        for x in self.params:
-            self.mavproxy.send("param load %s\n" % os.path.join(testdir, x))
-            self.mavproxy.expect('Loaded [0-9]+ parameters')
-        self.set_parameter('LOG_REPLAY', 1)
-        self.set_parameter('LOG_DISARMED', 1)
-        self.progress("RELOADING SITL WITH NEW PARAMETERS")
-
-        # restart with new parms
-        util.pexpect_close(self.mavproxy)
-        util.pexpect_close(self.sitl)
-
-        self.sitl = util.start_SITL(self.binary,
-                                    model=self.frame,
-                                    home=self.home,
-                                    speedup=self.speedup,
-                                    valgrind=self.valgrind,
-                                    gdb=self.gdb,
-                                    gdbserver=self.gdbserver)
+        self.start_SITL(wipe=True,
+                        model=self.frame,
+                        home=self.home,
+                        defaults_file=self.sitl_defaults_file(
+                            "ArduCopter"),
+                        valgrind=self.valgrind,
+                        gdb=self.gdb,
+                        gdbserver=self.gdbserver)
         self.mavproxy = util.start_MAVProxy_SITL('ArduCopter',
+                                                 master=self.mavproxy_master(),
                                                  options=self.options)
         self.mavproxy.expect('Telemetry log: (\S+)')
         self.logfile = self.mavproxy.match.group(1)
@@ -148,17 +122,7 @@ class AutoTestCopter(AutoTest):
 
         self.progress("Started simulator")
 
-        # get a mavlink connection going
-        connection_string = '127.0.0.1:19550'
-        try:
-            self.mav = mavutil.mavlink_connection(connection_string,
-                                                  robust_parsing=True)
-        except Exception as msg:
-            self.progress("Failed to start mavlink connection on %s: %s" %
-                          (connection_string, msg,))
-            raise
-        self.mav.message_hooks.append(self.message_hook)
-        self.mav.idle_hooks.append(self.idle_hook)
+        self.start_mavlink_connection()
         self.hasInit = True
         self.progress("Ready to start testing!")
 
@@ -167,7 +131,7 @@ class AutoTestCopter(AutoTest):
             self.mavproxy.send("module unload map\n")
             self.mavproxy.expect("Unloaded module map")
 
-        self.mav.close()
+        self.stop_mavlink_connection()
         util.pexpect_close(self.mavproxy)
         util.pexpect_close(self.sitl)
 
@@ -210,6 +174,19 @@ class AutoTestCopter(AutoTest):
         self.set_rc(3, hover_throttle)
         return True
 
+    def ready_on_ground(self):
+        """Arm in STABILIZE with the throttle down."""
+        self.set_rc_default()
+        self.set_rc(3, 1000)
+        self.mavproxy.send('switch 6\n')  # stabilize mode
+        self.wait_mode('STABILIZE')
+        self.wait_ready_to_arm()
+        return self.arm_vehicle()
+
+    def hover_over_home(self, alt=10):
+        """Arm in STABILIZE and take off to hover at alt over HOME."""
+        return self.ready_on_ground() and self.takeoff(alt)
+
     # loiter - fly south west, then loiter within 5m position and altitude
     def loiter(self, holdtime=10, maxaltchange=5, maxdistchange=5):
         """Hold loiter position."""
@@ -637,9 +614,9 @@ class AutoTestCopter(AutoTest):
         self.wait_mode('LOITER')
 
         # enable fence, disable avoidance
-        self.set_parameter('FENCE_ENABLE', 1)
-        self.set_parameter('AVOID_ENABLE', 0)
-        self.set_parameter('FENCE_TYPE', 1)
+        self.set_parameters({'FENCE_ENABLE': 1,
+                             'AVOID_ENABLE': 0,
+                             'FENCE_TYPE': 1})
 
         if not self.change_alt(10):
             failed_test_msg = "change_alt climb failed"
@@ -755,6 +732,8 @@ class AutoTestCopter(AutoTest):
 
         # record position for 30 seconds
         while tnow < tstart + timeout:
+            # get_sim_time doesn't block, so wait for it to move on
+            self.wait_message(lambda m: True, 'SYSTEM_TIME')
             tnow = self.get_sim_time()
             desired_glitch_num = int((tnow - tstart) * 2.2)
             if desired_glitch_num > glitch_current and glitch_current != -1:
@@ -865,6 +844,8 @@ class AutoTestCopter(AutoTest):
 
         # record position for 30 seconds
         while glitch_current < glitch_num:
+            # get_sim_time doesn't block, so wait for it to move on
+            self.wait_message(lambda m: True, 'SYSTEM_TIME')
             tnow = self.get_sim_time()
             desired_glitch_num = int((tnow - tstart) * 2.2)
             if desired_glitch_num > glitch_current and glitch_current != -1:
@@ -1145,6 +1126,105 @@ class AutoTestCopter(AutoTest):
         self.wait_mode('LOITER')
         return ret
 
+    def fly_square_and_mission(self):
+        """Fly a square saving WPs with CH7, then fly them as a mission."""
+        if not self.fly_square():
+            self.progress("fly_square failed")
+            return False
+
+        # save the stored mission to file
+        self.progress("# Save out the CH7 mission to file")
+        global num_wp
+        num_wp = self.save_mission_to_file(os.path.join(testdir,
+                                                        "ch7_mission.txt"))
+        if not num_wp:
+            self.progress("save_mission_to_file failed")
+            return False
+
+        # fly the stored mission
+        self.progress("# Fly CH7 saved mission")
+        return self.fly_mission(height_accuracy=0.5, target_altitude=10)
+
+    def fly_alt_change(self):
+        """Loiter, then climb to 30m and descend to 20m in loiter."""
+        return (self.loiter() and
+                self.change_alt(30) and
+                self.change_alt(20))
+
+    def boot_setup(self):
+        """Wait for a newly started vehicle to know where it is."""
+        self.mav.wait_heartbeat()
+        self.homeloc = self.mav.location()
+        self.progress("Home location: %s" % self.homeloc)
+        return True
+
+    def test_cases(self):
+        """Return the test cases autotest runs, in order. Each leaves the
+        vehicle where the next one starts from; most take off themselves,
+        so need only an armed vehicle on the ground to start from."""
+        def then_rtl(function):
+            return lambda: function() and self.fly_RTL()
+
+        def takeoff_then(function):
+            return lambda: self.takeoff(10) and function()
+
+        return [
+            AutoTestCase("FlySquare",
+                         "Fly a square and save WPs with CH7 switch",
+                         self.fly_square_and_mission,
+                         setup=self.hover_over_home),
+            AutoTestCase("ThrottleFailsafe",
+                         "Test Failsafe",
+                         self.fly_throttle_failsafe,
+                         setup=self.hover_over_home),
+            AutoTestCase("BatteryFailsafe",
+                         "Test Battery Failsafe",
+                         takeoff_then(self.fly_battery_failsafe),
+                         setup=self.ready_on_ground),
+            AutoTestCase("StabilityPatch",
+                         "Test Stability Patch",
+                         takeoff_then(then_rtl(
+                             lambda: self.fly_stability_patch(30))),
+                         setup=self.ready_on_ground),
+            AutoTestCase("HorizontalFence",
+                         "Test Horizontal Fence",
+                         takeoff_then(lambda: self.fly_fence_test(180)),
+                         setup=self.ready_on_ground),
+            AutoTestCase("MaxAltFence",
+                         "Test Max Alt Fence",
+                         lambda: self.fly_alt_max_fence_test(180),
+                         setup=self.ready_on_ground),
+            AutoTestCase("GPSGlitchLoiter",
+                         "GPS Glitch Loiter Test",
+                         takeoff_then(then_rtl(
+                             self.fly_gps_glitch_loiter_test)),
+                         setup=self.ready_on_ground),
+            AutoTestCase("GPSGlitchAuto",
+                         "GPS Glitch Auto Test",
+                         self.fly_gps_glitch_auto_test,
+                         setup=self.ready_on_ground),
+            AutoTestCase("LoiterAltChange",
+                         "Test Loiter for 10 seconds, climb and descend",
+                         takeoff_then(then_rtl(self.fly_alt_change)),
+                         setup=self.ready_on_ground),
+            AutoTestCase("Simple",
+                         "Fly in SIMPLE mode",
+                         takeoff_then(then_rtl(self.fly_simple)),
+                         setup=self.ready_on_ground),
+            AutoTestCase("SuperSimple",
+                         "Fly a circle in SUPER SIMPLE mode",
+                         takeoff_then(then_rtl(self.fly_super_simple)),
+                         setup=self.ready_on_ground),
+            AutoTestCase("Circle",
+                         "Fly CIRCLE mode",
+                         takeoff_then(then_rtl(self.fly_circle)),
+                         setup=self.ready_on_ground),
+            AutoTestCase("AutoMission",
+                         "Fly copter mission",
+                         self.fly_auto_test,
+                         setup=self.ready_on_ground),
+        ]
+
     def autotest(self):
         """Autotest ArduCopter in SITL."""
         self.frame = '+'
@@ -1157,277 +1237,11 @@ class AutoTestCopter(AutoTest):
         try:
             self.progress("Waiting for a heartbeat with mavlink protocol %s"
                           % self.mav.WIRE_PROTOCOL_VERSION)
-            self.mav.wait_heartbeat()
-            self.progress("Setting up RC parameters")
-            self.set_rc_default()
-            self.set_rc(3, 1000)
-            self.homeloc = self.mav.location()
-            self.progress("Home location: %s" % self.homeloc)
-            self.mavproxy.send('switch 6\n')  # stabilize mode
-            self.mav.wait_heartbeat()
-            self.wait_mode('STABILIZE')
-            self.progress("Waiting reading for arm")
-            self.wait_ready_to_arm()
-
-            # Arm
-            self.progress("# Arm motors")
-            if not self.arm_vehicle():
-                failed_test_msg = "arm_motors failed"
-                self.progress(failed_test_msg)
-                failed = True
-
-            self.progress("# Takeoff")
-            if not self.takeoff(10):
-                failed_test_msg = "takeoff failed"
-                self.progress(failed_test_msg)
-                failed = True
-
-            # Fly a square in Stabilize mode
-            self.progress("#")
-            self.progress("########## Fly a square and save WPs with CH7"
-                          " switch ##########")
-            self.progress("#")
-            if not self.fly_square():
-                failed_test_msg = "fly_square failed"
-                self.progress(failed_test_msg)
-                failed = True
-
-            # save the stored mission to file
-            self.progress("# Save out the CH7 mission to file")
-            global num_wp
-            num_wp = self.save_mission_to_file(os.path.join(testdir,
-                                                            "ch7_mission.txt"))
-            if not num_wp:
-                failed_test_msg = "save_mission_to_file failed"
-                self.progress(failed_test_msg)
-                failed = True
-
-            # fly the stored mission
-            self.progress("# Fly CH7 saved mission")
-            if not self.fly_mission(height_accuracy=0.5, target_altitude=10):
-                failed_test_msg = "fly ch7_mission failed"
-                self.progress(failed_test_msg)
-                failed = True
-
-            # Throttle Failsafe
-            self.progress("#")
-            self.progress("########## Test Failsafe ##########")
-            self.progress("#")
-            if not self.fly_throttle_failsafe():
-                failed_test_msg = "fly_throttle_failsafe failed"
-                self.progress(failed_test_msg)
-                failed = True
-
-            # Takeoff
-            self.progress("# Takeoff")
-            if not self.takeoff(10):
-                failed_test_msg = "takeoff failed"
-                self.progress(failed_test_msg)
-                failed = True
-
-            # Battery failsafe
-            if not self.fly_battery_failsafe():
-                failed_test_msg = "fly_battery_failsafe failed"
-                self.progress(failed_test_msg)
-                failed = True
-
-            # Takeoff
-            self.progress("# Takeoff")
-            if not self.takeoff(10):
-                failed_test_msg = "takeoff failed"
-                self.progress(failed_test_msg)
-                failed = True
-
-            # Stability patch
-            self.progress("#")
-            self.progress("########## Test Stability Patch ##########")
-            self.progress("#")
-            if not self.fly_stability_patch(30):
-                failed_test_msg = "fly_stability_patch failed"
-                self.progress(failed_test_msg)
-                failed = True
-
-            # RTL
-            self.progress("# RTL #")
-            if not self.fly_RTL():
-                failed_test_msg = "fly_RTL after stab patch failed"
-                self.progress(failed_test_msg)
-                failed = True
-
-            # Takeoff
-            self.progress("# Takeoff")
-            if not self.takeoff(10):
-                failed_test_msg = "takeoff failed"
-                self.progress(failed_test_msg)
-                failed = True
-
-            # Fence test
-            self.progress("#")
-            self.progress("########## Test Horizontal Fence ##########")
-            self.progress("#")
-            if not self.fly_fence_test(180):
-                failed_test_msg = "fly_fence_test failed"
-                self.progress(failed_test_msg)
-                failed = True
-
-            # Fence test
-            self.progress("#")
-            self.progress("########## Test Max Alt Fence ##########")
-            self.progress("#")
-            if not self.fly_alt_max_fence_test(180):
-                failed_test_msg = "fly_alt_max_fence_test failed"
-                self.progress(failed_test_msg)
-                failed = True
-
-            # Takeoff
-            self.progress("# Takeoff")
-            if not self.takeoff(10):
-                failed_test_msg = "takeoff failed"
-                self.progress(failed_test_msg)
-                failed = True
-
-            # Fly GPS Glitch Loiter test
-            self.progress("# GPS Glitch Loiter Test")
-            if not self.fly_gps_glitch_loiter_test():
-                failed_test_msg = "fly_gps_glitch_loiter_test failed"
-                self.progress(failed_test_msg)
+            if not self.run_test_cases(self.test_cases(),
+                                       boot=self.boot_setup):
+                failed_test_msg = "test cases failed"
                 failed = True
 
-            # RTL after GPS Glitch Loiter test
-            self.progress("# RTL #")
-            if not self.fly_RTL():
-                failed_test_msg = "fly_RTL failed"
-                self.progress(failed_test_msg)
-                failed = True
-
-            # Fly GPS Glitch test in auto mode
-            self.progress("# GPS Glitch Auto Test")
-            if not self.fly_gps_glitch_auto_test():
-                failed_test_msg = "fly_gps_glitch_auto_test failed"
-                self.progress(failed_test_msg)
-                failed = True
-
-            # take-off ahead of next test
-            self.progress("# Takeoff")
-            if not self.takeoff(10):
-                failed_test_msg = "takeoff failed"
-                self.progress(failed_test_msg)
-                failed = True
-
-            # Loiter for 10 seconds
-            self.progress("#")
-            self.progress("########## Test Loiter for 10 seconds ##########")
-            self.progress("#")
-            if not self.loiter():
-                failed_test_msg = "loiter failed"
-                self.progress(failed_test_msg)
-                failed = True
-
-            # Loiter Climb
-            self.progress("#")
-            self.progress("# Loiter - climb to 30m")
-            self.progress("#")
-            if not self.change_alt(30):
-                failed_test_msg = "change_alt climb failed"
-                self.progress(failed_test_msg)
-                failed = True
-
-            # Loiter Descend
-            self.progress("#")
-            self.progress("# Loiter - descend to 20m")
-            self.progress("#")
-            if not self.change_alt(20):
-                failed_test_msg = "change_alt descend failed"
-                self.progress(failed_test_msg)
-                failed = True
-
-            # RTL
-            self.progress("#")
-            self.progress("########## Test RTL ##########")
-            self.progress("#")
-            if not self.fly_RTL():
-                failed_test_msg = "fly_RTL after Loiter climb/descend failed"
-                self.progress(failed_test_msg)
-                failed = True
-
-            # Takeoff
-            self.progress("# Takeoff")
-            if not self.takeoff(10):
-                failed_test_msg = "takeoff failed"
-                self.progress(failed_test_msg)
-                failed = True
-
-            # Simple mode
-            self.progress("# Fly in SIMPLE mode")
-            if not self.fly_simple():
-                failed_test_msg = "fly_simple failed"
-                self.progress(failed_test_msg)
-                failed = True
-
-            # RTL
-            self.progress("#")
-            self.progress("########## Test RTL ##########")
-            self.progress("#")
-            if not self.fly_RTL():
-                failed_test_msg = "fly_RTL after simple mode failed"
-                self.progress(failed_test_msg)
-                failed = True
-
-            # Takeoff
-            self.progress("# Takeoff")
-            if not self.takeoff(10):
-                failed_test_msg = "takeoff failed"
-                self.progress(failed_test_msg)
-                failed = True
-
-            # Fly a circle in super simple mode
-            self.progress("# Fly a circle in SUPER SIMPLE mode")
-            if not self.fly_super_simple():
-                failed_test_msg = "fly_super_simple failed"
-                self.progress(failed_test_msg)
-                failed = True
-
-            # RTL
-            self.progress("# RTL #")
-            if not self.fly_RTL():
-                failed_test_msg = "fly_RTL after super simple mode failed"
-                self.progress(failed_test_msg)
-                failed = True
-
-            # Takeoff
-            self.progress("# Takeoff")
-            if not self.takeoff(10):
-                failed_test_msg = "takeoff failed"
-                self.progress(failed_test_msg)
-                failed = True
-
-            # Circle mode
-            self.progress("# Fly CIRCLE mode")
-            if not self.fly_circle():
-                failed_test_msg = "fly_circle failed"
-                self.progress(failed_test_msg)
-                failed = True
-
-            # RTL
-            self.progress("#")
-            self.progress("########## Test RTL ##########")
-            self.progress("#")
-            if not self.fly_RTL():
-                failed_test_msg = "fly_RTL after circle failed"
-                self.progress(failed_test_msg)
-                failed = True
-
-            self.progress("# Fly copter mission")
-            if not self.fly_auto_test():
-                failed_test_msg = "fly_auto_test failed"
-                self.progress(failed_test_msg)
-                failed = True
-            else:
-                self.progress("Flew copter mission OK")
-
-            # wait for disarm
-            self.mav.motors_disarmed_wait()
-
             log_filepath = util.reltopdir("../buildlogs/ArduCopter-log.bin")
             if not self.log_download(log_filepath):
                 failed_test_msg = "log_download failed"
@@ -1445,6 +1259,35 @@ class AutoTestCopter(AutoTest):
             return False
         return True
 
+    def heli_ready_to_fly(self):
+        """Arm in STABILIZE with the rotor spun up."""
+        self.set_rc_default()
+        self.set_rc(3, 1000)
+        self.progress("Lowering rotor speed")
+        self.set_rc(8, 1000)
+        self.mavproxy.send('switch 6\n')  # stabilize mode
+        self.wait_mode('STABILIZE')
+        self.wait_ready_to_arm()
+        if not self.arm_vehicle():
+            return False
+        self.progress("Raising rotor speed")
+        self.set_rc(8, 2000)
+        return True
+
+    def heli_lower_rotor_speed(self):
+        self.progress("Lowering rotor speed")
+        self.set_rc(8, 1000)
+
+    def test_cases_heli(self):
+        """Return the test cases autotest_heli runs, in order."""
+        return [
+            AutoTestCase("AVCMission",
+                         "Fly AVC mission",
+                         self.fly_avc_test,
+                         setup=self.heli_ready_to_fly,
+                         teardown=self.heli_lower_rotor_speed),
+        ]
+
     def autotest_heli(self):
         """Autotest Helicopter in SITL with AVC2013 mission."""
         self.frame = 'heli'
@@ -1455,37 +1298,10 @@ class AutoTestCopter(AutoTest):
         failed_test_msg = "None"
 
         try:
-            self.mav.wait_heartbeat()
-            self.set_rc_default()
-            self.set_rc(3, 1000)
-            self.homeloc = self.mav.location()
-
-            self.progress("Lowering rotor speed")
-            self.set_rc(8, 1000)
-            self.mavproxy.send('switch 6\n')  # stabilize mode
-            self.wait_mode('STABILIZE')
-            self.wait_ready_to_arm()
-
-            # Arm
-            self.progress("# Arm motors")
-            if not self.arm_vehicle():
-                failed_test_msg = "arm_motors failed"
-                self.progress(failed_test_msg)
-                failed = True
-
-            self.progress("Raising rotor speed")
-            self.set_rc(8, 2000)
-
-            self.progress("# Fly AVC mission")
-            if not self.fly_avc_test():
-                failed_test_msg = "fly_avc_test failed"
-                self.progress(failed_test_msg)
+            if not self.run_test_cases(self.test_cases_heli(),
+                                       boot=self.boot_setup):
+                failed_test_msg = "test cases failed"
                 failed = True
-            else:
-                self.progress("Flew AVC mission OK")
-
-            self.progress("Lowering rotor speed")
-            self.set_rc(8, 1000)
 
             # mission ends with disarm so should be ok to download logs now
             log_path = util.reltopdir("../buildlogs/Helicopter-log.bin")
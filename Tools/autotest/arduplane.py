@@ -12,6 +12,7 @@ from pymavlink import mavutil
 from pysim import util
 
 from common import AutoTest
+from common import AutoTestCase
 
 # get location of scripts
 testdir = os.path.dirname(os.path.realpath(__file__))
@@ -26,13 +27,14 @@ class AutoTestPlane(AutoTest):
                  use_map=False,
                  valgrind=False,
                  gdb=False,
-                 speedup=10,
+                 speedup=None,
                  frame=None,
                  params=None,
-                 gdbserver=False):
-        super(AutoTestPlane, self).__init__()
+                 gdbserver=False,
+                 instance=0):
+        super(AutoTestPlane, self).__init__(instance=instance)
         self.binary = binary
-        self.options = ('--sitl=127.0.0.1:5501 --out=127.0.0.1:19550'
+        self.options = (self.mavproxy_options() +
                         ' --streamrate=10')
         self.viewerip = viewerip
         self.use_map = use_map
@@ -64,16 +66,15 @@ class AutoTestPlane(AutoTest):
 
         defaults_file = os.path.join(testdir,
                                      'default_params/plane-jsbsim.parm')
-        self.sitl = util.start_SITL(self.binary,
-                                    wipe=True,
-                                    model=self.frame,
-                                    home=self.home,
-                                    speedup=self.speedup,
-                                    defaults_file=defaults_file,
-                                    valgrind=self.valgrind,
-                                    gdb=self.gdb,
-                                    gdbserver=self.gdbserver)
+        self.start_SITL(wipe=True,
+                        model=self.frame,
+                        home=self.home,
+                        defaults_file=defaults_file,
+                        valgrind=self.valgrind,
+                        gdb=self.gdb,
+                        gdbserver=self.gdbserver)
         self.mavproxy = util.start_MAVProxy_SITL('ArduPlane',
+                                                 master=self.mavproxy_master(),
                                                  options=self.options)
         self.mavproxy.expect('Telemetry log: (\S+)')
         logfile = self.mavproxy.match.group(1)
@@ -97,17 +98,7 @@ class AutoTestPlane(AutoTest):
 
         self.progress("Started simulator")
 
-        # get a mavlink connection going
-        connection_string = '127.0.0.1:19550'
-        try:
-            self.mav = mavutil.mavlink_connection(connection_string,
-                                                  robust_parsing=True)
-        except Exception as msg:
-            self.progress("Failed to start mavlink connection on %s: %s"
-                          % (connection_string, msg))
-            raise
-        self.mav.message_hooks.append(self.message_hook)
-        self.mav.idle_hooks.append(self.idle_hook)
+        self.start_mavlink_connection()
         self.hasInit = True
         self.progress("Ready to start testing!")
 
@@ -116,7 +107,7 @@ class AutoTestPlane(AutoTest):
             self.mavproxy.send("module unload map\n")
             self.mavproxy.expect("Unloaded module map")
 
-        self.mav.close()
+        self.stop_mavlink_connection()
         util.pexpect_close(self.mavproxy)
         util.pexpect_close(self.sitl)
 
@@ -528,92 +519,101 @@ class AutoTestPlane(AutoTest):
         self.progress("Mission OK")
         return True
 
+    def boot_setup(self):
+        """Wait for a newly started vehicle to know where it is."""
+        self.mav.wait_heartbeat()
+        self.progress("Setting up RC parameters")
+        self.set_rc_default()
+        self.set_rc(3, 1000)
+        self.set_rc(8, 1800)
+        self.progress("Waiting for GPS fix")
+        self.mav.recv_match(condition='VFR_HUD.alt>10', blocking=True)
+        self.mav.wait_gps_fix()
+        while self.mav.location().alt < 10:
+            self.mav.wait_gps_fix()
+        self.homeloc = self.mav.location()
+        self.progress("Home location: %s" % self.homeloc)
+        return True
+
+    def test_cases(self):
+        """Return the test cases autotest runs, in order. All but the first
+        start in the air, so take off for setup."""
+        return [
+            AutoTestCase("TakeOff",
+                         "Takeoff",
+                         self.takeoff),
+            AutoTestCase("LeftCircuit",
+                         "Fly left circuit",
+                         self.fly_left_circuit,
+                         setup=self.takeoff),
+            AutoTestCase("LeftRoll",
+                         "Fly left roll",
+                         lambda: self.axial_left_roll(1),
+                         setup=self.takeoff),
+            AutoTestCase("InsideLoop",
+                         "Fly inside loop",
+                         self.inside_loop,
+                         setup=self.takeoff),
+            AutoTestCase("Stabilize",
+                         "Test stabilize",
+                         self.test_stabilize,
+                         setup=self.takeoff),
+            AutoTestCase("ACRO",
+                         "Test ACRO",
+                         self.test_acro,
+                         setup=self.takeoff),
+            AutoTestCase("FBWB",
+                         "Test FBWB",
+                         self.test_FBWB,
+                         setup=self.takeoff),
+            AutoTestCase("CRUISE",
+                         "Test CRUISE",
+                         lambda: self.test_FBWB(mode='CRUISE'),
+                         setup=self.takeoff),
+            AutoTestCase("RTL",
+                         "Fly RTL",
+                         self.fly_RTL,
+                         setup=self.takeoff),
+            AutoTestCase("LOITER",
+                         "Fly LOITER",
+                         self.fly_LOITER,
+                         setup=self.takeoff),
+            AutoTestCase("CIRCLE",
+                         "Fly CIRCLE",
+                         self.fly_CIRCLE,
+                         setup=self.takeoff),
+            AutoTestCase("Mission",
+                         "Fly ap1.txt mission",
+                         lambda: self.fly_mission(
+                             os.path.join(testdir, "ap1.txt"),
+                             height_accuracy=10,
+                             target_altitude=self.homeloc.alt+100),
+                         setup=self.takeoff),
+        ]
+
     def autotest(self):
         """Autotest ArduPlane in SITL."""
         if not self.hasInit:
             self.init()
 
         failed = False
-        fail_list = []
         e = 'None'
         try:
             self.progress("Waiting for a heartbeat with mavlink protocol %s"
                           % self.mav.WIRE_PROTOCOL_VERSION)
-            self.mav.wait_heartbeat()
-            self.progress("Setting up RC parameters")
-            self.set_rc_default()
-            self.set_rc(3, 1000)
-            self.set_rc(8, 1800)
-            self.progress("Waiting for GPS fix")
-            self.mav.recv_match(condition='VFR_HUD.alt>10', blocking=True)
-            self.mav.wait_gps_fix()
-            while self.mav.location().alt < 10:
-                self.mav.wait_gps_fix()
-            self.homeloc = self.mav.location()
-            self.progress("Home location: %s" % self.homeloc)
-            if not self.takeoff():
-                self.progress("Failed takeoff")
-                failed = True
-                fail_list.append("takeoff")
-            if not self.fly_left_circuit():
-                self.progress("Failed left circuit")
-                failed = True
-                fail_list.append("left_circuit")
-            if not self.axial_left_roll(1):
-                self.progress("Failed left roll")
-                failed = True
-                fail_list.append("left_roll")
-            if not self.inside_loop():
-                self.progress("Failed inside loop")
-                failed = True
-                fail_list.append("inside_loop")
-            if not self.test_stabilize():
-                self.progress("Failed stabilize test")
-                failed = True
-                fail_list.append("stabilize")
-            if not self.test_acro():
-                self.progress("Failed ACRO test")
-                failed = True
-                fail_list.append("acro")
-            if not self.test_FBWB():
-                self.progress("Failed FBWB test")
-                failed = True
-                fail_list.append("fbwb")
-            if not self.test_FBWB(mode='CRUISE'):
-                self.progress("Failed CRUISE test")
-                failed = True
-                fail_list.append("cruise")
-            if not self.fly_RTL():
-                self.progress("Failed RTL")
-                failed = True
-                fail_list.append("RTL")
-            if not self.fly_LOITER():
-                self.progress("Failed LOITER")
-                failed = True
-                fail_list.append("LOITER")
-            if not self.fly_CIRCLE():
-                self.progress("Failed CIRCLE")
-                failed = True
-                fail_list.append("LOITER")
-            if not self.fly_mission(os.path.join(testdir, "ap1.txt"),
-                                    height_accuracy=10,
-                                    target_altitude=self.homeloc.alt+100):
-                self.progress("Failed mission")
+            if not self.run_test_cases(self.test_cases(),
+                                       boot=self.boot_setup):
                 failed = True
-                fail_list.append("mission")
             if not self.log_download(self.buildlogs_path("ArduPlane-log.bin")):
                 self.progress("Failed log download")
                 failed = True
-                fail_list.append("log_download")
         except pexpect.TIMEOUT as e:
             self.progress("Failed with timeout")
             failed = True
-            fail_list.append("timeout")
 
         self.close()
 
         if failed:
             self.progress("FAILED: %s" % e)
-            self.progress("Fail list: %s" % fail_list)
             return False
         return True
@@ -9,9 +9,9 @@ import pexpect
 from pymavlink import mavutil
 
 from pysim import util
-from pysim import vehicleinfo
 
 from common import AutoTest
+from common import AutoTestCase
 
 # get location of scripts
 testdir = os.path.dirname(os.path.realpath(__file__))
@@ -25,13 +25,14 @@ class AutoTestSub(AutoTest):
                  use_map=False,
                  valgrind=False,
                  gdb=False,
-                 speedup=10,
+                 speedup=None,
                  frame=None,
                  params=None,
-                 gdbserver=False):
-        super(AutoTestSub, self).__init__()
+                 gdbserver=False,
+                 instance=0):
+        super(AutoTestSub, self).__init__(instance=instance)
         self.binary = binary
-        self.options = ('--sitl=127.0.0.1:5501 --out=127.0.0.1:19550'
+        self.options = (self.mavproxy_options() +
                         ' --streamrate=10')
         self.viewerip = viewerip
         self.use_map = use_map
@@ -61,42 +62,16 @@ class AutoTestSub(AutoTest):
         if self.use_map:
             self.options += ' --map'
 
-        self.sitl = util.start_SITL(self.binary,
-                                    wipe=True,
-                                    model=self.frame,
-                                    home=self.home,
-                                    speedup=self.speedup_default)
-        self.mavproxy = util.start_MAVProxy_SITL('ArduSub')
-
-        self.progress("WAITING FOR PARAMETERS")
-        self.mavproxy.expect('Received [0-9]+ parameters')
-
-        # setup test parameters
-        vinfo = vehicleinfo.VehicleInfo()
-        if self.params is None:
-            frames = vinfo.options["ArduSub"]["frames"]
-            self.params = frames[self.frame]["default_params_filename"]
-        if not isinstance(self.params, list):
-            self.params = [self.params]
-        for x in self.params:
-            self.mavproxy.send("param load %s\n" % os.path.join(testdir, x))
-            self.mavproxy.expect('Loaded [0-9]+ parameters')
-        self.set_parameter('LOG_REPLAY', 1)
-        self.set_parameter('LOG_DISARMED', 1)
-        self.progress("RELOADING SITL WITH NEW PARAMETERS")
-
-        # restart with new parms
-        util.pexpect_close(self.mavproxy)
-        util.pexpect_close(self.sitl)
-
-        self.sitl = util.start_SITL(self.binary,
-                                    model=self.frame,
-                                    home=self.home,
-                                    speedup=self.speedup,
-                                    valgrind=self.valgrind,
-                                    gdb=self.gdb,
-                                    gdbserver=self.gdbserver)
+        self.start_SITL(wipe=True,
+                        model=self.frame,
+                        home=self.home,
+                        defaults_file=self.sitl_defaults_file(
+                            "ArduSub"),
+                        valgrind=self.valgrind,
+                        gdb=self.gdb,
+                        gdbserver=self.gdbserver)
         self.mavproxy = util.start_MAVProxy_SITL('ArduSub',
+                                                 master=self.mavproxy_master(),
                                                  options=self.options)
         self.mavproxy.expect('Telemetry log: (\S+)')
         logfile = self.mavproxy.match.group(1)
@@ -120,17 +95,7 @@ class AutoTestSub(AutoTest):
 
         self.progress("Started simulator")
 
-        # get a mavlink connection going
-        connection_string = '127.0.0.1:19550'
-        try:
-            self.mav = mavutil.mavlink_connection(connection_string,
-                                                  robust_parsing=True)
-        except Exception as msg:
-            self.progress("Failed to start mavlink connection on %s: %s" %
-                          (connection_string, msg,))
-            raise
-        self.mav.message_hooks.append(self.message_hook)
-        self.mav.idle_hooks.append(self.idle_hook)
+        self.start_mavlink_connection()
         self.hasInit = True
         self.progress("Ready to start testing!")
 
@@ -139,7 +104,7 @@ class AutoTestSub(AutoTest):
             self.mavproxy.send("module unload map\n")
             self.mavproxy.expect("Unloaded module map")
 
-        self.mav.close()
+        self.stop_mavlink_connection()
         util.pexpect_close(self.mavproxy)
         util.pexpect_close(self.sitl)
 
@@ -210,6 +175,38 @@ class AutoTestSub(AutoTest):
         self.progress("Mission OK")
         return True
 
+    def boot_setup(self):
+        """Wait for a newly started vehicle to know where it is."""
+        self.mav.wait_heartbeat()
+        self.mavproxy.send('param set FS_GCS_ENABLE 0\n')
+        self.progress("Waiting for GPS fix")
+        self.mav.wait_gps_fix()
+
+        # wait for EKF and GPS checks to pass
+        self.mavproxy.expect('IMU0 is using GPS')
+
+        self.homeloc = self.mav.location()
+        self.progress("Home location: %s" % self.homeloc)
+        return True
+
+    def arm_with_rc_default(self):
+        self.set_rc_default()
+        return self.arm_vehicle()
+
+    def test_cases(self):
+        """Return the test cases autotest runs, in order."""
+        return [
+            AutoTestCase("DiveManual",
+                         "Dive in manual",
+                         self.dive_manual,
+                         setup=self.arm_with_rc_default),
+            AutoTestCase("DiveMission",
+                         "Dive sub_mission.txt mission",
+                         lambda: self.dive_mission(
+                             os.path.join(testdir, "sub_mission.txt")),
+                         setup=self.arm_with_rc_default),
+        ]
+
     def autotest(self):
         """Autotest ArduSub in SITL."""
         if not self.hasInit:
@@ -220,25 +217,8 @@ class AutoTestSub(AutoTest):
         try:
             self.progress("Waiting for a heartbeat with mavlink protocol %s"
                           % self.mav.WIRE_PROTOCOL_VERSION)
-            self.mav.wait_heartbeat()
-            self.mavproxy.send('param set FS_GCS_ENABLE 0\n')
-            self.progress("Waiting for GPS fix")
-            self.mav.wait_gps_fix()
-
-            # wait for EKF and GPS checks to pass
-            self.mavproxy.expect('IMU0 is using GPS')
-
-            self.homeloc = self.mav.location()
-            self.progress("Home location: %s" % self.homeloc)
-            self.set_rc_default()
-            if not self.arm_vehicle():
-                self.progress("Failed to ARM")
-                failed = True
-            if not self.dive_manual():
-                self.progress("Failed manual dive")
-                failed = True
-            if not self.dive_mission(os.path.join(testdir, "sub_mission.txt")):
-                self.progress("Failed auto mission")
+            if not self.run_test_cases(self.test_cases(),
+                                       boot=self.boot_setup):
                 failed = True
             if not self.log_download(self.buildlogs_path("ArduSub-log.bin")):
                 self.progress("Failed log download")
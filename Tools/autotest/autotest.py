@@ -7,6 +7,7 @@ from __future__ import print_function
 import atexit
 import fnmatch
 import glob
+import json
 import optparse
 import os
 import shutil
@@ -37,7 +38,7 @@ def buildlogs_path(path):
         bits.append(path)
     return os.path.join(*bits)
 
-def get_default_params(atype, binary):
+def get_default_params(atype, binary, instance=0):
     """Get default parameters."""
 
     # use rover simulator so SITL is not starved of input
@@ -48,16 +49,17 @@ def get_default_params(atype, binary):
         frame = "+"
 
     home = "%f,%f,%u,%u" % (HOME.lat, HOME.lng, HOME.alt, HOME.heading)
-    sitl = util.start_SITL(binary, wipe=True, model=frame, home=home, speedup=10, unhide_parameters=True)
-    mavproxy = util.start_MAVProxy_SITL(atype)
+    master = 'tcp:127.0.0.1:%u' % (5760 + 10 * instance)
+    sitl = util.start_SITL(binary, wipe=True, model=frame, home=home, speedup=10, unhide_parameters=True, instance=instance)
+    mavproxy = util.start_MAVProxy_SITL(atype, master=master)
     print("Dumping defaults")
     idx = mavproxy.expect(['Please Run Setup', 'Saved [0-9]+ parameters to (\S+)'])
     if idx == 0:
         # we need to restart it after eeprom erase
         util.pexpect_close(mavproxy)
         util.pexpect_close(sitl)
-        sitl = util.start_SITL(binary, model=frame, home=home, speedup=10)
-        mavproxy = util.start_MAVProxy_SITL(atype)
+        sitl = util.start_SITL(binary, model=frame, home=home, speedup=10, instance=instance)
+        mavproxy = util.start_MAVProxy_SITL(atype, master=master)
         idx = mavproxy.expect('Saved [0-9]+ parameters to (\S+)')
     parmfile = mavproxy.match.group(1)
     dest = buildlogs_path('%s-defaults.parm' % atype)
@@ -162,6 +164,12 @@ def alarm_handler(signum, frame):
         util.pexpect_close_all()
         convert_gpx()
         write_fullresults()
+        # let steps running in parallel close their SITL and MAVProxy,
+        # which are in sessions of their own so escape the killpg
+        import multiprocessing
+        for process in multiprocessing.active_children():
+            process.terminate()
+            process.join()
         os.killpg(0, signal.SIGKILL)
     except Exception:
         pass
@@ -184,6 +192,9 @@ __bin_names = {
     "ArduSub" : "ardusub"
 }
 
+# binaries copied aside when running steps in parallel, by binary name
+binary_snapshots = {}
+
 def binary_path(step, debug=False):
     try:
         vehicle = step.split(".")[1]
@@ -196,6 +207,12 @@ def binary_path(step, debug=False):
         # cope with builds that don't have a specific binary
         return None
 
+    if binary_name in binary_snapshots:
+        return binary_snapshots[binary_name]
+
+    return built_binary_path(binary_name, debug)
+
+def built_binary_path(binary_name, debug=False):
     if debug:
         binary_basedir = "sitl-debug"
     else:
@@ -211,8 +228,8 @@ def binary_path(step, debug=False):
     return binary
 
 
-def run_step(step):
-    """Run one step."""
+def run_step(step, instance=0):
+    """Run one step, with any SITL started as the given instance."""
 
     # remove old logs
     util.run_cmd('/bin/rm -f logs/*.BIN logs/LASTLOG.TXT')
@@ -248,7 +265,7 @@ def run_step(step):
 
     if step.startswith("default"):
         vehicle = step[8:]
-        return get_default_params(vehicle, binary)
+        return get_default_params(vehicle, binary, instance)
 
     fly_opts = {
         "viewerip": opts.viewerip,
@@ -256,33 +273,34 @@ def run_step(step):
         "valgrind": opts.valgrind,
         "gdb": opts.gdb,
         "gdbserver": opts.gdbserver,
+        "instance": instance,
     }
     if opts.speedup is not None:
         fly_opts["speedup"] = opts.speedup
 
     if step == 'fly.ArduCopter':
         arducopter = AutoTestCopter(binary, frame=opts.frame, **fly_opts)
-        return arducopter.autotest()
+        return run_autotest(step, arducopter, arducopter.autotest)
 
     if step == 'fly.CopterAVC':
         arducopter = AutoTestCopter(binary, **fly_opts)
-        return arducopter.autotest_heli()
+        return run_autotest(step, arducopter, arducopter.autotest_heli)
 
     if step == 'fly.ArduPlane':
         arduplane = AutoTestPlane(binary, **fly_opts)
-        return arduplane.autotest()
+        return run_autotest(step, arduplane, arduplane.autotest)
 
     if step == 'fly.QuadPlane':
         quadplane = AutoTestQuadPlane(binary, **fly_opts)
-        return quadplane.autotest()
+        return run_autotest(step, quadplane, quadplane.autotest)
 
     if step == 'drive.APMrover2':
         apmrover2 = AutoTestRover(binary, frame=opts.frame, **fly_opts)
-        return apmrover2.autotest()
+        return run_autotest(step, apmrover2, apmrover2.autotest)
 
     if step == 'dive.ArduSub':
         ardusub = AutoTestSub(binary, **fly_opts)
-        return ardusub.autotest()
+        return run_autotest(step, ardusub, ardusub.autotest)
 
     if step == 'build.All':
         return build_all()
@@ -305,12 +323,34 @@ def run_step(step):
     raise RuntimeError("Unknown step %s" % step)
 
 
+def run_autotest(step, tester, autotest):
+    """Run the test cases of tester selected by --cases and --shard with
+    autotest, adding their results as <step>.<test case>."""
+    tester.select_test_cases(patterns=test_case_patterns, shard=opts.shard)
+    tester.mavlink_log_download = opts.mavlink_log_download
+    try:
+        return autotest()
+    finally:
+        for (name, passed, elapsed, speedup) in tester.test_case_results:
+            if passed:
+                result = '<span class="passed-text">PASSED</span>'
+            else:
+                result = '<span class="failed-text">FAILED</span>'
+            results.add("%s.%s" % (step, name), result, elapsed, speedup)
+
+
 class TestResult(object):
     """Test result class."""
-    def __init__(self, name, result, elapsed):
+    def __init__(self, name, result, elapsed, speedup=None):
         self.name = name
         self.result = result
         self.elapsed = "%.1f" % elapsed
+        # the sim time to wall-clock time ratio the test ran at
+        self.speedup = speedup
+        if speedup is None:
+            self.speedup_text = ""
+        else:
+            self.speedup_text = " at speedup %.1f" % speedup
 
 
 class TestFile(object):
@@ -329,9 +369,9 @@ class TestResults(object):
         self.files = []
         self.images = []
 
-    def add(self, name, result, elapsed):
+    def add(self, name, result, elapsed, speedup=None):
         """Add a result."""
-        self.tests.append(TestResult(name, result, elapsed))
+        self.tests.append(TestResult(name, result, elapsed, speedup))
 
     def addfile(self, name, fname):
         """Add a result file."""
@@ -369,6 +409,7 @@ def write_fullresults():
     global results
     results.addglob("Google Earth track", '*.kmz')
     results.addfile('Full Logs', 'autotest-output.txt')
+    results.addglob('Step output', '*-output.txt')
     results.addglob('DataFlash Log', '*-log.bin')
     results.addglob("MAVLink log", '*.tlog')
     results.addglob("GPX track", '*.gpx')
@@ -470,6 +511,188 @@ def run_tests(steps):
 
     return passed
 
+# steps which run with no other step running, in the order they are listed
+exclusive_steps = ['prerequisites',
+                   'build.All',
+                   'build.Binaries',
+                   'build.DevRelease',
+                   'build.Examples',
+                   'convertgpx']
+
+# the binary built by each SITL build step
+build_step_binaries = {
+    'build.ArduPlane': 'arduplane',
+    'build.APMrover2': 'ardurover',
+    'build.ArduCopter': 'arducopter',
+    'build.AntennaTracker': 'antennatracker',
+    'build.Helicopter': 'arducopter-heli',
+    'build.ArduSub': 'ardusub',
+}
+
+def step_binary_name(step):
+    """Return the name of the SITL binary a step runs, or None."""
+    if step.startswith('build.'):
+        return None
+    try:
+        return __bin_names.get(step.split(".")[1], None)
+    except IndexError:
+        return None
+
+def step_dependencies(steps):
+    """Return (after, needs) dicts of the steps each step must wait for,
+    and the steps which must also have passed for it to be run at all."""
+    after = {}
+    needs = {}
+    for i, step in enumerate(steps):
+        after[step] = set()
+        needs[step] = set()
+        binary_name = step_binary_name(step)
+        for previous in steps[:i]:
+            if step in exclusive_steps or previous in exclusive_steps:
+                after[step].add(previous)
+            if binary_name is not None and build_step_binaries.get(previous) == binary_name:
+                # a fly step runs whatever was last built for it
+                needs[step] = set([previous])
+        after[step].update(needs[step])
+    return (after, needs)
+
+def instance_dirpath(step):
+    """Return the working directory for a step run in parallel."""
+    return util.reltopdir(os.path.join('tmp', 'autotest', step))
+
+def snapshot_binary(binary_name):
+    """Copy a SITL binary aside, so that building other vehicles can't remove
+    or replace it while steps using it are still to run."""
+    try:
+        binary = built_binary_path(binary_name, debug=opts.debug)
+    except ValueError:
+        return
+    dest = os.path.join(util.reltopdir(os.path.join('tmp', 'autotest', 'bin')), os.path.basename(binary))
+    util.mkdir_p(os.path.dirname(dest))
+    shutil.copy2(binary, dest)
+    binary_snapshots[binary_name] = dest
+
+def child_signal_handler(signum, frame):
+    """Close the SITL and MAVProxy processes started by a step running in a
+    child process, which multiprocessing exits without cleaning up."""
+    util.pexpect_close_all()
+    os._exit(1)
+
+def run_step_in_child(step, instance, outfile):
+    """Run a step in a forked child process, in its own directory with its
+    output written to outfile, exiting with 0 if it passed."""
+    signal.signal(signal.SIGTERM, child_signal_handler)
+    signal.signal(signal.SIGINT, child_signal_handler)
+    if os.getenv('BUILDLOGS') is not None:
+        os.environ['BUILDLOGS'] = os.path.abspath(os.getenv('BUILDLOGS'))
+    workdir = instance_dirpath(step)
+    if os.path.exists(workdir):
+        shutil.rmtree(workdir)
+    util.mkdir_p(workdir)
+    os.chdir(workdir)
+    f = open(outfile, mode='w')
+    os.dup2(f.fileno(), sys.stdout.fileno())
+    os.dup2(f.fileno(), sys.stderr.fileno())
+    passed = False
+    first_result = len(results.tests)
+    try:
+        passed = run_step(step, instance)
+        if passed:
+            check_logs(step)
+    except Exception:
+        traceback.print_exc(file=sys.stdout)
+        check_logs(step)
+    util.pexpect_close_all()
+    # pass the results of the step's test cases back to the parent
+    f = open('test-results.json', mode='w')
+    json.dump([(t.name, t.result, float(t.elapsed), t.speedup) for t in results.tests[first_result:]], f)
+    f.close()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    sys.exit(0 if passed else 1)
+
+def run_tests_parallel(steps, max_parallel):
+    """Run a list of steps, up to max_parallel of them at once, each with its
+    own SITL instance number and directory. SITL builds run one at a time,
+    and steps running a SITL binary wait for the build of it to pass."""
+    import multiprocessing
+
+    (after, needs) = step_dependencies(steps)
+    for step in steps:
+        name = step_binary_name(step)
+        if name is not None and not any(build_step_binaries.get(s) == name for s in steps):
+            # not being built by this run, but other builds may still clean it away
+            snapshot_binary(name)
+
+    passed = True
+    failed = []
+    finished = set()
+    pending = list(steps)
+    running = {}
+    free_instances = list(range(max_parallel))
+    try:
+        while len(pending) or len(running):
+            for step in pending[:]:
+                if len(running) >= max_parallel:
+                    break
+                if not after[step].issubset(finished):
+                    continue
+                if step.startswith('build.') and any(s.startswith('build.') for s in running):
+                    continue
+                pending.remove(step)
+                if any(s in failed for s in needs[step]):
+                    print(">>>> FAILED STEP: %s at %s (%s failed)" % (step, time.asctime(), ",".join(needs[step])))
+                    results.add(step, '<span class="failed-text">FAILED</span>', 0)
+                    failed.append(step)
+                    finished.add(step)
+                    passed = False
+                    continue
+                instance = free_instances.pop(0)
+                outfile = buildlogs_path('%s-output.txt' % step)
+                print(">>>> RUNNING STEP: %s at %s (instance %u)" % (step, time.asctime(), instance))
+                sys.stdout.flush()
+                process = multiprocessing.Process(target=run_step_in_child, args=(step, instance, outfile))
+                process.start()
+                running[step] = (process, instance, time.time(), outfile)
+
+            time.sleep(0.1)
+            for step in list(running.keys()):
+                (process, instance, t1, outfile) = running[step]
+                if process.is_alive():
+                    continue
+                process.join()
+                del running[step]
+                free_instances.append(instance)
+                finished.add(step)
+                print(util.loadfile(outfile))
+                test_results = os.path.join(instance_dirpath(step), 'test-results.json')
+                if os.path.exists(test_results):
+                    for (name, result, elapsed, speedup) in json.load(open(test_results)):
+                        results.add(name, result, elapsed, speedup)
+                if process.exitcode == 0:
+                    results.add(step, '<span class="passed-text">PASSED</span>', time.time() - t1)
+                    print(">>>> PASSED STEP: %s at %s" % (step, time.asctime()))
+                    if step in build_step_binaries:
+                        snapshot_binary(build_step_binaries[step])
+                else:
+                    print(">>>> FAILED STEP: %s at %s" % (step, time.asctime()))
+                    passed = False
+                    failed.append(step)
+                    results.add(step, '<span class="failed-text">FAILED</span>', time.time() - t1)
+                sys.stdout.flush()
+    finally:
+        for (process, instance, t1, outfile) in running.values():
+            process.terminate()
+        for (process, instance, t1, outfile) in running.values():
+            process.join()
+
+    if not passed:
+        print("FAILED %u tests: %s" % (len(failed), failed))
+
+    write_fullresults()
+
+    return passed
+
 if __name__ == "__main__":
 ############## main program #############
     os.environ['PYTHONUNBUFFERED'] = '1'
@@ -483,18 +706,36 @@ if __name__ == "__main__":
     parser.add_option("--map", action='store_true', default=False, help='show map')
     parser.add_option("--experimental", default=False, action='store_true', help='enable experimental tests')
     parser.add_option("--timeout", default=3000, type='int', help='maximum runtime in seconds')
-    parser.add_option("--speedup", default=None, type='int', help='speedup to run the simulations at')
+    parser.add_option("--speedup", default=None, type='int', help='speedup to run the simulations at, instead of adapting it to what the host can sustain')
     parser.add_option("--valgrind", default=False, action='store_true', help='run ArduPilot binaries under valgrind')
     parser.add_option("--gdb", default=False, action='store_true', help='run ArduPilot binaries under gdb')
     parser.add_option("--debug", default=False, action='store_true', help='make built binaries debug binaries')
     parser.add_option("-j", default=None, type='int', help='build CPUs')
+    parser.add_option("--parallel", default=1, type='int', help='number of steps to run at once, each with its own SITL instance')
     parser.add_option("--frame", type='string', default=None, help='specify frame type')
     parser.add_option("--gdbserver", default=False, action='store_true', help='run ArduPilot binaries under gdbserver')
     parser.add_option("--no-clean", default=False, action='store_true', help='do not clean before building', dest="no_clean")
     parser.add_option("--no-configure", default=False, action='store_true', help='do not configure before building', dest="no_configure")
+    parser.add_option("--cases", type='string', default=None, help='list of test cases to run in each step (comma separated, wildcards allowed)')
+    parser.add_option("--mavlink-log-download", default=False, action='store_true', help="download dataflash logs over MAVLink, testing the vehicle's log transfer, rather than copying them from SITL", dest="mavlink_log_download")
+    parser.add_option("--shard", type='string', default=None, help="run only shard i of n of each step's test cases, given as i/n")
 
     opts, args = parser.parse_args()
 
+    test_case_patterns = None
+    if opts.cases is not None:
+        test_case_patterns = opts.cases.split(',')
+
+    if opts.shard is not None:
+        try:
+            (shard, shards) = [int(x) for x in opts.shard.split('/')]
+        except ValueError:
+            shard = shards = 0
+        if shards < 1 or shard < 1 or shard > shards:
+            print("Bad --shard %s, should be i/n with 1 <= i <= n" % opts.shard)
+            sys.exit(1)
+        opts.shard = (shard, shards)
+
 
     steps = [
     'prerequisites',
@@ -568,8 +809,16 @@ if __name__ == "__main__":
 
     results = TestResults()
 
+    if opts.parallel > 1 and (opts.gdb or opts.gdbserver):
+        print("Running steps one at a time under gdb")
+        opts.parallel = 1
+
     try:
-        if not run_tests(steps_to_run):
+        if opts.parallel > 1:
+            passed = run_tests_parallel(steps_to_run, opts.parallel)
+        else:
+            passed = run_tests(steps_to_run)
+        if not passed:
             sys.exit(1)
     except KeyboardInterrupt:
         util.pexpect_close_all()
@@ -1,14 +1,24 @@
 from __future__ import print_function
+import collections
+import fnmatch
+import itertools
 import math
+import re
+import struct
+import threading
 import time
+import traceback
 
 from pymavlink import mavwp, mavutil
 
 from pysim import util
+from pysim import vehicleinfo
 
 import sys
 import abc
 import os
+import shutil
+import socket
 
 # a list of pexpect objects to read while waiting for
 # messages. This keeps the output to stdout flowing
@@ -28,13 +38,208 @@ class AutoTestTimeoutException(Exception):
     pass
 
 
+class MAVLinkDispatcher(object):
+    """Reads all messages from a MAVLink connection in a background thread,
+    keeping the latest message of each type and a bounded history of all of
+    them. Waits walk that history on the caller's thread from the last
+    message of each type they wait for that any wait examined, so nothing
+    of that type received in between is missed."""
+
+    def __init__(self, mav, history=10000):
+        self.mav = mav
+        self.cond = threading.Condition()
+        self.latest = {}
+        self.history = collections.deque(maxlen=history)
+        # sequence number of the last message received, and by type of the
+        # last one examined by a wait; those up to base count as examined
+        self.received = 0
+        self.examined = {}
+        self.base = 0
+        self.sim_time = None
+        # (wall-clock time, sim time) of recent SYSTEM_TIMEs
+        self.sim_time_samples = collections.deque(maxlen=1000)
+        # exception which stopped the thread reading self.mav
+        self.error = None
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        try:
+            while self.running:
+                m = self.mav.recv_msg()
+                if m is None:
+                    self.mav.select(0.05)
+                    continue
+                with self.cond:
+                    self.received += 1
+                    self.history.append((self.received, m))
+                    self.latest[m.get_type()] = m
+                    if m.get_type() == 'SYSTEM_TIME':
+                        self.sim_time = m.time_boot_ms * 1.0e-3
+                        self.sim_time_samples.append((time.time(),
+                                                      self.sim_time))
+                    self.cond.notify_all()
+        except Exception as e:
+            # raised to the test thread by wait
+            with self.cond:
+                self.error = e
+                self.cond.notify_all()
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+
+    def reset(self):
+        """Forget everything received so far, for a restarted vehicle."""
+        with self.cond:
+            self.base = self.received
+            self.examined = {}
+            self.latest = {}
+            self.sim_time = None
+            self.sim_time_samples.clear()
+
+    @staticmethod
+    def sim_wall_timeout(timeout):
+        """Return the wall-clock seconds after which a wait of timeout
+        seconds of sim time gives up, allowing for SITL running at well
+        under realtime, e.g. under valgrind."""
+        return 60 + 10 * timeout
+
+    def cursor(self, type):
+        """Return the sequence number of the last message of type examined."""
+        return max(self.base, self.examined.get(type, 0))
+
+    def received_after(self, seq):
+        """Return the (seq, message)s in the history received after seq."""
+        with self.cond:
+            count = min(self.received - seq, len(self.history))
+            return list(itertools.islice(self.history,
+                                         len(self.history) - count,
+                                         None))
+
+    def preceding(self, m, type):
+        """Return the last message of type received before m, or None if
+        there isn't one in the history."""
+        with self.cond:
+            found = False
+            for (seq, h) in reversed(self.history):
+                if h is m:
+                    found = True
+                elif found and h.get_type() == type:
+                    return h
+        return None
+
+    def wait(self, predicate, type=None, timeout=None, wall_timeout=None):
+        """Return the first unexamined message of one of the given types for
+        which predicate returns True, waiting up to timeout seconds of sim
+        time or wall_timeout seconds of wall-clock time for it. Returns None
+        on timeout. A sim time timeout is also bounded by wall-clock time,
+        in case sim time stops. Raises the exception that stopped the
+        thread reading self.mav, if one did."""
+        if type is not None and not isinstance(type, (list, set)):
+            type = [type]
+        if timeout is not None and wall_timeout is None:
+            wall_timeout = self.sim_wall_timeout(timeout)
+        sim_deadline = None
+        if wall_timeout is not None:
+            wall_deadline = time.time() + wall_timeout
+        # every message after this has been looked at by this wait
+        if type is None:
+            scanned = self.base
+        else:
+            scanned = min(self.cursor(t) for t in type)
+        while True:
+            if (timeout is not None and sim_deadline is None and
+                    self.sim_time is not None):
+                sim_deadline = self.sim_time + timeout
+            for (seq, m) in self.received_after(scanned):
+                scanned = seq
+                mtype = m.get_type()
+                # skipping those already seen by a wait inside predicate
+                if ((type is None or mtype in type) and
+                        seq > self.cursor(mtype)):
+                    self.examined[mtype] = seq
+                    if predicate(m):
+                        return m
+                if mtype == 'SYSTEM_TIME' and timeout is not None:
+                    if sim_deadline is None:
+                        sim_deadline = m.time_boot_ms * 1.0e-3 + timeout
+                    elif m.time_boot_ms * 1.0e-3 > sim_deadline:
+                        return None
+            if self.error is not None:
+                raise self.error
+            if wall_timeout is not None and time.time() >= wall_deadline:
+                return None
+            for hook in self.mav.idle_hooks:
+                hook(self.mav)
+            with self.cond:
+                if self.received == scanned:
+                    self.cond.wait(0.05)
+
+    def recv_match(self, condition=None, type=None, blocking=False,
+                   timeout=None):
+        """Drop-in for mavfile.recv_match served from the history. condition
+        is evaluated with the message being examined in place of the latest
+        of its type, and with no type given only messages of the types
+        condition refers to are returned."""
+        if not blocking:
+            timeout = 0
+        if condition is not None and type is None:
+            type = re.findall(r'\b([A-Z][A-Z0-9_]*)\.', condition) or None
+
+        def condition_ok(m):
+            if condition is None:
+                return True
+            with self.cond:
+                messages = dict(self.latest)
+            messages[m.get_type()] = m
+            return mavutil.evaluate_condition(condition, messages)
+
+        return self.wait(condition_ok, type=type, wall_timeout=timeout)
+
+
+class AutoTestCase(object):
+    """A test case run by AutoTest.run_test_cases. setup brings the vehicle
+    from the checkpoint taken before the first case to the state function
+    starts from; teardown is run after function whatever its result."""
+    def __init__(self, name, description, function,
+                 setup=None, teardown=None):
+        self.name = name
+        self.description = description
+        self.function = function
+        self.setup = setup
+        self.teardown = teardown
+
+
 class AutoTest(ABC):
     """Base abstract class.
     It implements the common function for all vehicle types.
     """
-    def __init__(self):
+    def __init__(self, instance=0):
         self.mavproxy = None
         self.mav = None
+        self.mav_dispatcher = None
+        # the SITL speedup is adapted to what the host achieves if None
+        # is passed as the speedup to the vehicle's constructor
+        self.adaptive_speedup = False
+        self.speedup_max = 50
+        # lowest speedup the host has failed to keep up with
+        self.speedup_ceiling = None
+        self.speedup_adapted = 0
+        self.sitl = None
+        self.sitl_dirpath = None
+        self.sitl_args = None
+        # download logs over MAVLink even from a local SITL, testing the
+        # vehicle's log transfer
+        self.mavlink_log_download = False
+        self.test_case_patterns = None
+        self.shard = None
+        # (name, passed, elapsed, achieved speedup or None) for each test
+        # case run
+        self.test_case_results = []
+        self.instance = instance
 
     def progress(self, text):
         """Display autotest progress text."""
@@ -53,6 +258,305 @@ class AutoTest(ABC):
             bits.append(path)
         return os.path.join(*bits)
 
+    def sitl_port(self, port):
+        """Return the port used by this SITL instance for an instance 0 port.
+        SITL adds 10 for each instance to all its ports."""
+        return port + 10 * self.instance
+
+    def mavproxy_master(self):
+        """MAVProxy --master for this SITL instance."""
+        return 'tcp:127.0.0.1:%u' % self.sitl_port(5760)
+
+    def mavlink_out(self):
+        """Address MAVProxy forwards MAVLink to for this instance's tests."""
+        return '127.0.0.1:%u' % self.sitl_port(19550)
+
+    def mavproxy_options(self):
+        """MAVProxy options connecting it to this SITL instance."""
+        return '--sitl=127.0.0.1:%u --out=%s' % (self.sitl_port(5501),
+                                                 self.mavlink_out())
+
+    def sitl_defaults_file(self, vehicle):
+        """Return the SITL --defaults files for self.params, which are the
+        frame's default parameters if None, plus the autotest logging
+        settings. These are loaded by SITL as it boots."""
+        if self.params is None:
+            frames = vehicleinfo.VehicleInfo().options[vehicle]["frames"]
+            self.params = frames[self.frame]["default_params_filename"]
+        if not isinstance(self.params, list):
+            self.params = [self.params]
+        params = self.params + ['default_params/autotest-logging.parm']
+        return ",".join([os.path.join(testdir, x) for x in params])
+
+    def start_SITL(self, **sitl_args):
+        """Start this instance's SITL at self.speedup, remembering sitl_args
+        so restart_SITL can start it the same way again."""
+        if self.speedup is None:
+            self.adaptive_speedup = True
+            self.speedup = self.sustained_speedup()
+            self.progress("Starting at speedup %u" % self.speedup)
+        self.sitl_args = sitl_args
+        # SITL writes its eeprom and dataflash logs to its working directory
+        self.sitl_dirpath = os.getcwd()
+        self.sitl = util.start_SITL(self.binary,
+                                    instance=self.instance,
+                                    speedup=self.speedup,
+                                    **sitl_args)
+
+    def restart_SITL(self, eeprom=None):
+        """Restart SITL without wiping its eeprom, first replacing that with
+        the file eeprom if given. MAVProxy reconnects to the new SITL by
+        itself, and so keeps the same tlog."""
+        util.pexpect_close(self.sitl)
+        if eeprom is not None:
+            shutil.copy(eeprom, "eeprom.bin")
+        sitl_args = dict(self.sitl_args, wipe=False)
+        self.sitl = util.start_SITL(self.binary,
+                                    instance=self.instance,
+                                    speedup=self.speedup,
+                                    **sitl_args)
+        self.expect_list_clear()
+        self.expect_list_extend([self.sitl, self.mavproxy])
+        # sim time starts again from zero
+        self.mav_dispatcher.reset()
+        self.mav.wait_heartbeat()
+        if self.adaptive_speedup:
+            # eeprom may hold a SIM_SPEEDUP from before the checkpoint
+            self.set_parameter('SIM_SPEEDUP', self.speedup)
+
+    def sustained_speedup_filepath(self):
+        """Return the file holding the speedup this vehicle last sustained
+        on this host."""
+        return os.path.join(util.reltopdir('tmp'),
+                            'autotest-speedup',
+                            '%s-%s-%s' % (socket.gethostname(),
+                                          type(self).__name__,
+                                          util.make_safe_filename(
+                                              str(self.frame))))
+
+    def sustained_speedup(self):
+        """Return the speedup this vehicle last sustained on this host, or
+        self.speedup_default if there isn't one."""
+        try:
+            return int(util.loadfile(self.sustained_speedup_filepath()))
+        except Exception:
+            return self.speedup_default
+
+    def save_sustained_speedup(self):
+        filepath = self.sustained_speedup_filepath()
+        util.mkdir_p(os.path.dirname(filepath))
+        tmp = filepath + ".tmp%u" % os.getpid()
+        f = open(tmp, mode='w')
+        f.write("%u\n" % self.speedup)
+        f.close()
+        os.rename(tmp, filepath)
+
+    def achieved_speedup(self, window=10):
+        """Return the ratio of sim time to wall-clock time over about the
+        last window wall-clock seconds, or None if that's not known yet."""
+        with self.mav_dispatcher.cond:
+            samples = list(self.mav_dispatcher.sim_time_samples)
+        if not len(samples):
+            return None
+        (wall_end, sim_end) = samples[-1]
+        for (wall_start, sim_start) in samples:
+            if wall_start >= wall_end - window:
+                break
+        if wall_end - wall_start < window / 2.0:
+            return None
+        return (sim_end - sim_start) / (wall_end - wall_start)
+
+    def adapt_speedup(self, interval=10):
+        """With an adaptive speedup, at most every interval seconds compare
+        the achieved speedup with the one asked for. If the host falls
+        behind, back off to below what it achieved; if it keeps up, try
+        half as fast again, up to self.speedup_max but only half way to
+        the last speedup it fell behind at."""
+        if not self.adaptive_speedup:
+            return
+        if time.time() - self.speedup_adapted < interval:
+            return
+        achieved = self.achieved_speedup(window=interval)
+        if achieved is None:
+            return
+        self.speedup_adapted = time.time()
+        if achieved < 0.8 * self.speedup:
+            self.speedup_ceiling = self.speedup
+            speedup = max(1, int(0.9 * achieved))
+        elif achieved >= 0.95 * self.speedup:
+            speedup = min(self.speedup_max, int(math.ceil(1.5 * self.speedup)))
+            if self.speedup_ceiling is not None:
+                # close in on it rather than failing at it again
+                speedup = min(speedup,
+                              (self.speedup + self.speedup_ceiling) // 2)
+        else:
+            return
+        if speedup == self.speedup:
+            return
+        self.progress("Speedup %.1f achieved of %u, changing to %u" %
+                      (achieved, self.speedup, speedup))
+        self.speedup = speedup
+        self.set_parameter('SIM_SPEEDUP', speedup)
+        # forget samples from before the change
+        with self.mav_dispatcher.cond:
+            self.mav_dispatcher.sim_time_samples.clear()
+
+    def checkpoint_filepath(self, name):
+        """Return where checkpoint name is saved for this vehicle."""
+        return os.path.join(os.getcwd(),
+                            "checkpoints",
+                            "%s-%s.bin" % (type(self).__name__, name))
+
+    def save_checkpoint(self, name):
+        """Save the vehicle's eeprom, holding its parameters, mission, fence
+        and rally points, as checkpoint name. SITL can't save its physics
+        or EKF state, so to get back to a flight state restore_checkpoint
+        runs a setup function, e.g. takeoff, on the restored vehicle."""
+        # parameter saves are queued to the IO thread; let them complete
+        self.wait_seconds(1)
+        filepath = self.checkpoint_filepath(name)
+        util.mkdir_p(os.path.dirname(filepath))
+        shutil.copy("eeprom.bin", filepath)
+        self.progress("Saved checkpoint %s to %s" % (name, filepath))
+
+    def restore_checkpoint(self, name, setup=None):
+        """Restart SITL from checkpoint name, then call setup, if given, to
+        bring the vehicle to the state a test starts from. Returns the
+        result of setup, or True."""
+        self.progress("Restoring checkpoint %s" % name)
+        self.restart_SITL(eeprom=self.checkpoint_filepath(name))
+        if setup is None:
+            return True
+        return setup()
+
+    def start_mavlink_connection(self, timeout=60):
+        """Connect to the MAVLink forwarded by MAVProxy, returning once the
+        first HEARTBEAT has been received. From then on self.mav is read
+        only by a MAVLinkDispatcher, which serves its recv_match."""
+        connection_string = self.mavlink_out()
+        try:
+            self.mav = mavutil.mavlink_connection(connection_string,
+                                                  robust_parsing=True)
+        except Exception as msg:
+            self.progress("Failed to start mavlink connection on %s: %s" %
+                          (connection_string, msg,))
+            raise
+        self.mav.idle_hooks.append(self.idle_hook)
+        self.mav_dispatcher = MAVLinkDispatcher(self.mav)
+        self.mav.recv_match = self.mav_dispatcher.recv_match
+        if self.mav.wait_heartbeat(timeout=timeout) is None:
+            raise AutoTestTimeoutException("No HEARTBEAT on %s" %
+                                           connection_string)
+
+    def stop_mavlink_connection(self):
+        """Stop reading MAVLink and close the connection."""
+        self.mav_dispatcher.stop()
+        self.mav.close()
+
+    def wait_message(self, predicate, type=None, timeout=None):
+        """Return the first message of type received since the last wait for
+        which predicate returns True, or None after timeout seconds of sim
+        time."""
+        self.adapt_speedup()
+        return self.mav_dispatcher.wait(predicate, type=type, timeout=timeout)
+
+    def latest_message(self, type):
+        """Return the last message of type received, without waiting."""
+        return self.mav_dispatcher.latest.get(type)
+
+    #################################################
+    # TEST CASES
+    #################################################
+    def select_test_cases(self, patterns=None, shard=None):
+        """Run only the test cases whose names match one of the fnmatch
+        patterns, and of those only every n'th from the i'th (counting
+        from 1) for shard (i, n)."""
+        self.test_case_patterns = patterns
+        self.shard = shard
+
+    def selected_test_cases(self, test_cases):
+        """Return the test cases from test_cases selected to be run."""
+        selected = test_cases
+        if self.test_case_patterns is not None:
+            selected = [x for x in selected
+                        if any(fnmatch.fnmatch(x.name.lower(), p.lower())
+                               for p in self.test_case_patterns)]
+        if self.shard is not None:
+            (i, n) = self.shard
+            selected = selected[i-1::n]
+        return selected
+
+    def run_test_cases(self, test_cases, boot=None, checkpoint="booted"):
+        """Run the selected test cases in order, recording each one's result
+        and time in self.test_case_results, and return True if they all
+        passed. boot is called first, and the vehicle then saved as
+        checkpoint. Each case carries on from where the case before it in
+        test_cases left the vehicle; when that case failed or wasn't run,
+        the vehicle is restored from checkpoint, boot called again and the
+        case's setup run instead."""
+        if boot is not None and not boot():
+            self.progress("Failed to boot vehicle")
+            return False
+        self.save_checkpoint(checkpoint)
+        failed = []
+        previous = None
+        for test_case in self.selected_test_cases(test_cases):
+            self.progress("#")
+            self.progress("########## %s ##########" % test_case.description)
+            self.progress("#")
+            tstart = time.time()
+            index = test_cases.index(test_case)
+            passed = False
+            speedup = None
+            try:
+                if previous is None or test_cases[index-1] is not previous:
+                    if (len(self.test_case_results) and
+                            not self.restore_checkpoint(checkpoint, boot)):
+                        raise ValueError("failed to restore %s" % checkpoint)
+                    if test_case.setup is not None and not test_case.setup():
+                        raise ValueError("setup failed")
+                sim_start = self.get_sim_time()
+                wall_start = time.time()
+                passed = test_case.function()
+                # sim time restarts if SITL was restarted, so check it didn't
+                if self.get_sim_time() > sim_start:
+                    speedup = ((self.get_sim_time() - sim_start) /
+                               (time.time() - wall_start))
+            except Exception as e:
+                self.progress("Exception in %s: %s" % (test_case.name, e))
+                traceback.print_exc(file=sys.stdout)
+            if test_case.teardown is not None:
+                try:
+                    test_case.teardown()
+                except Exception as e:
+                    self.progress("Exception in %s teardown: %s" %
+                                  (test_case.name, e))
+                    passed = False
+            elapsed = time.time() - tstart
+            self.test_case_results.append((test_case.name,
+                                           passed,
+                                           elapsed,
+                                           speedup))
+            if speedup is not None:
+                elapsed_text = "%.1fs at speedup %.1f" % (elapsed, speedup)
+            else:
+                elapsed_text = "%.1fs" % elapsed
+            if passed:
+                self.progress("PASSED: %s (%s)" % (test_case.name,
+                                                   elapsed_text))
+                previous = test_case
+            else:
+                self.progress("FAILED: %s (%s)" % (test_case.name,
+                                                   elapsed_text))
+                failed.append(test_case.name)
+                previous = None
+        if self.adaptive_speedup:
+            self.save_sustained_speedup()
+        if len(failed):
+            self.progress("FAILED test cases: %s" % ",".join(failed))
+            return False
+        return True
+
     #################################################
     # GENERAL UTILITIES
     #################################################
@@ -73,10 +577,6 @@ class AutoTest(ABC):
         for p in expect_list:
             util.pexpect_drain(p)
 
-    def message_hook(self, mav, msg):
-        """Called as each mavlink msg is received."""
-        self.idle_hook(mav)
-
     def expect_callback(self, e):
         """Called when waiting for a expect pattern."""
         global expect_list
@@ -89,9 +589,10 @@ class AutoTest(ABC):
     # SIM UTILITIES
     #################################################
     def get_sim_time(self):
-        """Get SITL time."""
-        m = self.mav.recv_match(type='SYSTEM_TIME', blocking=True)
-        return m.time_boot_ms * 1.0e-3
+        """Get SITL time from the last SYSTEM_TIME received."""
+        if self.mav_dispatcher.sim_time is None:
+            self.wait_message(lambda m: True, 'SYSTEM_TIME')
+        return self.mav_dispatcher.sim_time
 
     def sim_location(self):
         """Return current simulator location."""
@@ -117,18 +618,142 @@ class AutoTest(ABC):
         self.wait_seconds(1)
 
     def log_download(self, filename, timeout=360):
-        """Download latest log."""
+        """Fetch the latest dataflash log to filename. A SITL instance
+        running here writes its logs to its own logs directory, so they're
+        taken from there; a remote vehicle's log, or any log if
+        self.mavlink_log_download is set, is downloaded over MAVLink."""
         self.disarm_vehicle()
-        self.mav.wait_heartbeat()
-        self.mavproxy.send("log list\n")
-        self.mavproxy.expect("numLogs")
-        self.mav.wait_heartbeat()
-        self.mav.wait_heartbeat()
-        self.mavproxy.send("set shownoise 0\n")
-        self.mavproxy.send("log download latest %s\n" % filename)
-        self.mavproxy.expect("Finished downloading", timeout=timeout)
-        self.mav.wait_heartbeat()
-        self.mav.wait_heartbeat()
+        if self.sitl is not None and not self.mavlink_log_download:
+            return self.log_copy_local(filename)
+        return self.log_download_mavlink(filename, timeout=timeout)
+
+    def sitl_logs_dirpath(self):
+        """Return the directory this instance's SITL writes dataflash logs
+        to."""
+        return os.path.join(self.sitl_dirpath, "logs")
+
+    def log_copy_local(self, filename):
+        """Hardlink, or failing that copy, the latest log written by this
+        instance's SITL to filename."""
+        logs_dirpath = self.sitl_logs_dirpath()
+        try:
+            lastlog = int(util.loadfile(os.path.join(logs_dirpath,
+                                                     "LASTLOG.TXT")))
+        except Exception as e:
+            self.progress("No logs in %s (%s)" % (logs_dirpath, str(e)))
+            return False
+        logfile = None
+        for name in ["%u.BIN" % lastlog, "%08u.BIN" % lastlog]:
+            if os.path.exists(os.path.join(logs_dirpath, name)):
+                logfile = os.path.join(logs_dirpath, name)
+                break
+        if logfile is None:
+            self.progress("Log %u missing from %s" % (lastlog, logs_dirpath))
+            return False
+        if os.path.exists(filename):
+            os.unlink(filename)
+        try:
+            # the link sees everything SITL writes to the log until it exits
+            os.link(logfile, filename)
+        except Exception:
+            # log writes are queued to the IO thread; let them complete
+            self.wait_seconds(2)
+            shutil.copy(logfile, filename)
+        self.progress("Copied %s to %s" % (logfile, filename))
+        return True
+
+    @staticmethod
+    def log_missing_ranges(chunks, size):
+        """Return (offset, count) for each range of a log of size bytes not
+        covered by chunks, a dict of data by offset.
+
+        >>> AutoTest.log_missing_ranges({}, 100)
+        [(0, 100)]
+        >>> AutoTest.log_missing_ranges({0: b'x' * 90, 90: b'x' * 10}, 100)
+        []
+        >>> AutoTest.log_missing_ranges({90: b'x' * 90, 270: b'x' * 30}, 300)
+        [(0, 90), (180, 90)]
+        >>> AutoTest.log_missing_ranges({0: b'x' * 90, 45: b'x' * 90}, 200)
+        [(135, 65)]
+        """
+        missing = []
+        pos = 0
+        for ofs in sorted(chunks.keys()):
+            if ofs > pos:
+                missing.append((pos, ofs - pos))
+            pos = max(pos, ofs + len(chunks[ofs]))
+        if pos < size:
+            missing.append((pos, size - pos))
+        return missing
+
+    def log_download_mavlink(self, filename, timeout=360):
+        """Download the latest log over MAVLink. The vehicle serves one
+        LOG_REQUEST_DATA at a time, streaming LOG_DATA for the whole range
+        requested, so the whole log is asked for at once and then only the
+        ranges lost in transit are asked for again."""
+        tstart = time.time()
+        target_system = self.mav.target_system
+        target_component = self.mav.target_component
+        self.mav.mav.log_request_list_send(target_system,
+                                           target_component,
+                                           0,
+                                           0xffff)
+        entries = {}
+        while True:
+            m = self.mav.recv_match(type='LOG_ENTRY',
+                                    blocking=True,
+                                    timeout=10)
+            if m is None:
+                raise AutoTestTimeoutException("No LOG_ENTRY received")
+            if m.num_logs == 0:
+                self.progress("Vehicle has no logs")
+                return False
+            entries[m.id] = m
+            if m.id == m.last_log_num:
+                break
+        entry = entries[max(entries.keys())]
+        size = entry.size
+        self.progress("Downloading log %u (%u bytes)" % (entry.id, size))
+        chunks = {}
+        missing = [(0, size)]
+        while len(missing):
+            if time.time() - tstart > timeout:
+                raise AutoTestTimeoutException(
+                    "Log download incomplete: %u ranges missing" %
+                    len(missing))
+            (ofs, count) = missing[0]
+            self.mav.mav.log_request_data_send(target_system,
+                                               target_component,
+                                               entry.id,
+                                               ofs,
+                                               count)
+            while True:
+                # a request sent while the vehicle is still streaming
+                # is dropped, so a stall means asking again
+                m = self.mav.recv_match(type='LOG_DATA',
+                                        blocking=True,
+                                        timeout=2)
+                if m is None:
+                    break
+                if m.id != entry.id:
+                    continue
+                chunks[m.ofs] = bytearray(m.data[:m.count])
+                if m.count < 90:
+                    # end of the log
+                    size = min(size, m.ofs + m.count)
+                    break
+                if m.ofs + m.count >= ofs + count:
+                    break
+            missing = self.log_missing_ranges(chunks, size)
+        self.mav.mav.log_request_end_send(target_system, target_component)
+        data = bytearray()
+        for ofs in sorted(chunks.keys()):
+            data[ofs:ofs+len(chunks[ofs])] = chunks[ofs]
+        f = open(filename, mode='wb')
+        f.write(data[:size])
+        f.close()
+        self.progress("Downloaded %u bytes in %.1fs" %
+                      (size, time.time() - tstart))
         return True
 
     def show_gps_and_sim_positions(self, on_off):
@@ -202,16 +827,39 @@ class AutoTest(ABC):
         return True
 
     def set_parameter(self, name, value):
-        for i in range(1, 10):
-            self.mavproxy.send("param set %s %s\n" % (name, str(value)))
-            self.mavproxy.send("param fetch %s\n" % name)
-            self.mavproxy.expect("%s = (.*)" % (name,))
-            returned_value = self.mavproxy.match.group(1)
-            if float(returned_value) == float(value):
-                # yes, exactly equal.
-                break
-            self.progress("Param fetch returned incorrect value (%s) vs (%s)"
-                          % (returned_value, value))
+        """Set one parameter, see set_parameters."""
+        self.set_parameters({name: value})
+
+    def set_parameters(self, parameters, timeout=10, retries=3):
+        """Set a dict of parameter names to values over MAVLink. PARAM_SETs
+        for all of them are sent at once, then the PARAM_VALUEs sent back
+        collected; any parameter not confirmed with its new value within
+        timeout seconds is sent again, up to retries times."""
+        # PARAM_VALUE carries a float, so compare with what that makes of value
+        pending = dict((name, struct.unpack('f', struct.pack('f', value))[0])
+                       for (name, value) in parameters.items())
+        for i in range(retries):
+            for (name, value) in pending.items():
+                self.mav.param_set_send(name, value)
+            tstart = time.time()
+            while len(pending) and time.time() < tstart + timeout:
+                m = self.mav.recv_match(type='PARAM_VALUE',
+                                        blocking=True,
+                                        timeout=tstart + timeout - time.time())
+                if m is None or m.param_id not in pending:
+                    continue
+                if m.param_value == pending[m.param_id]:
+                    # yes, exactly equal.
+                    del pending[m.param_id]
+                else:
+                    self.progress("PARAM_VALUE for %s returned incorrect value "
+                                  "(%s) vs (%s)" % (m.param_id, m.param_value,
+                                                    pending[m.param_id]))
+            if not len(pending):
+                return
+            self.progress("Resending parameters %s" % ",".join(pending.keys()))
+        raise AutoTestTimeoutException("Failed to set parameters %s" %
+                                       ",".join(pending.keys()))
 
     def get_parameter(self, name):
         self.mavproxy.send("param fetch %s\n" % name)
@@ -329,104 +977,122 @@ class AutoTest(ABC):
     #################################################
     def wait_seconds(self, seconds_to_wait):
         """Wait some second in SITL time."""
-        tstart = self.get_sim_time()
-        tnow = tstart
-        while tstart + seconds_to_wait > tnow:
-            tnow = self.get_sim_time()
+        tend = self.get_sim_time() + seconds_to_wait
+        self.wait_message(lambda m: m.time_boot_ms * 1.0e-3 >= tend,
+                          'SYSTEM_TIME')
 
     def wait_altitude(self, alt_min, alt_max, timeout=30):
         """Wait for a given altitude range."""
-        climb_rate = 0
-        previous_alt = 0
+        previous_alt = [0]
 
-        tstart = self.get_sim_time()
-        self.progress("Waiting for altitude between %u and %u" %
-                      (alt_min, alt_max))
-        while self.get_sim_time() < tstart + timeout:
-            m = self.mav.recv_match(type='VFR_HUD', blocking=True)
-            climb_rate = m.alt - previous_alt
-            previous_alt = m.alt
+        def altitude_ok(m):
+            climb_rate = m.alt - previous_alt[0]
+            previous_alt[0] = m.alt
             self.progress("Wait Altitude: Cur:%u, min_alt:%u, climb_rate: %u"
                           % (m.alt, alt_min, climb_rate))
-            if m.alt >= alt_min and m.alt <= alt_max:
-                self.progress("Altitude OK")
-                return True
+            return m.alt >= alt_min and m.alt <= alt_max
+
+        self.progress("Waiting for altitude between %u and %u" %
+                      (alt_min, alt_max))
+        if self.wait_message(altitude_ok, 'VFR_HUD', timeout) is not None:
+            self.progress("Altitude OK")
+            return True
         self.progress("Failed to attain altitude range")
         return False
 
     def wait_groundspeed(self, gs_min, gs_max, timeout=30):
         """Wait for a given ground speed range."""
-        tstart = self.get_sim_time()
-        self.progress("Waiting for groundspeed between %.1f and %.1f" %
-                      (gs_min, gs_max))
-        while self.get_sim_time() < tstart + timeout:
-            m = self.mav.recv_match(type='VFR_HUD', blocking=True)
+        def groundspeed_ok(m):
             self.progress("Wait groundspeed %.1f, target:%.1f" %
                           (m.groundspeed, gs_min))
-            if m.groundspeed >= gs_min and m.groundspeed <= gs_max:
-                return True
+            return m.groundspeed >= gs_min and m.groundspeed <= gs_max
+
+        self.progress("Waiting for groundspeed between %.1f and %.1f" %
+                      (gs_min, gs_max))
+        if self.wait_message(groundspeed_ok, 'VFR_HUD', timeout) is not None:
+            return True
         self.progress("Failed to attain groundspeed range")
         return False
 
     def wait_roll(self, roll, accuracy, timeout=30):
         """Wait for a given roll in degrees."""
-        tstart = self.get_sim_time()
-        self.progress("Waiting for roll of %d at %s" % (roll, time.ctime()))
-        while self.get_sim_time() < tstart + timeout:
-            m = self.mav.recv_match(type='ATTITUDE', blocking=True)
+        def roll_ok(m):
             p = math.degrees(m.pitch)
             r = math.degrees(m.roll)
             self.progress("Roll %d Pitch %d" % (r, p))
-            if math.fabs(r - roll) <= accuracy:
-                self.progress("Attained roll %d" % roll)
-                return True
+            return math.fabs(r - roll) <= accuracy
+
+        self.progress("Waiting for roll of %d at %s" % (roll, time.ctime()))
+        if self.wait_message(roll_ok, 'ATTITUDE', timeout) is not None:
+            self.progress("Attained roll %d" % roll)
+            return True
         self.progress("Failed to attain roll %d" % roll)
         return False
 
     def wait_pitch(self, pitch, accuracy, timeout=30):
         """Wait for a given pitch in degrees."""
-        tstart = self.get_sim_time()
-        self.progress("Waiting for pitch of %u at %s" % (pitch, time.ctime()))
-        while self.get_sim_time() < tstart + timeout:
-            m = self.mav.recv_match(type='ATTITUDE', blocking=True)
+        def pitch_ok(m):
             p = math.degrees(m.pitch)
             r = math.degrees(m.roll)
             self.progress("Pitch %d Roll %d" % (p, r))
-            if math.fabs(p - pitch) <= accuracy:
-                self.progress("Attained pitch %d" % pitch)
-                return True
+            return math.fabs(p - pitch) <= accuracy
+
+        self.progress("Waiting for pitch of %u at %s" % (pitch, time.ctime()))
+        if self.wait_message(pitch_ok, 'ATTITUDE', timeout) is not None:
+            self.progress("Attained pitch %d" % pitch)
+            return True
         self.progress("Failed to attain pitch %d" % pitch)
         return False
 
     def wait_heading(self, heading, accuracy=5, timeout=30):
         """Wait for a given heading."""
-        tstart = self.get_sim_time()
+        def heading_ok(m):
+            self.progress("Heading %u" % m.heading)
+            return math.fabs(m.heading - heading) <= accuracy
+
         self.progress("Waiting for heading %u with accuracy %u" %
                       (heading, accuracy))
-        while self.get_sim_time() < tstart + timeout:
-            m = self.mav.recv_match(type='VFR_HUD', blocking=True)
-            self.progress("Heading %u" % m.heading)
-            if math.fabs(m.heading - heading) <= accuracy:
-                self.progress("Attained heading %u" % heading)
-                return True
+        if self.wait_message(heading_ok, 'VFR_HUD', timeout) is not None:
+            self.progress("Attained heading %u" % heading)
+            return True
         self.progress("Failed to attain heading %u" % heading)
         return False
 
+    def gps_location(self, m):
+        """Return the location mav.location() would have returned when
+        GPS_RAW_INT m was received."""
+        vfr_hud = self.mav_dispatcher.preceding(m, 'VFR_HUD')
+        if vfr_hud is None:
+            vfr_hud = self.latest_message('VFR_HUD')
+        return mavutil.location(m.lat * 1.0e-7,
+                                m.lon * 1.0e-7,
+                                vfr_hud.alt,
+                                vfr_hud.heading)
+
     def wait_distance(self, distance, accuracy=5, timeout=30):
         """Wait for flight of a given distance."""
-        tstart = self.get_sim_time()
         start = self.mav.location()
-        while self.get_sim_time() < tstart + timeout:
-            pos = self.mav.location()
-            delta = self.get_distance(start, pos)
+        overshoot = []
+
+        def distance_ok(m):
+            if m.fix_type < 3 or m.lat == 0:
+                return False
+            delta = self.get_distance(start, self.gps_location(m))
             self.progress("Distance %.2f meters" % delta)
-            if math.fabs(delta - distance) <= accuracy:
-                self.progress("Attained distance %.2f meters OK" % delta)
-                return True
             if delta > (distance + accuracy):
-                self.progress("Failed distance - overshoot delta=%f dist=%f"
-                              % (delta, distance))
-                return False
+                overshoot.append(delta)
+                return True
+            return math.fabs(delta - distance) <= accuracy
+
+        m = self.wait_message(distance_ok, 'GPS_RAW_INT', timeout)
+        if len(overshoot):
+            self.progress("Failed distance - overshoot delta=%f dist=%f"
+                          % (overshoot[0], distance))
+            return False
+        if m is not None:
+            self.progress("Attained distance %.2f meters OK" %
+                          self.get_distance(start, self.gps_location(m)))
+            return True
         self.progress("Failed to attain distance %u" % distance)
         return False
 
@@ -437,22 +1103,28 @@ class AutoTest(ABC):
                       target_altitude=None,
                       height_accuracy=-1):
         """Wait for arrival at a location."""
-        tstart = self.get_sim_time()
         if target_altitude is None:
             target_altitude = loc.alt
+
+        def location_ok(m):
+            if m.fix_type < 3 or m.lat == 0:
+                return False
+            pos = self.gps_location(m)
+            delta = self.get_distance(loc, pos)
+            self.progress("Distance %.2f meters alt %.1f" % (delta, pos.alt))
+            if delta > accuracy:
+                return False
+            height_delta = math.fabs(pos.alt - target_altitude)
+            return height_accuracy == -1 or height_delta <= height_accuracy
+
         self.progress("Waiting for location"
                       "%.4f,%.4f at altitude %.1f height_accuracy=%.1f" %
                       (loc.lat, loc.lng, target_altitude, height_accuracy))
-        while self.get_sim_time() < tstart + timeout:
-            pos = self.mav.location()
-            delta = self.get_distance(loc, pos)
-            self.progress("Distance %.2f meters alt %.1f" % (delta, pos.alt))
-            if delta <= accuracy:
-                height_delta = math.fabs(pos.alt - target_altitude)
-                if (height_accuracy != -1 and height_delta > height_accuracy):
-                    continue
-                self.progress("Reached location (%.2f meters)" % delta)
-                return True
+        m = self.wait_message(location_ok, 'GPS_RAW_INT', timeout)
+        if m is not None:
+            self.progress("Reached location (%.2f meters)" %
+                          self.get_distance(loc, self.gps_location(m)))
+            return True
         self.progress("Failed to attain location")
         return False
 
@@ -463,11 +1135,11 @@ class AutoTest(ABC):
                       max_dist=2,
                       timeout=400):
         """Wait for waypoint ranges."""
-        tstart = self.get_sim_time()
         # this message arrives after we set the current WP
         start_wp = self.mav.waypoint_current()
-        current_wp = start_wp
         mode = self.mav.flightmode
+        # current waypoint, and the result once the wait is over
+        state = {"current_wp": start_wp, "result": None}
 
         self.progress("\ntest: wait for waypoint ranges start=%u end=%u\n\n"
                       % (wpnum_start, wpnum_end))
@@ -476,39 +1148,54 @@ class AutoTest(ABC):
         #                  (wpnum_start, start_wp))
         #    return False
 
-        while self.get_sim_time() < tstart + timeout:
-            seq = self.mav.waypoint_current()
-            m = self.mav.recv_match(type='NAV_CONTROLLER_OUTPUT',
-                                    blocking=True)
+        def waypoint_progress(m):
+            """Check NAV_CONTROLLER_OUTPUT m, returning True once the wait
+            is over or a new waypoint has started."""
+            seq = self.latest_message('MISSION_CURRENT').seq
             wp_dist = m.wp_dist
-            m = self.mav.recv_match(type='VFR_HUD', blocking=True)
+            alt = self.latest_message('VFR_HUD').alt
+            current_wp = state["current_wp"]
 
             # if we changed mode, fail
             if self.mav.flightmode != mode:
                 self.progress('Exited %s mode' % mode)
-                return False
+                state["result"] = False
+                return True
 
             self.progress("test: WP %u (wp_dist=%u Alt=%d), current_wp: %u,"
                           "wpnum_end: %u" %
-                          (seq, wp_dist, m.alt, current_wp, wpnum_end))
+                          (seq, wp_dist, alt, current_wp, wpnum_end))
+            new_wp = False
             if seq == current_wp+1 or (seq > current_wp+1 and allow_skip):
                 self.progress("test: Starting new waypoint %u" % seq)
-                tstart = self.get_sim_time()
+                new_wp = True
                 current_wp = seq
+                state["current_wp"] = seq
                 # the wp_dist check is a hack until we can sort out
                 # the right seqnum for end of mission
             # if current_wp == wpnum_end or (current_wp == wpnum_end-1 and
             #                                wp_dist < 2):
             if current_wp == wpnum_end and wp_dist < max_dist:
                 self.progress("Reached final waypoint %u" % seq)
+                state["result"] = True
                 return True
             if seq >= 255:
                 self.progress("Reached final waypoint %u" % seq)
+                state["result"] = True
                 return True
             if seq > current_wp+1:
                 self.progress("Failed: Skipped waypoint! Got wp %u expected %u"
                               % (seq, current_wp+1))
-                return False
+                state["result"] = False
+                return True
+            return new_wp
+
+        # each new waypoint restarts the timeout
+        while self.wait_message(waypoint_progress,
+                                'NAV_CONTROLLER_OUTPUT',
+                                timeout) is not None:
+            if state["result"] is not None:
+                return state["result"]
         self.progress("Failed: Timed out waiting for waypoint %u of %u" %
                       (wpnum_end, wpnum_end))
         return False
@@ -516,12 +1203,11 @@ class AutoTest(ABC):
     def wait_mode(self, mode, timeout=None):
         """Wait for mode to change."""
         self.progress("Waiting for mode %s" % mode)
-        tstart = self.get_sim_time()
-        hastimeout = False
-        while self.mav.flightmode.upper() != mode.upper() and not hastimeout:
-            if timeout is not None:
-                hastimeout = self.get_sim_time() > tstart + timeout
-            self.mav.wait_heartbeat()
+        if self.mav.flightmode.upper() != mode.upper():
+            self.wait_message(
+                lambda m: self.mav.flightmode.upper() == mode.upper(),
+                'HEARTBEAT',
+                timeout)
         self.progress("Got mode %s" % mode)
         return self.mav.flightmode
 
@@ -532,18 +1218,22 @@ class AutoTest(ABC):
     def wait_ekf_happy(self, timeout=30):
         """Wait for EKF to be happy"""
 
-        tstart = self.get_sim_time()
         required_value = 831
-        self.progress("Waiting for EKF value %u" % required_value)
-        while timeout is None or self.get_sim_time() < tstart + timeout:
-            m = self.mav.recv_match(type='EKF_STATUS_REPORT', blocking=True)
-            current = m.flags
-            if (tstart - self.get_sim_time()) % 5 == 0:
+        previous_flags = [None]
+
+        def ekf_happy(m):
+            if m.flags != previous_flags[0]:
                 self.progress("Wait EKF.flags: required:%u current:%u" %
-                              (required_value, current))
-            if current == required_value:
-                self.progress("EKF Flags OK")
-                return
+                              (required_value, m.flags))
+                previous_flags[0] = m.flags
+            return m.flags == required_value
+
+        self.progress("Waiting for EKF value %u" % required_value)
+        if self.wait_message(ekf_happy,
+                             'EKF_STATUS_REPORT',
+                             timeout) is not None:
+            self.progress("EKF Flags OK")
+            return
         self.progress("Failed to get EKF.flags=%u" % required_value)
         raise AutoTestTimeoutException()
 
@@ -652,3 +1342,9 @@ class AutoTest(ABC):
     def autotest(self):
         """Autotest used by ArduPilot autotest CI."""
         pass
+
+
+if __name__ == "__main__":
+    import doctest
+
+    doctest.testmod()
@@ -191,8 +191,9 @@ def valgrind_log_filepath(binary, model):
 
 def start_SITL(binary, valgrind=False, gdb=False, wipe=False,
     synthetic_clock=True, home=None, model=None, speedup=1, defaults_file=None,
-               unhide_parameters=False, gdbserver=False):
-    """Launch a SITL instance."""
+               unhide_parameters=False, gdbserver=False, instance=0):
+    """Launch a SITL instance. Instance N listens on ports 10*N above
+    instance 0's, so several can run at once from different directories."""
     cmd = []
     if valgrind and os.path.exists('/usr/bin/valgrind'):
         cmd.extend(['valgrind', '-q', '--log-file=%s' % valgrind_log_filepath(binary=binary, model=model)])
@@ -211,6 +212,8 @@ def start_SITL(binary, valgrind=False, gdb=False, wipe=False,
         cmd.extend(['xterm', '-e', 'gdb', '-x', '/tmp/x.gdb', '--args'])
 
     cmd.append(binary)
+    if instance != 0:
+        cmd.extend(['-I', str(instance)])
     if wipe:
         cmd.append('-w')
     if synthetic_clock:
@@ -231,20 +234,40 @@ def start_SITL(binary, valgrind=False, gdb=False, wipe=False,
     child = pexpect.spawn(first, rest, logfile=sys.stdout, encoding=ENCODING, timeout=5)
     delaybeforesend = 0
     pexpect_autoclose(child)
-    # give time for parameters to properly setup
-    time.sleep(3)
     if gdb:
         # if we run GDB we do so in an xterm.  "Waiting for
-        # connection" is never going to appear on xterm's output.
-        # ... so let's give it another magic second.
-        time.sleep(1)
+        # connection" is never going to appear on xterm's output,
+        # so wait for SITL to listen for MAVProxy instead.
         # TODO: have a SITL-compiled ardupilot able to have its
         # console on an output fd.
+        wait_for_listening_port(5760 + 10 * instance, timeout=300)
     else:
         child.expect('Waiting for connection', timeout=300)
     return child
 
 
+def wait_for_listening_port(port, timeout=60):
+    """Wait until something is listening for TCP connections on port,
+    without connecting to it."""
+    import errno
+    import socket
+    tstart = time.time()
+    while time.time() < tstart + timeout:
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # allows binding over old TIME_WAIT connections, but not over a listener
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            s.bind(('127.0.0.1', port))
+        except socket.error as e:
+            if e.errno == errno.EADDRINUSE:
+                return
+            raise
+        finally:
+            s.close()
+        time.sleep(0.1)
+    raise RuntimeError("Timed out waiting for port %u" % port)
+
+
 def start_MAVProxy_SITL(atype, aircraft=None, setup=False, master='tcp:127.0.0.1:5760',
                         options=None, logfile=sys.stdout):
     """Launch mavproxy connected to a SITL instance."""
@@ -8,6 +8,7 @@ import shutil
 from pymavlink import mavutil
 
 from common import AutoTest
+from common import AutoTestCase
 from pysim import util
 
 # get location of scripts
@@ -25,13 +26,14 @@ class AutoTestQuadPlane(AutoTest):
                  use_map=False,
                  valgrind=False,
                  gdb=False,
-                 speedup=10,
+                 speedup=None,
                  frame=None,
                  params=None,
-                 gdbserver=False):
-        super(AutoTestQuadPlane, self).__init__()
+                 gdbserver=False,
+                 instance=0):
+        super(AutoTestQuadPlane, self).__init__(instance=instance)
         self.binary = binary
-        self.options = ('--sitl=127.0.0.1:5501 --out=127.0.0.1:19550'
+        self.options = (self.mavproxy_options() +
                         ' --streamrate=10')
         self.viewerip = viewerip
         self.use_map = use_map
@@ -67,16 +69,15 @@ class AutoTestQuadPlane(AutoTest):
             self.options += ' --map'
 
         defaults_file = os.path.join(testdir, 'default_params/quadplane.parm')
-        self.sitl = util.start_SITL(self.binary,
-                                    wipe=True,
-                                    model=self.frame,
-                                    home=self.home,
-                                    speedup=self.speedup,
-                                    defaults_file=defaults_file,
-                                    valgrind=self.valgrind,
-                                    gdb=self.gdb,
-                                    gdbserver=self.gdbserver)
+        self.start_SITL(wipe=True,
+                        model=self.frame,
+                        home=self.home,
+                        defaults_file=defaults_file,
+                        valgrind=self.valgrind,
+                        gdb=self.gdb,
+                        gdbserver=self.gdbserver)
         self.mavproxy = util.start_MAVProxy_SITL('QuadPlane',
+                                                 master=self.mavproxy_master(),
                                                  options=self.options)
         self.mavproxy.expect('Telemetry log: (\S+)')
         logfile = self.mavproxy.match.group(1)
@@ -100,17 +101,7 @@ class AutoTestQuadPlane(AutoTest):
 
         self.progress("Started simulator")
 
-        # get a mavlink connection going
-        connection_string = '127.0.0.1:19550'
-        try:
-            self.mav = mavutil.mavlink_connection(connection_string,
-                                                  robust_parsing=True)
-        except Exception as msg:
-            self.progress("Failed to start mavlink connection on %s: %s" %
-                          (connection_string, msg))
-            raise
-        self.mav.message_hooks.append(self.message_hook)
-        self.mav.idle_hooks.append(self.idle_hook)
+        self.start_mavlink_connection()
         self.hasInit = True
         self.progress("Ready to start testing!")
 
@@ -119,7 +110,7 @@ class AutoTestQuadPlane(AutoTest):
             self.mavproxy.send("module unload map\n")
             self.mavproxy.expect("Unloaded module map")
 
-        self.mav.close()
+        self.stop_mavlink_connection()
         util.pexpect_close(self.mavproxy)
         util.pexpect_close(self.sitl)
 
@@ -173,6 +164,38 @@ class AutoTestQuadPlane(AutoTest):
         self.progress("Mission OK")
         return True
 
+    def boot_setup(self):
+        """Wait for a newly started vehicle to know where it is."""
+        self.mav.wait_heartbeat()
+        self.progress("Waiting for GPS fix")
+        self.mav.recv_match(condition='VFR_HUD.alt>10', blocking=True)
+        self.mav.wait_gps_fix()
+        while self.mav.location().alt < 10:
+            self.mav.wait_gps_fix()
+        self.homeloc = self.mav.location()
+        self.progress("Home location: %s" % self.homeloc)
+        return True
+
+    def arm_when_ready(self):
+        # wait for EKF and GPS checks to pass
+        self.progress("Waiting reading for arm")
+        self.wait_seconds(30)
+
+        self.arm_vehicle()
+        return True
+
+    def test_cases(self):
+        """Return the test cases autotest runs, in order."""
+        m = os.path.join(testdir, "ArduPlane-Missions/Dalby-OBC2016.txt")
+        f = os.path.join(testdir,
+                         "ArduPlane-Missions/Dalby-OBC2016-fence.txt")
+        return [
+            AutoTestCase("Mission",
+                         "Fly Dalby-OBC2016 mission",
+                         lambda: self.fly_mission(m, f),
+                         setup=self.arm_when_ready),
+        ]
+
     def autotest(self):
         """Autotest QuadPlane in SITL."""
         self.frame = 'quadplane'
@@ -184,26 +207,8 @@ class AutoTestQuadPlane(AutoTest):
         try:
             self.progress("Waiting for a heartbeat with mavlink protocol %s"
                           % self.mav.WIRE_PROTOCOL_VERSION)
-            self.mav.wait_heartbeat()
-            self.progress("Waiting for GPS fix")
-            self.mav.recv_match(condition='VFR_HUD.alt>10', blocking=True)
-            self.mav.wait_gps_fix()
-            while self.mav.location().alt < 10:
-                self.mav.wait_gps_fix()
-            self.homeloc = self.mav.location()
-            self.progress("Home location: %s" % self.homeloc)
-
-            # wait for EKF and GPS checks to pass
-            self.progress("Waiting reading for arm")
-            self.wait_seconds(30)
-
-            self.arm_vehicle()
-
-            m = os.path.join(testdir, "ArduPlane-Missions/Dalby-OBC2016.txt")
-            f = os.path.join(testdir,
-                             "ArduPlane-Missions/Dalby-OBC2016-fence.txt")
-            if not self.fly_mission(m, f):
-                self.progress("Failed mission")
+            if not self.run_test_cases(self.test_cases(),
+                                       boot=self.boot_setup):
                 failed = True
         except pexpect.TIMEOUT as e:
             self.progress("Failed with timeout")